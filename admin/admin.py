@@ -5,18 +5,18 @@ from fastapi.openapi import docs, utils
 
 from admin import auth
 from config import settings
-from admin.cachestore import CacheStore, get_cache_store
+from admin.cachestore import AsyncCacheStore, get_cache_store
 
 router = APIRouter()
 
 @router.post("/login")
-def login(response: Response, email: str = Form(...),
-          apikey: str = Form(...), cs: CacheStore = Depends(get_cache_store)):
+async def login(response: Response, email: str = Form(...),
+                apikey: str = Form(...), cs: AsyncCacheStore = Depends(get_cache_store)):
 
     if not apikey or not email:
         return None
 
-    session = cs.get_session(apikey)
+    session = await cs.get_session(apikey)
     if not session:
         response = JSONResponse({"Error": "ApiKey not found"})
         response.delete_cookie("session_id")
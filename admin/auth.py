@@ -1,26 +1,29 @@
 import urllib.parse
-import hashlib, hmac, base64
+import hashlib, hmac, base64, logging
 from datetime import datetime, timezone, timedelta
 from fastapi import Depends, APIRouter, HTTPException, status, Response, Request, BackgroundTasks, Header, Cookie
-from fastapi.responses import JSONResponse, HTMLResponse
-from sqlalchemy.orm import Session
+from fastapi.responses import JSONResponse, HTMLResponse, StreamingResponse
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from data.db import User, UserBase
-from data.db import get_db
-from admin.user import create as GetOrCreateUser
+from data.db import get_async_db
+from admin.user import create as GetOrCreateUser, user_cache
 
 from typing import Annotated
 from fastapi.security import APIKeyCookie
 
-from google.oauth2 import id_token
-from google.auth.transport import requests
+from admin import idtoken, metrics
+from admin.metrics import TimedTemplates
 from config import settings
 
-from admin.cachestore import CacheStore, get_cache_store
+from admin.cachestore import AsyncCacheStore, get_cache_store
+from admin.events import EventBus, get_event_bus, browser_channel, user_channel, session_event_stream
 
-from fastapi.templating import Jinja2Templates
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter()
-templates = Jinja2Templates(directory='templates')
+templates = TimedTemplates(directory='templates')
 
 cookie_scheme = APIKeyCookie(name="session_id", description="Admin session_id is created by create_session.sh")
 
@@ -28,7 +31,7 @@ def hash_email(email: str):
     # return hashlib.sha256(email.encode()).hexdigest()
     return base64.urlsafe_b64encode(hashlib.sha256(email.encode()).digest()).decode()
 
-def mutate_session(response: Response, old_session: dict, cs: CacheStore, immediate: bool = False):
+async def mutate_session(response: Response, old_session: dict, cs: AsyncCacheStore, immediate: bool = False):
     if not old_session:
         raise HTTPException(status_code=404, detail="Session not found")
     if old_session["email"] == settings.admin_email:
@@ -36,13 +39,14 @@ def mutate_session(response: Response, old_session: dict, cs: CacheStore, immedi
 
     age_left = old_session["expires"] - int(datetime.now(timezone.utc).timestamp())
     if not immediate and age_left*2 > settings.session_max_age:
-        print("Session still has much time: ", age_left, " seconds left.")
+        logger.debug("Session still has much time", extra={"age_left": age_left})
         return old_session
 
-    print("Session expires soon in", age_left, ". Mutating the session.")
-    session = cs.create_session(old_session["user_id"], old_session["email"])
+    logger.info("Session expires soon, rotating it", extra={"age_left": age_left, "user_id": old_session["user_id"]})
+    session = await cs.rotate_session(old_session["session_id"])
+    if not session:
+        raise HTTPException(status_code=404, detail="Session not found")
     new_cookie(response, session)
-    cs.delete_session(old_session["session_id"])
     return session
 
 def new_cookie(response: Response, session: dict):
@@ -75,7 +79,7 @@ def delete_cookie(response: Response):
     return response
 
 def csrf_verify(csrf_token: str, session: dict):
-    print("### Debug: csrf_verify: ", csrf_token)
+    logger.debug("csrf_verify", extra={"csrf_token": csrf_token})
     if hmac.compare_digest(csrf_token, session['csrf_token']):
     # if csrf_token == session['csrf_token']:
         return csrf_token
@@ -83,34 +87,45 @@ def csrf_verify(csrf_token: str, session: dict):
         raise HTTPException(status_code=403, detail="CSRF token: "+csrf_token+" did not match the record.")
 
 def user_verify(user_token: str, session: dict):
-    print("### Debug: user_verify: ", user_token)
+    logger.debug("user_verify", extra={"user_token": user_token})
     if hmac.compare_digest(user_token, hash_email(session['email'])):
     # if user_token == hash_email(session["email"]):
         return user_token
     else:
         raise HTTPException(status_code=403, detail="USER token: "+user_token+" did not match the record.")
 
-def get_user_by_user_id(user_id: int, ds: Session):
-    user=ds.query(User).filter(User.id==user_id).first().__dict__
+async def get_user_by_user_id(user_id: int, ds: AsyncSession):
+    result = await ds.execute(select(User).where(User.id==user_id))
+    user=result.scalars().first()
     return user
 
 async def get_current_user(session_id: str = Depends(cookie_scheme),
-                           ds: Session = Depends(get_db), cs: CacheStore = Depends(get_cache_store)):
+                           ds: AsyncSession = Depends(get_async_db), cs: AsyncCacheStore = Depends(get_cache_store)):
     if not session_id:
         return None
 
-    session = cs.get_session(session_id)
+    session = await cs.get_session(session_id)
     if not session:
-        print("get_current_user: No session found for the session_id: ", session_id)
+        logger.debug("get_current_user: No session found", extra={"session_id": session_id})
         return None
         # raise HTTPException(status_code=403, detail="No session found for the session_id: "+session_id)
 
-    user_dict = get_user_by_user_id(session["user_id"], ds)
-    user=UserBase(**user_dict)
-    return user
+    user_id = int(session["user_id"])
+    with metrics.phase("user"):
+        user = user_cache.get(user_id)
+        if user:
+            return user
+
+        db_user = await get_user_by_user_id(user_id, ds)
+        if not db_user:
+            logger.info("get_current_user: No user found", extra={"user_id": user_id})
+            return None
+        user=UserBase.model_validate(db_user)
+        user_cache.set(user_id, user)
+        return user
 
 async def is_authenticated(session_id: str = Depends(cookie_scheme),
-                           ds: Session = Depends(get_db), cs: CacheStore = Depends(get_cache_store)):
+                           ds: AsyncSession = Depends(get_async_db), cs: AsyncCacheStore = Depends(get_cache_store)):
 
     user = await get_current_user(session_id=session_id, cs=cs, ds=ds)
 
@@ -125,7 +140,7 @@ async def is_authenticated(session_id: str = Depends(cookie_scheme),
             detail="Disabled user"
         )
     else:
-        print("Authenticated.")
+        logger.debug("Authenticated", extra={"user_id": user.id})
         return JSONResponse({"message": "Authenticated"})
 
 class RequiresLogin(Exception):
@@ -133,39 +148,37 @@ class RequiresLogin(Exception):
 
 async def is_authenticated_admin(
                                  session_id: Annotated[str | None, Cookie()] = None,
-                                 ds: Session = Depends(get_db),
-                                 cs: CacheStore = Depends(get_cache_store)
+                                 ds: AsyncSession = Depends(get_async_db),
+                                 cs: AsyncCacheStore = Depends(get_cache_store)
                                  ):
     user = await get_current_user(session_id=session_id, cs=cs, ds=ds)
     if not user:
         raise RequiresLogin("You must log in as Admin")
     if not user.disabled and user.admin:
-        print("Authenticated as Admin.")
+        logger.debug("Authenticated as Admin", extra={"user_id": user.id})
         return JSONResponse({"message": "Authenticated Admin"})
     raise RequiresLogin("You must log in as Admin")
 
 async def VerifyToken(jwt: str):
     try:
-        idinfo = id_token.verify_oauth2_token(
-            jwt,
-            requests.Request(),
-            settings.google_oauth2_client_id)
+        with metrics.phase("google"):
+            idinfo = await idtoken.verify_oauth2_token(jwt, settings.google_oauth2_client_id)
     except ValueError:
-        print("Error: Failed to validate JWT token with GOOGLE_OAUTH2_CLIENT_ID=" + settings.google_oauth2_client_id +".")
+        logger.warning("Failed to validate JWT token", extra={"client_id": settings.google_oauth2_client_id})
         return None
 
-    print("idinfo: ", idinfo)
+    logger.debug("Verified ID token", extra={"idinfo": idinfo})
     return idinfo
 
 @router.post("/login")
-async def login(request: Request, ds: Session = Depends(get_db), cs: CacheStore = Depends(get_cache_store)):
+async def login(request: Request, ds: AsyncSession = Depends(get_async_db), cs: AsyncCacheStore = Depends(get_cache_store)):
 
     body = await request.body()
     jwt = dict(urllib.parse.parse_qsl(body.decode('utf-8'))).get('credential')
 
     idinfo = await VerifyToken(jwt)
     if not idinfo:
-        print("Error: Failed to validate JWT token")
+        logger.warning("Login rejected: invalid JWT token")
         return  Response("Error: Failed to validate JWT token")
 
     expected_nonce = request.session.get('expected_nonce')
@@ -176,21 +189,22 @@ async def login(request: Request, ds: Session = Depends(get_db), cs: CacheStore
 
     user = await GetOrCreateUser(idinfo, ds)
     if not user:
-        print("Error: Failed to GetOrCreateUser")
+        logger.error("Login failed: GetOrCreateUser returned no user", extra={"email": idinfo.get("email")})
         return  Response("Error: Failed to GetOrCreateUser for the JWT")
 
     response = JSONResponse({"Authenticated_as": user.name})
-    session = cs.create_session(user.id, user.email)
+    session = await cs.create_session(user.id, user.email)
     new_cookie(response, session)
+    await get_event_bus().publish(browser_channel(request.session), {"type": "user_switched"})
 
     response.headers["HX-Trigger"] = "ReloadNavbar"
     return response
 
 @router.get("/logout")
-async def logout(response: Response,
+async def logout(request: Request, response: Response,
                  session_id: Annotated[str | None, Cookie()] = None,
                  hx_request: Annotated[str | None, Header()] = None,
-                 cs: CacheStore = Depends(get_cache_store)):
+                 cs: AsyncCacheStore = Depends(get_cache_store)):
 
     if not hx_request:
         raise HTTPException(
@@ -200,15 +214,16 @@ async def logout(response: Response,
 
     response = JSONResponse({"message": "user logged out"})
     response.headers["HX-Trigger"] = "ReloadNavbar, LogoutSecretContent"
-    cs.delete_session(session_id)
+    await cs.delete_session(session_id)
     delete_cookie(response)
+    await get_event_bus().publish(browser_channel(request.session), {"type": "logged_out", "reason": "logout"})
     return response
 
 @router.get("/auth_navbar", response_class=HTMLResponse)
 async def auth_navbar(request: Request,
                       session_id: Annotated[str|None, Cookie()] = None,
                       hx_request: Annotated[str|None, Header()] = None,
-                      ds: Session = Depends(get_db), cs: CacheStore = Depends(get_cache_store)
+                      ds: AsyncSession = Depends(get_async_db), cs: AsyncCacheStore = Depends(get_cache_store)
                       ):
 
     if not hx_request:
@@ -224,28 +239,27 @@ async def auth_navbar(request: Request,
         logout_url = "/auth/logout"
         icon_url = "/img/logout.png"
         refresh_token_url = "/auth/refresh_token"
-        mutate_user_url = "/auth/mutate_user"
+        events_url = "/auth/events"
 
         context = {"request": request, "logout_url":logout_url,
-                   "icon_url": icon_url, "refresh_token_url": refresh_token_url, "mutate_user_url": mutate_user_url,
+                   "icon_url": icon_url, "refresh_token_url": refresh_token_url, "events_url": events_url,
                    "name": user.name, "picture": user.picture, "userToken": hash_email(user.email)}
         return templates.TemplateResponse("auth_navbar.logout.j2", context)
 
-    print("User not logged-in.")
-    cs.cleanup_sessions()
+    logger.debug("User not logged-in")
 
     # For unauthenticated users, return the menu.login component.
     client_id = settings.google_oauth2_client_id
     login_url = "/auth/login"
     icon_url = "/img/icon.png"
     refresh_token_url = "/auth/refresh_token"
-    mutate_user_url = "/auth/mutate_user"
+    events_url = "/auth/events"
     nonce = base64.urlsafe_b64encode(hashlib.sha256(str(datetime.now()).encode()).digest()).decode()
 
     request.session['expected_nonce'] = nonce
 
     context = {"request": request, "client_id": client_id, "login_url": login_url,
-               "icon_url": icon_url, "refresh_token_url": refresh_token_url, "mutate_user_url": mutate_user_url,
+               "icon_url": icon_url, "refresh_token_url": refresh_token_url, "events_url": events_url,
                "userToken": "anonymous", "nonce": nonce}
     response = templates.TemplateResponse("auth_navbar.login.j2", context)
     return response
@@ -254,7 +268,7 @@ async def auth_navbar(request: Request,
 async def check(response: Response,
                 session_id: Annotated[str|None, Cookie()] = None,
                 hx_request: Annotated[str|None, Header()] = None,
-                ds: Session = Depends(get_db), cs: CacheStore = Depends(get_cache_store)):
+                ds: AsyncSession = Depends(get_async_db), cs: AsyncCacheStore = Depends(get_cache_store)):
 
     if not hx_request:
         raise HTTPException(
@@ -271,13 +285,26 @@ async def check(response: Response,
 
     return Response(status_code=status.HTTP_204_NO_CONTENT)
 
+@router.get("/events")
+async def events(request: Request,
+                 session_id: Annotated[str|None, Cookie()] = None,
+                 cs: AsyncCacheStore = Depends(get_cache_store),
+                 bus: EventBus = Depends(get_event_bus)):
+    # One lookup when the tab connects; after that the stream needs no cache store access.
+    session = await cs.get_session(session_id) if session_id else None
+    channels = [browser_channel(request.session)]
+    if session:
+        channels.append(user_channel(int(session["user_id"])))
+    return StreamingResponse(session_event_stream(bus, channels, session), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 @router.get("/refresh_token")
-async def refresh_token(response: Response,
+async def refresh_token(request: Request, response: Response,
                   hx_request: Annotated[str | None, Header()] = None,
                   session_id: Annotated[str | None, Cookie()] = None,
                   x_csrf_token: Annotated[str | None, Header()] = None,
                   x_user_token: Annotated[str | None, Header()] = None,
-                  cs: CacheStore = Depends(get_cache_store)):
+                  cs: AsyncCacheStore = Depends(get_cache_store)):
 
     if not hx_request:
         raise HTTPException(
@@ -287,18 +314,20 @@ async def refresh_token(response: Response,
     if not session_id:
         raise HTTPException(status_code=403, detail="No session_id in the request")
 
-    session = cs.get_session(session_id)
+    session = await cs.get_session(session_id)
     if not session:
-        print("refresh_token: No session found for the session_id: ", session_id)
+        logger.debug("refresh_token: No session found", extra={"session_id": session_id})
         raise HTTPException(status_code=403, detail="No session found for the session_id: "+session_id)
 
     try:
         csrf_verify(x_csrf_token, session)
         user_verify(x_user_token, session)
-        new_session = mutate_session(response, session, cs, False)
+        new_session = await mutate_session(response, session, cs, False)
         if new_session != session:
-            print("Session mutated, new_session: ", new_session)
+            logger.debug("Session mutated", extra={"new_session": new_session})
             response.headers["HX-Trigger"] = "ReloadNavbar"
+            await get_event_bus().publish(browser_channel(request.session),
+                                          {"type": "rotated", "expires": new_session["expires"]})
         return {"ok": True, "new_session_id": new_session["session_id"]}
     except HTTPException as e:
         response = JSONResponse(status_code=e.status_code, content={"detail": e.detail})
@@ -336,7 +365,7 @@ async def logout_content(request: Request,
 async def cleanup_sessions(
                          background_tasks: BackgroundTasks,
                          session_id: Annotated[str|None, Cookie()] = None,
-                         cs: CacheStore = Depends(get_cache_store)):
+                         cs: AsyncCacheStore = Depends(get_cache_store)):
     if not session_id:
         return {"message": "Session CleanUp not triggered. Please login first."}
 
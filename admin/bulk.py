@@ -0,0 +1,195 @@
+import csv, io, json
+from itertools import islice
+from typing import Dict, List, Literal
+from fastapi import APIRouter, Depends, UploadFile
+from starlette.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from sqlalchemy import select
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from data.db import User, Customer, AsyncSessionDATA, get_async_db
+from admin.user import user_cache, revoke_sessions
+from admin.cachestore import AsyncCacheStore, get_cache_store
+from config import settings
+
+# Bulk export and import of users and customers as NDJSON or CSV.
+#
+# Exports are streamed from a server-side cursor, bulk_export_chunk_size rows at
+# a time. Imports are read line by line from the uploaded file, which the
+# multipart parser spools to disk, and upserted on email in transactions of
+# bulk_import_batch_size rows. The file is read and parsed in the threadpool, a
+# batch at a time, so as not to block the event loop. Memory use does not depend
+# on the number of rows.
+#
+#   curl -b cookies 'https://.../crud/customers/export?format=csv' > customers.csv
+#   curl -b cookies -F file=@customers.csv 'https://.../crud/customers/import?format=csv'
+
+router = APIRouter()
+admin_router = APIRouter()
+
+# Exported columns. Imports may set any of them but id, which is left to the
+# database; columns missing from a row keep their current value.
+BULK_COLUMNS = {
+    User: ["id", "name", "email", "disabled", "admin", "picture"],
+    Customer: ["id", "name", "email"],
+}
+
+MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+# Rejected rows reported back by an import; the rest are only counted.
+MAX_REPORTED_ERRORS = 20
+
+BulkFormat = Literal["ndjson", "csv"]
+
+async def export_rows(model, fmt: str):
+    columns = BULK_COLUMNS[model]
+    query = (select(*(getattr(model, column) for column in columns)).order_by(model.id)
+             .execution_options(yield_per=settings.bulk_export_chunk_size))
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if fmt == "csv":
+        writer.writerow(columns)
+    # Opened here because the session from get_async_db is closed before a streaming response is sent.
+    async with AsyncSessionDATA() as db:
+        result = await db.stream(query)
+        async for rows in result.partitions():
+            if fmt == "csv":
+                writer.writerows(rows)
+            else:
+                buffer.writelines(json.dumps(row._asdict()) + "\n" for row in rows)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+def export_response(model, name: str, fmt: str) -> StreamingResponse:
+    return StreamingResponse(export_rows(model, fmt), media_type=MEDIA_TYPES[fmt],
+                             headers={"Content-Disposition": f'attachment; filename="{name}.{fmt}"'})
+
+# Yields (line number, row, error) for each record of the file.
+def parse_rows(file, fmt: str):
+    text = io.TextIOWrapper(file, encoding="utf-8-sig", newline="")
+    if fmt == "csv":
+        reader = csv.DictReader(text)
+        try:
+            for row in reader:
+                yield reader.line_num, row, None
+        except csv.Error as e:
+            yield reader.line_num, None, str(e)
+        return
+    for number, line in enumerate(text, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as e:
+            yield number, None, f"invalid JSON: {e}"
+            continue
+        if not isinstance(row, dict):
+            yield number, None, "not a JSON object"
+            continue
+        yield number, row, None
+
+def to_bool(value) -> bool:
+    if isinstance(value, bool):
+        return value
+    if str(value).strip().lower() in ("1", "true", "yes"):
+        return True
+    if str(value).strip().lower() in ("0", "false", "no", ""):
+        return False
+    raise ValueError(f"not a boolean: {value!r}")
+
+# The column values of one imported row, validated against the model.
+def import_values(model, row: Dict) -> Dict:
+    values = {}
+    for column in BULK_COLUMNS[model]:
+        if column == "id" or column not in row:
+            continue
+        value = row[column]
+        column_type = model.__table__.c[column].type
+        if column_type.python_type is bool:
+            value = to_bool(value)
+        elif value is not None:
+            value = str(value).strip()
+            if column_type.length and len(value) > column_type.length:
+                raise ValueError(f"{column} is longer than {column_type.length} characters")
+        values[column] = value
+    if "@" not in (values.get("email") or ""):
+        raise ValueError("email is missing or invalid")
+    return values
+
+async def upsert(db: AsyncSession, model, rows: List[Dict]):
+    stmt = insert(model).values(rows)
+    updates = {column: stmt.excluded[column] for column in rows[0] if column != "email"}
+    if updates:
+        stmt = stmt.on_conflict_do_update(index_elements=[model.email], set_=updates)
+    else:
+        stmt = stmt.on_conflict_do_nothing(index_elements=[model.email])
+    result = await db.execute(stmt.returning(model.id))
+    return result.scalars().all()
+
+# Upserts the rows of a batch in one transaction. Rows are grouped by the
+# columns they set, since a multi-row INSERT sets the same columns for all.
+async def import_batch(db: AsyncSession, model, batch: List[Dict], after_batch=None) -> int:
+    groups: Dict[tuple, List[Dict]] = {}
+    for values in batch:
+        groups.setdefault(tuple(values), []).append(values)
+    upserted = 0
+    for columns, rows in groups.items():
+        ids = await upsert(db, model, rows)
+        upserted += len(ids)
+        if after_batch is not None:
+            await after_batch(columns, ids)
+    await db.commit()
+    return upserted
+
+async def import_rows(db: AsyncSession, model, file: UploadFile, fmt: str, after_batch=None) -> Dict:
+    report = {"upserted": 0, "rejected": 0, "errors": []}
+    batch: List[Dict] = []
+    records = parse_rows(file.file, fmt)
+    while parsed := await run_in_threadpool(lambda: list(islice(records, settings.bulk_import_batch_size))):
+        for line, row, error in parsed:
+            if error is None:
+                try:
+                    batch.append(import_values(model, row))
+                except ValueError as e:
+                    error = str(e)
+            if error is not None:
+                report["rejected"] += 1
+                if len(report["errors"]) < MAX_REPORTED_ERRORS:
+                    report["errors"].append({"line": line, "error": error})
+                continue
+            if len(batch) >= settings.bulk_import_batch_size:
+                report["upserted"] += await import_batch(db, model, batch, after_batch)
+                batch = []
+    if batch:
+        report["upserted"] += await import_batch(db, model, batch, after_batch)
+    return report
+
+@router.get("/users/export")
+async def export_users(format: BulkFormat = "ndjson"):
+    return export_response(User, "users", format)
+
+@router.get("/customers/export")
+async def export_customers(format: BulkFormat = "ndjson"):
+    return export_response(Customer, "customers", format)
+
+@admin_router.post("/users/import")
+async def import_users(file: UploadFile, format: BulkFormat = "ndjson",
+                       db_session: AsyncSession = Depends(get_async_db),
+                       cs: AsyncCacheStore = Depends(get_cache_store)):
+    # Like set_user_disabled: drop cached users, and log out the ones disabled by the import.
+    async def after_batch(columns: tuple, user_ids: List[int]):
+        for user_id in user_ids:
+            user_cache.invalidate(user_id)
+        if "disabled" in columns:
+            result = await db_session.execute(select(User.id).where(User.id.in_(user_ids), User.disabled))
+            for user_id in result.scalars():
+                await revoke_sessions(cs, user_id)
+    return await import_rows(db_session, User, file, format, after_batch)
+
+@admin_router.post("/customers/import")
+async def import_customers(file: UploadFile, format: BulkFormat = "ndjson",
+                           db_session: AsyncSession = Depends(get_async_db)):
+    return await import_rows(db_session, Customer, file, format)
@@ -1,21 +1,36 @@
-import secrets, json
+import secrets, time, asyncio, logging
+from collections import Counter
 import redis
+import redis.asyncio
 from typing import Optional, Dict, List
 from datetime import datetime, timezone, timedelta
 from abc import ABC, abstractmethod
 from fastapi import HTTPException, status
+from sqlalchemy import select, delete, case, func
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import async_sessionmaker
 from sqlalchemy.exc import SQLAlchemyError, NoResultFound
 
-from data.db import Sessions, get_cache
+from data.db import Sessions, SessionRotation, CACHE_STORE_URI, ASYNC_CACHE_STORE_URI
+from data.db import create_sqlite_engine, create_async_sqlite_engine
+from admin.ttlcache import TTLCache
+from admin.sessionformat import SessionFormat, get_session_format, other_session_format
+from admin.sessiontoken import SessionTokenSigner, is_token
+from admin.metrics import TimedCacheStore
 from config import settings
 
+logger = logging.getLogger(__name__)
+
 class CacheStore(ABC):
 
     @abstractmethod
     def get_session(self, session_id: str) -> Optional[Dict]:
         pass
 
-    def list_sessions(self) -> List[Dict]:
+    def list_sessions(self, cursor: Optional[int] = None, count: int = 100) -> Dict:
+        pass
+
+    def session_stats(self, top: int = 20) -> Dict:
         pass
 
     @abstractmethod
@@ -26,94 +41,376 @@ class CacheStore(ABC):
     def delete_session(self, session_id: str) -> None:
         pass
 
+    @abstractmethod
+    def rotate_session(self, session_id: str) -> Optional[Dict]:
+        pass
+
     @abstractmethod
     def cleanup_sessions(self) -> None:
         pass
 
+    def revoke_user_sessions(self, user_id: int) -> List[str]:
+        pass
+
+    def reap_expired(self, batch_size: int) -> int:
+        return 0
+
+    def pool_stats(self) -> Dict:
+        return {}
+
+    def close(self) -> None:
+        pass
+
+CLEANUP_BATCH_SIZE = 1000
+
+# DELETE ... WHERE expires <= now LIMIT n, written as a subquery because
+# SQLite only supports DELETE ... LIMIT when built with a compile option.
+def expired_sessions_delete(batch_size: int):
+    now = int(datetime.now().timestamp())
+    expired = select(Sessions.id).where(Sessions.expires <= now).limit(batch_size)
+    return delete(Sessions).where(Sessions.id.in_(expired)).execution_options(synchronize_session=False)
+
+def rotation_expires() -> int:
+    return int(time.time()) + settings.session_rotation_grace
+
+def session_expires() -> int:
+    return int((datetime.now(timezone.utc) + timedelta(seconds=settings.session_max_age)).timestamp())
+
+# Deleting the old session claims the rotation: when two requests rotate the
+# same session at once, only one of them gets a row back. The other one finds
+# the successor through session_rotations instead.
+def session_claim(session_id: str):
+    return (delete(Sessions).where(Sessions.session_id == session_id)
+            .returning(Sessions.user_id, Sessions.email).execution_options(synchronize_session=False))
+
+def session_successor_query(session_id: str):
+    return (select(Sessions).join(SessionRotation, SessionRotation.new_session_id == Sessions.session_id)
+            .where(SessionRotation.old_session_id == session_id, SessionRotation.expires > int(time.time())))
+
+def rotated_session_entries(session_id: str, user_id: int, email: str):
+    session_entry = Sessions(session_id=secrets.token_urlsafe(64), csrf_token=secrets.token_urlsafe(32),
+                             user_id=user_id, email=email, expires=session_expires())
+    rotation = SessionRotation(old_session_id=session_id, new_session_id=session_entry.session_id,
+                               expires=rotation_expires())
+    return session_entry, rotation
+
+def expired_rotations_delete():
+    return delete(SessionRotation).where(SessionRotation.expires <= int(time.time()))
+
+# Rotates a session in one round trip. A rotated:<old_id> pointer to the
+# successor is kept for the grace period, so a concurrent refresh with the
+# same old cookie returns the same new session instead of creating another.
+# Sessions in either layout of admin/sessionformat.py are read, and the new
+# one is written in the configured layout.
+# KEYS: session:<old_id>, rotated:<old_id>
+# ARGV: old_id, new_id, csrf_token, expires, ttl, grace, format
+ROTATE_SESSION_SCRIPT = """
+local function load(key)
+    local kind = redis.call('TYPE', key)['ok']
+    if kind == 'string' then
+        return cjson.decode(redis.call('GET', key))
+    elseif kind == 'hash' then
+        local fields = redis.call('HGETALL', key)
+        local raw = {}
+        for i = 1, #fields, 2 do
+            raw[fields[i]] = fields[i + 1]
+        end
+        return {csrf_token = raw['c'], user_id = tonumber(raw['u']), email = raw['e'], expires = tonumber(raw['x'])}
+    end
+end
+
+local function reply(session_id, session)
+    return {session_id, session['csrf_token'], tostring(session['user_id']), session['email'], tostring(session['expires'])}
+end
+
+local successor = redis.call('GET', KEYS[2])
+if successor then
+    local session = load('session:' .. successor)
+    if not session then
+        return false
+    end
+    return reply(successor, session)
+end
+local session = load(KEYS[1])
+if not session then
+    return false
+end
+session['session_id'] = ARGV[2]
+session['csrf_token'] = ARGV[3]
+session['expires'] = tonumber(ARGV[4])
+local key = 'session:' .. ARGV[2]
+if ARGV[7] == 'hash' then
+    redis.call('HSET', key, 'c', session['csrf_token'], 'u', session['user_id'], 'e', session['email'], 'x', session['expires'])
+    redis.call('EXPIRE', key, ARGV[5])
+else
+    redis.call('SETEX', key, ARGV[5], cjson.encode(session))
+end
+local user_sessions = 'user_sessions:' .. session['user_id']
+redis.call('DEL', KEYS[1])
+redis.call('SETEX', KEYS[2], ARGV[6], ARGV[2])
+redis.call('SREM', user_sessions, ARGV[1])
+redis.call('SADD', user_sessions, ARGV[2])
+redis.call('EXPIRE', user_sessions, ARGV[5])
+return reply(ARGV[2], session)
+"""
+
+def rotate_session_args(session_id: str, session_format: SessionFormat):
+    keys = [f"session:{session_id}", f"rotated:{session_id}"]
+    args = [session_id, secrets.token_urlsafe(64), secrets.token_urlsafe(32), session_expires(),
+            settings.session_max_age, settings.session_rotation_grace, session_format.name]
+    return keys, args
+
+def rotated_session(reply) -> Optional[Dict]:
+    if not reply:
+        return None
+    session_id, csrf_token, user_id, email, expires = reply
+    return {"session_id": session_id, "csrf_token": csrf_token, "user_id": int(user_id),
+            "email": email, "expires": int(expires)}
+
+STATS_SCAN_COUNT = 1000
+EXPIRY_BUCKETS = [60, 300, 900, 3600, 86400]
+
+def expiry_bucket(age_left: Optional[int]) -> str:
+    if age_left is None:
+        return "no_expiry"
+    if age_left <= 0:
+        return "expired"
+    for limit in EXPIRY_BUCKETS:
+        if age_left <= limit:
+            return f"<={limit}s"
+    return f">{EXPIRY_BUCKETS[-1]}s"
+
+# Aggregate counts over all sessions, built either one session at a time
+# (Redis, scanned in batches) or from GROUP BY results (SQL).
+class SessionStats:
+    def __init__(self):
+        self.now = int(time.time())
+        self.total = 0
+        self.admin = 0
+        self.by_user = Counter()
+        self.by_expiry = Counter()
+
+    def add(self, session: Dict) -> None:
+        expires = session.get("expires")
+        self.total += 1
+        self.by_user[int(session["user_id"])] += 1
+        self.by_expiry[expiry_bucket(expires - self.now if expires is not None else None)] += 1
+        if session.get("email") == settings.admin_email:
+            self.admin += 1
+
+    def add_counts(self, by_user, by_expiry, admin) -> None:
+        for user_id, n in by_user:
+            self.by_user[user_id] += n
+            self.total += n
+        for age_left, n in by_expiry:
+            self.by_expiry[expiry_bucket(age_left)] += n
+        self.admin += admin[0][0]
+
+    def result(self, top: int) -> Dict:
+        return {
+            "total": self.total,
+            "users": len(self.by_user),
+            "admin_sessions": self.admin,
+            "top_users": [{"user_id": u, "sessions": n} for u, n in self.by_user.most_common(top)],
+            "expiry_histogram": dict(self.by_expiry),
+        }
+
+def sessions_page_query(cursor: Optional[int], count: int):
+    # Keyset pagination on the primary key.
+    query = select(Sessions.__table__).order_by(Sessions.id).limit(count)
+    if cursor:
+        query = query.where(Sessions.id > cursor)
+    return query
+
+def sessions_page(rows, count: int) -> Dict:
+    sessions = [dict(row._mapping) for row in rows]
+    next_cursor = sessions[-1]["id"] if len(sessions) == count else None
+    return {"sessions": sessions, "next_cursor": next_cursor}
+
+def sessions_stats_queries():
+    now = int(time.time())
+    # Group by the upper bound of each bucket, which expiry_bucket() maps back to its label.
+    age_left = Sessions.expires - now
+    bucket = case(*[(age_left <= limit, limit) for limit in [0] + EXPIRY_BUCKETS], else_=EXPIRY_BUCKETS[-1] + 1)
+    bucket = case((Sessions.expires.is_(None), None), else_=bucket).label("bucket")
+    return [
+        select(Sessions.user_id, func.count()).group_by(Sessions.user_id),
+        select(bucket, func.count()).group_by(bucket),
+        select(func.count()).where(Sessions.email == settings.admin_email),
+    ]
+
+# Uses the index on sessions.user_id; RETURNING needs SQLite 3.35 or later.
+def user_sessions_delete(user_id: int):
+    return (delete(Sessions).where(Sessions.user_id == user_id)
+            .returning(Sessions.session_id).execution_options(synchronize_session=False))
+
 class SQLCacheStore(CacheStore):
-    def __init__(self, db_session):
-        self.cs = db_session
+    def __init__(self, session_factory=None):
+        if session_factory is None:
+            session_factory = sessionmaker(autocommit=False, autoflush=False, bind=create_cache_engine())
+        self.Session = session_factory
+        self.engine = session_factory.kw["bind"]
 
     def get_session(self, session_id: str) -> Optional[Dict]:
+        with self.Session() as cs:
+            return self._get_session(cs, session_id)
+
+    def _get_session(self, cs, session_id: str) -> Optional[Dict]:
         try:
-            session_data = self.cs.query(Sessions).filter(Sessions.session_id == session_id).one()
+            session_data = cs.query(Sessions).filter(Sessions.session_id == session_id).one()
         except NoResultFound:
             return None
         except SQLAlchemyError as e:
-            print(f"An error occurred while retrieving the session: {e}")
+            logger.error("An error occurred while retrieving the session", exc_info=e)
             raise RuntimeError(f"An error occurred while retrieving the session: {e}")
 
         if session_data:
             session = session_data.__dict__
-            print("session: ", session)
-            print("session_id: ", session["session_id"])
+            logger.debug("Session loaded", extra={"session": session})
             return session
         else:
             return None
 
-    def list_sessions(self) -> List[Dict]:
-        sessions = self.cs.query(Sessions).offset(0).limit(100).all()
-        return [session.__dict__ for session in sessions]
+    def list_sessions(self, cursor: Optional[int] = None, count: int = 100) -> Dict:
+        with self.Session() as cs:
+            rows = cs.execute(sessions_page_query(cursor, count)).all()
+            return sessions_page(rows, count)
+
+    def session_stats(self, top: int = 20) -> Dict:
+        with self.Session() as cs:
+            stats = SessionStats()
+            stats.add_counts(*(cs.execute(q).all() for q in sessions_stats_queries()))
+            return stats.result(top)
 
     def create_session(self, user_id: int, email: str) -> Dict:
         session_id = secrets.token_urlsafe(64)
         csrf_token = secrets.token_urlsafe(32)
 
-        session = self.get_session(session_id)
-        if session:
-            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Duplicate session_id")
+        with self.Session() as cs:
+            session = self._get_session(cs, session_id)
+            if session:
+                raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Duplicate session_id")
 
-        expires = int((datetime.now(timezone.utc) 
-                       + timedelta(seconds=settings.session_max_age)).timestamp())
+            expires = int((datetime.now(timezone.utc) 
+                           + timedelta(seconds=settings.session_max_age)).timestamp())
 
-        session_entry = Sessions(session_id=session_id, csrf_token=csrf_token,
-                                 user_id=user_id, email=email, expires=expires)
-        self.cs.add(session_entry)
-        self.cs.commit()
-        self.cs.refresh(session_entry)
-        return session_entry.__dict__
+            session_entry = Sessions(session_id=session_id, csrf_token=csrf_token,
+                                     user_id=user_id, email=email, expires=expires)
+            cs.add(session_entry)
+            cs.commit()
+            cs.refresh(session_entry)
+            return session_entry.__dict__
 
     def delete_session(self, session_id: str) -> None:
-        session = self.cs.query(Sessions).filter(Sessions.session_id == session_id).first()
-        # session is not dict
-        if session.email == settings.admin_email:
-            return
-        if session:
-            self.cs.delete(session)
-            self.cs.commit()
+        with self.Session() as cs:
+            session = cs.query(Sessions).filter(Sessions.session_id == session_id).first()
+            # session is not dict
+            if not session or session.email == settings.admin_email:
+                return
+            cs.delete(session)
+            cs.commit()
+
+    def rotate_session(self, session_id: str) -> Optional[Dict]:
+        with self.Session() as cs:
+            claimed = cs.execute(session_claim(session_id)).first()
+            if claimed is None:
+                successor = cs.execute(session_successor_query(session_id)).scalars().first()
+                return successor.__dict__ if successor else None
+
+            session_entry, rotation = rotated_session_entries(session_id, claimed.user_id, claimed.email)
+            cs.add_all([session_entry, rotation])
+            cs.commit()
+            cs.refresh(session_entry)
+            return session_entry.__dict__
 
     def cleanup_sessions(self) -> None:
-        now = int(datetime.now().timestamp())
-        expired_sessions = self.cs.query(Sessions).filter(Sessions.expires <= now).all()
-        for session in expired_sessions:
-            print("Cleaning up expired session: ", session.session_id)
-            self.cs.delete(session)
-        self.cs.commit()
-        
+        while self.reap_expired(CLEANUP_BATCH_SIZE) == CLEANUP_BATCH_SIZE:
+            pass
+
+    def reap_expired(self, batch_size: int) -> int:
+        with self.Session() as cs:
+            result = cs.execute(expired_sessions_delete(batch_size))
+            cs.execute(expired_rotations_delete())
+            cs.commit()
+            return result.rowcount
+
+    def revoke_user_sessions(self, user_id: int) -> List[str]:
+        with self.Session() as cs:
+            result = cs.execute(user_sessions_delete(user_id))
+            revoked = result.scalars().all()
+            cs.commit()
+            return revoked
+
+    def pool_stats(self) -> Dict:
+        return sql_pool_stats(self.engine.pool)
+
+    def close(self) -> None:
+        self.engine.dispose()
+
 class RedisCacheStore(CacheStore):
 
-    def __init__(self):
-        self.redis_client = redis.Redis(
-            host=settings.redis_host,
-            port=settings.redis_port,
-            db=0,
-            decode_responses=True)
+    def __init__(self, connection_pool: Optional[redis.ConnectionPool] = None,
+                 session_format: Optional[SessionFormat] = None):
+        if connection_pool is None:
+            connection_pool = create_redis_pool()
+        self.pool = connection_pool
+        self.redis_client = redis.Redis(connection_pool=connection_pool)
+        self.rotate_script = self.redis_client.register_script(ROTATE_SESSION_SCRIPT)
+        self.format = session_format or get_session_format()
+        self.legacy_format = other_session_format(self.format)
 
     def get_session(self, session_id: str) -> Optional[dict]:
-        session_data = self.redis_client.get(f"session:{session_id}")
-        session = json.loads(session_data) if session_data else None
+        session = self._load(session_id)
         if session:
-            print("session: ", session)
-            print("session_id: ", session["session_id"])
+            logger.debug("Session loaded", extra={"session": session})
         return session
 
-    def list_sessions(self) -> List[Dict]:
+    def _load(self, session_id: str) -> Optional[Dict]:
+        key = f"session:{session_id}"
+        try:
+            return self.format.loads(session_id, self.format.read(self.redis_client, key))
+        except redis.ResponseError:
+            # WRONGTYPE: written in the other format before REDIS_SESSION_FORMAT was changed.
+            return self.legacy_format.loads(session_id, self.legacy_format.read(self.redis_client, key))
+
+    def _scan_page(self, cursor: int, count: int):
+        cursor, keys = self.redis_client.scan(cursor=cursor, match="session:*", count=count)
+        if not keys:
+            return cursor, []
+        # One pipelined read per key rather than MGET, which cannot read the hash format.
+        pipe = self.redis_client.pipeline(transaction=False)
+        for key in keys:
+            self.format.read(pipe, key)
+        values = pipe.execute(raise_on_error=False)
         sessions = []
-        for key in self.redis_client.scan_iter(match="session:*"):
-            session_data = self.redis_client.get(key)
-            session = json.loads(session_data)
-            sessions.append(session)
-        return sessions
+        for key, raw in zip(keys, values):
+            session_id = key[len("session:"):]
+            if isinstance(raw, redis.ResponseError):
+                session = self._load(session_id)
+            else:
+                session = self.format.loads(session_id, raw)
+            if session:
+                sessions.append(session)
+        return cursor, sessions
+
+    def list_sessions(self, cursor: Optional[int] = None, count: int = 100) -> Dict:
+        # SCAN's count is only a hint, so keep scanning until the page is full or the scan is done.
+        cursor, sessions = cursor or 0, []
+        while True:
+            cursor, page = self._scan_page(cursor, count - len(sessions))
+            sessions.extend(page)
+            if cursor == 0 or len(sessions) >= count:
+                break
+        return {"sessions": sessions, "next_cursor": cursor or None}
+
+    def session_stats(self, top: int = 20) -> Dict:
+        stats, cursor = SessionStats(), 0
+        while True:
+            cursor, page = self._scan_page(cursor, STATS_SCAN_COUNT)
+            for session in page:
+                stats.add(session)
+            if cursor == 0:
+                return stats.result(top)
 
     def create_session(self, user_id: int, email: str) -> Dict:
         session_id = secrets.token_urlsafe(64)
@@ -126,24 +423,710 @@ class RedisCacheStore(CacheStore):
             "email": email,
             "expires": int((datetime.now(timezone.utc) + timedelta(seconds=expires)).timestamp())
         }
-        self.redis_client.setex(f"session:{session_id}", expires, json.dumps(session_data))
+        pipe = self.redis_client.pipeline(transaction=True)
+        self.format.write(pipe, f"session:{session_id}", session_data, expires)
+        pipe.sadd(f"user_sessions:{user_id}", session_id)
+        pipe.expire(f"user_sessions:{user_id}", expires)
+        pipe.execute()
         return session_data
 
     def delete_session(self, session_id: str) -> None:
         session = self.get_session(session_id)
         # session is dict
-        if session["email"] == settings.admin_email:
+        if not session or session["email"] == settings.admin_email:
             return
-        self.redis_client.delete(f"session:{session_id}")
+        pipe = self.redis_client.pipeline(transaction=True)
+        pipe.delete(f"session:{session_id}")
+        pipe.srem(f"user_sessions:{session['user_id']}", session_id)
+        pipe.execute()
+
+    def rotate_session(self, session_id: str) -> Optional[Dict]:
+        keys, args = rotate_session_args(session_id, self.format)
+        return rotated_session(self.rotate_script(keys=keys, args=args))
+
+    def revoke_user_sessions(self, user_id: int) -> List[str]:
+        session_ids = list(self.redis_client.smembers(f"user_sessions:{user_id}"))
+        pipe = self.redis_client.pipeline(transaction=True)
+        for session_id in session_ids:
+            pipe.delete(f"session:{session_id}")
+        pipe.delete(f"user_sessions:{user_id}")
+        pipe.execute()
+        return session_ids
 
     def cleanup_sessions(self) -> None:
         # Redis handles session expiration automatically based on the TTL set during creation.
         pass
 
-def get_cache_store() -> CacheStore:
+    def pool_stats(self) -> Dict:
+        return redis_pool_stats(self.pool)
+
+    def close(self) -> None:
+        self.pool.disconnect()
+
+# Async variants used by the request handlers, so that a session lookup
+# does not block the event loop while waiting on Redis or SQLite.
+
+class AsyncCacheStore(ABC):
+
+    @abstractmethod
+    async def get_session(self, session_id: str) -> Optional[Dict]:
+        pass
+
+    async def list_sessions(self, cursor: Optional[int] = None, count: int = 100) -> Dict:
+        pass
+
+    async def session_stats(self, top: int = 20) -> Dict:
+        pass
+
+    @abstractmethod
+    async def create_session(self, user_id: int, email: str) -> Dict:
+        pass
+
+    @abstractmethod
+    async def delete_session(self, session_id: str) -> None:
+        pass
+
+    @abstractmethod
+    async def rotate_session(self, session_id: str) -> Optional[Dict]:
+        pass
+
+    @abstractmethod
+    async def cleanup_sessions(self) -> None:
+        pass
+
+    async def revoke_user_sessions(self, user_id: int) -> List[str]:
+        pass
+
+    async def reap_expired(self, batch_size: int) -> int:
+        return 0
+
+    def pool_stats(self) -> Dict:
+        return {}
+
+    def cache_stats(self) -> Dict:
+        return {}
+
+    async def start(self) -> None:
+        pass
+
+    async def close(self) -> None:
+        pass
+
+class AsyncSQLCacheStore(AsyncCacheStore):
+    def __init__(self, session_factory=None):
+        if session_factory is None:
+            session_factory = async_sessionmaker(autoflush=False, expire_on_commit=False,
+                                                 bind=create_async_cache_engine())
+        self.Session = session_factory
+        self.engine = session_factory.kw["bind"]
+
+    async def get_session(self, session_id: str) -> Optional[Dict]:
+        async with self.Session() as cs:
+            return await self._get_session(cs, session_id)
+
+    async def _get_session(self, cs, session_id: str) -> Optional[Dict]:
+        try:
+            result = await cs.execute(select(Sessions).where(Sessions.session_id == session_id))
+            session_data = result.scalar_one()
+        except NoResultFound:
+            return None
+        except SQLAlchemyError as e:
+            logger.error("An error occurred while retrieving the session", exc_info=e)
+            raise RuntimeError(f"An error occurred while retrieving the session: {e}")
+
+        session = session_data.__dict__
+        logger.debug("Session loaded", extra={"session": session})
+        return session
+
+    async def list_sessions(self, cursor: Optional[int] = None, count: int = 100) -> Dict:
+        async with self.Session() as cs:
+            result = await cs.execute(sessions_page_query(cursor, count))
+            return sessions_page(result.all(), count)
+
+    async def session_stats(self, top: int = 20) -> Dict:
+        async with self.Session() as cs:
+            stats = SessionStats()
+            stats.add_counts(*[(await cs.execute(q)).all() for q in sessions_stats_queries()])
+            return stats.result(top)
+
+    async def create_session(self, user_id: int, email: str) -> Dict:
+        session_id = secrets.token_urlsafe(64)
+        csrf_token = secrets.token_urlsafe(32)
+
+        async with self.Session() as cs:
+            session = await self._get_session(cs, session_id)
+            if session:
+                raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Duplicate session_id")
+
+            expires = int((datetime.now(timezone.utc)
+                           + timedelta(seconds=settings.session_max_age)).timestamp())
+
+            session_entry = Sessions(session_id=session_id, csrf_token=csrf_token,
+                                     user_id=user_id, email=email, expires=expires)
+            cs.add(session_entry)
+            await cs.commit()
+            await cs.refresh(session_entry)
+            return session_entry.__dict__
+
+    async def delete_session(self, session_id: str) -> None:
+        async with self.Session() as cs:
+            result = await cs.execute(select(Sessions).where(Sessions.session_id == session_id))
+            session = result.scalars().first()
+            # session is not dict
+            if not session or session.email == settings.admin_email:
+                return
+            await cs.delete(session)
+            await cs.commit()
+
+    async def rotate_session(self, session_id: str) -> Optional[Dict]:
+        async with self.Session() as cs:
+            claimed = (await cs.execute(session_claim(session_id))).first()
+            if claimed is None:
+                successor = (await cs.execute(session_successor_query(session_id))).scalars().first()
+                return successor.__dict__ if successor else None
+
+            session_entry, rotation = rotated_session_entries(session_id, claimed.user_id, claimed.email)
+            cs.add_all([session_entry, rotation])
+            await cs.commit()
+            await cs.refresh(session_entry)
+            return session_entry.__dict__
+
+    async def cleanup_sessions(self) -> None:
+        while await self.reap_expired(CLEANUP_BATCH_SIZE) == CLEANUP_BATCH_SIZE:
+            pass
+
+    async def reap_expired(self, batch_size: int) -> int:
+        async with self.Session() as cs:
+            result = await cs.execute(expired_sessions_delete(batch_size))
+            await cs.execute(expired_rotations_delete())
+            await cs.commit()
+            return result.rowcount
+
+    async def revoke_user_sessions(self, user_id: int) -> List[str]:
+        async with self.Session() as cs:
+            result = await cs.execute(user_sessions_delete(user_id))
+            revoked = result.scalars().all()
+            await cs.commit()
+            return revoked
+
+    def pool_stats(self) -> Dict:
+        return sql_pool_stats(self.engine.pool)
+
+    async def close(self) -> None:
+        await self.engine.dispose()
+
+class AsyncRedisCacheStore(AsyncCacheStore):
+
+    def __init__(self, connection_pool: Optional[redis.asyncio.ConnectionPool] = None,
+                 session_format: Optional[SessionFormat] = None):
+        if connection_pool is None:
+            connection_pool = create_async_redis_pool()
+        self.pool = connection_pool
+        self.redis_client = redis.asyncio.Redis(connection_pool=connection_pool)
+        self.rotate_script = self.redis_client.register_script(ROTATE_SESSION_SCRIPT)
+        self.format = session_format or get_session_format()
+        self.legacy_format = other_session_format(self.format)
+
+    async def get_session(self, session_id: str) -> Optional[dict]:
+        session = await self._load(session_id)
+        if session:
+            logger.debug("Session loaded", extra={"session": session})
+        return session
+
+    async def _load(self, session_id: str) -> Optional[Dict]:
+        key = f"session:{session_id}"
+        try:
+            return self.format.loads(session_id, await self.format.read(self.redis_client, key))
+        except redis.ResponseError:
+            # WRONGTYPE: written in the other format before REDIS_SESSION_FORMAT was changed.
+            return self.legacy_format.loads(session_id, await self.legacy_format.read(self.redis_client, key))
+
+    async def _scan_page(self, cursor: int, count: int):
+        cursor, keys = await self.redis_client.scan(cursor=cursor, match="session:*", count=count)
+        if not keys:
+            return cursor, []
+        # One pipelined read per key rather than MGET, which cannot read the hash format.
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            for key in keys:
+                self.format.read(pipe, key)
+            values = await pipe.execute(raise_on_error=False)
+        sessions = []
+        for key, raw in zip(keys, values):
+            session_id = key[len("session:"):]
+            if isinstance(raw, redis.ResponseError):
+                session = await self._load(session_id)
+            else:
+                session = self.format.loads(session_id, raw)
+            if session:
+                sessions.append(session)
+        return cursor, sessions
+
+    async def list_sessions(self, cursor: Optional[int] = None, count: int = 100) -> Dict:
+        # SCAN's count is only a hint, so keep scanning until the page is full or the scan is done.
+        cursor, sessions = cursor or 0, []
+        while True:
+            cursor, page = await self._scan_page(cursor, count - len(sessions))
+            sessions.extend(page)
+            if cursor == 0 or len(sessions) >= count:
+                break
+        return {"sessions": sessions, "next_cursor": cursor or None}
+
+    async def session_stats(self, top: int = 20) -> Dict:
+        stats, cursor = SessionStats(), 0
+        while True:
+            cursor, page = await self._scan_page(cursor, STATS_SCAN_COUNT)
+            for session in page:
+                stats.add(session)
+            if cursor == 0:
+                return stats.result(top)
+
+    async def create_session(self, user_id: int, email: str) -> Dict:
+        session_id = secrets.token_urlsafe(64)
+        csrf_token = secrets.token_urlsafe(32)
+        expires = settings.session_max_age
+        session_data = {
+            "session_id": session_id,
+            "csrf_token": csrf_token,
+            "user_id": user_id,
+            "email": email,
+            "expires": int((datetime.now(timezone.utc) + timedelta(seconds=expires)).timestamp())
+        }
+        # The user_sessions set is the per-user index used by revoke_user_sessions.
+        # Its ttl is refreshed on every login, so it outlives all of the user's sessions.
+        async with self.redis_client.pipeline(transaction=True) as pipe:
+            self.format.write(pipe, f"session:{session_id}", session_data, expires)
+            pipe.sadd(f"user_sessions:{user_id}", session_id)
+            pipe.expire(f"user_sessions:{user_id}", expires)
+            await pipe.execute()
+        return session_data
+
+    async def delete_session(self, session_id: str) -> None:
+        session = await self.get_session(session_id)
+        # session is dict
+        if not session or session["email"] == settings.admin_email:
+            return
+        async with self.redis_client.pipeline(transaction=True) as pipe:
+            pipe.delete(f"session:{session_id}")
+            pipe.srem(f"user_sessions:{session['user_id']}", session_id)
+            await pipe.execute()
+
+    async def rotate_session(self, session_id: str) -> Optional[Dict]:
+        keys, args = rotate_session_args(session_id, self.format)
+        return rotated_session(await self.rotate_script(keys=keys, args=args))
+
+    async def revoke_user_sessions(self, user_id: int) -> List[str]:
+        session_ids = list(await self.redis_client.smembers(f"user_sessions:{user_id}"))
+        async with self.redis_client.pipeline(transaction=True) as pipe:
+            for session_id in session_ids:
+                pipe.delete(f"session:{session_id}")
+            pipe.delete(f"user_sessions:{user_id}")
+            await pipe.execute()
+        return session_ids
+
+    async def cleanup_sessions(self) -> None:
+        # Redis handles session expiration automatically based on the TTL set during creation.
+        pass
+
+    def pool_stats(self) -> Dict:
+        return redis_pool_stats(self.pool)
+
+    async def close(self) -> None:
+        await self.redis_client.aclose()
+        await self.pool.disconnect()
+
+INVALIDATION_CHANNEL = "cachestore:invalidate"
+
+# Keeps recently read sessions in a per-worker LRU in front of the Redis store.
+# Every worker subscribes to INVALIDATION_CHANNEL, and deleting or rotating a
+# session publishes its id there, so logout takes effect on all workers as soon
+# as the message arrives and at the latest after the local ttl.
+class TieredCacheStore(AsyncCacheStore):
+
+    def __init__(self, remote: AsyncRedisCacheStore, maxsize: int, ttl: float):
+        self.remote = remote
+        self.local = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.remote_hits = 0
+        self.remote_misses = 0
+        self.invalidations_published = 0
+        self.invalidations_received = 0
+        self._listener: Optional[asyncio.Task] = None
+
+    async def get_session(self, session_id: str) -> Optional[Dict]:
+        session = self.local.get(session_id)
+        if session:
+            return session
+
+        session = await self.remote.get_session(session_id)
+        if not session:
+            self.remote_misses += 1
+            return None
+        self.remote_hits += 1
+        # Never keep a session locally past its own expiry. Sessions written without
+        # one, like the admin session of create_data.sh, get the plain local ttl.
+        expires = session.get("expires")
+        if expires is None:
+            self.local.set(session_id, session)
+            return session
+        age_left = int(expires) - int(time.time())
+        if age_left > 0:
+            self.local.set(session_id, session, min(self.local.ttl, age_left))
+        return session
+
+    async def list_sessions(self, cursor: Optional[int] = None, count: int = 100) -> Dict:
+        return await self.remote.list_sessions(cursor, count)
+
+    async def session_stats(self, top: int = 20) -> Dict:
+        return await self.remote.session_stats(top)
+
+    async def create_session(self, user_id: int, email: str) -> Dict:
+        return await self.remote.create_session(user_id, email)
+
+    async def delete_session(self, session_id: str) -> None:
+        await self.remote.delete_session(session_id)
+        await self.invalidate(session_id)
+
+    async def rotate_session(self, session_id: str) -> Optional[Dict]:
+        session = await self.remote.rotate_session(session_id)
+        await self.invalidate(session_id)
+        return session
+
+    async def cleanup_sessions(self) -> None:
+        await self.remote.cleanup_sessions()
+
+    async def revoke_user_sessions(self, user_id: int) -> List[str]:
+        session_ids = await self.remote.revoke_user_sessions(user_id)
+        await self.invalidate(*session_ids)
+        return session_ids
+
+    async def reap_expired(self, batch_size: int) -> int:
+        return await self.remote.reap_expired(batch_size)
+
+    async def invalidate(self, *session_ids: str) -> None:
+        if not session_ids:
+            return
+        async with self.remote.redis_client.pipeline(transaction=False) as pipe:
+            for session_id in session_ids:
+                self.local.invalidate(session_id)
+                pipe.publish(INVALIDATION_CHANNEL, session_id)
+            await pipe.execute()
+        self.invalidations_published += len(session_ids)
+
+    async def _listen(self) -> None:
+        while True:
+            try:
+                async with self.remote.redis_client.pubsub() as pubsub:
+                    await pubsub.subscribe(INVALIDATION_CHANNEL)
+                    async for message in pubsub.listen():
+                        if message["type"] != "message":
+                            continue
+                        self.local.invalidate(message["data"])
+                        self.invalidations_received += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Invalidations may have been missed while disconnected.
+                logger.warning("Session invalidation listener error", exc_info=e)
+                self.local.clear()
+                await asyncio.sleep(1)
+
+    def pool_stats(self) -> Dict:
+        return self.remote.pool_stats()
+
+    def cache_stats(self) -> Dict:
+        local = self.local.stats()
+        return {
+            "local_hits": local["hits"],
+            "remote_hits": self.remote_hits,
+            "remote_misses": self.remote_misses,
+            "invalidations_published": self.invalidations_published,
+            "invalidations_received": self.invalidations_received,
+            "local": local,
+        }
+
+    async def start(self) -> None:
+        if self._listener is None:
+            self._listener = asyncio.create_task(self._listen())
+
+    async def close(self) -> None:
+        if self._listener is not None:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except asyncio.CancelledError:
+                pass
+            self._listener = None
+        await self.remote.close()
+
+REVOCATION_CHANNEL = "cachestore:revoked"
+REVOKED_SESSIONS_KEY = "revoked_sessions"
+
+# Stateless sessions: the session_id cookie is a signed token carrying user_id,
+# email, csrf_token and expires, so get_session does no I/O. Revoked tokens
+# (logout, rotation, revoke_user_sessions) are kept in the revoked_sessions
+# sorted set in Redis, scored by their expiry. Every worker mirrors that set in
+# memory: it loads the set when its subscription to REVOCATION_CHANNEL is
+# confirmed and then applies the revocations published there.
+# Session ids that are not tokens, like the admin session made by
+# renew_admin_session.sh, are looked up in the Redis store as before.
+class TokenCacheStore(AsyncCacheStore):
+
+    def __init__(self, remote: AsyncRedisCacheStore, signer: SessionTokenSigner):
+        self.remote = remote
+        self.signer = signer
+        self.revoked: Dict[str, int] = {}
+        self.verified = 0
+        self.rejected = 0
+        self.revocations_received = 0
+        self._listener: Optional[asyncio.Task] = None
+
+    def _new_claims(self, user_id: int, email: str) -> Dict:
+        return {"j": secrets.token_urlsafe(16), "u": user_id, "e": email,
+                "c": secrets.token_urlsafe(32), "x": session_expires()}
+
+    def _session(self, token: str, claims: Dict) -> Dict:
+        return {"session_id": token, "csrf_token": claims["c"], "user_id": claims["u"],
+                "email": claims["e"], "expires": claims["x"]}
+
+    # Keeps user_tokens:<user_id>, the tokens issued to a user scored by expiry,
+    # for revoke_user_sessions, and records revocations.
+    async def _update(self, user_id: int, issued: Optional[Dict[str, int]] = None,
+                      revoked: Optional[Dict[str, int]] = None) -> None:
+        self.revoked.update(revoked or {})
+        user_tokens = f"user_tokens:{user_id}"
+        async with self.remote.redis_client.pipeline(transaction=True) as pipe:
+            if issued:
+                pipe.zadd(user_tokens, issued)
+                pipe.expire(user_tokens, settings.session_max_age)
+            if revoked:
+                pipe.zrem(user_tokens, *revoked)
+                pipe.zadd(REVOKED_SESSIONS_KEY, revoked)
+                for jti, expires in revoked.items():
+                    pipe.publish(REVOCATION_CHANNEL, f"{jti} {expires}")
+            await pipe.execute()
+
+    async def get_session(self, session_id: str) -> Optional[Dict]:
+        if not is_token(session_id):
+            return await self.remote.get_session(session_id)
+        claims = self.signer.loads(session_id)
+        if not claims or claims["x"] <= int(time.time()) or claims["j"] in self.revoked:
+            self.rejected += 1
+            return None
+        self.verified += 1
+        return self._session(session_id, claims)
+
+    async def list_sessions(self, cursor: Optional[int] = None, count: int = 100) -> Dict:
+        # Only sessions kept in Redis; tokens are not stored anywhere.
+        return await self.remote.list_sessions(cursor, count)
+
+    async def session_stats(self, top: int = 20) -> Dict:
+        return await self.remote.session_stats(top)
+
+    async def create_session(self, user_id: int, email: str) -> Dict:
+        claims = self._new_claims(user_id, email)
+        await self._update(user_id, issued={claims["j"]: claims["x"]})
+        return self._session(self.signer.dumps(claims), claims)
+
+    async def delete_session(self, session_id: str) -> None:
+        if not is_token(session_id):
+            return await self.remote.delete_session(session_id)
+        claims = self.signer.loads(session_id)
+        if not claims or claims["e"] == settings.admin_email:
+            return
+        await self._update(claims["u"], revoked={claims["j"]: claims["x"]})
+
+    async def rotate_session(self, session_id: str) -> Optional[Dict]:
+        if not is_token(session_id):
+            return await self.remote.rotate_session(session_id)
+        claims = self.signer.loads(session_id)
+        if not claims:
+            return None
+        pointer = f"rotated:{claims['j']}"
+        client = self.remote.redis_client
+        if claims["j"] not in self.revoked and claims["x"] > int(time.time()):
+            new_claims = self._new_claims(claims["u"], claims["e"])
+            token = self.signer.dumps(new_claims)
+            if await client.set(pointer, token, nx=True, ex=settings.session_rotation_grace):
+                await self._update(claims["u"], issued={new_claims["j"]: new_claims["x"]},
+                                   revoked={claims["j"]: claims["x"]})
+                return self._session(token, new_claims)
+        # Already rotated, by this or another worker: return the same successor.
+        successor = await client.get(pointer)
+        return await self.get_session(successor) if successor else None
+
+    async def cleanup_sessions(self) -> None:
+        await self.remote.cleanup_sessions()
+
+    async def revoke_user_sessions(self, user_id: int) -> List[str]:
+        now = int(time.time())
+        tokens = await self.remote.redis_client.zrangebyscore(f"user_tokens:{user_id}", now, "+inf", withscores=True)
+        revoked = {jti: int(expires) for jti, expires in tokens}
+        if revoked:
+            await self._update(user_id, revoked=revoked)
+        return list(revoked) + await self.remote.revoke_user_sessions(user_id)
+
+    async def reap_expired(self, batch_size: int) -> int:
+        now = int(time.time())
+        for jti in [jti for jti, expires in self.revoked.items() if expires <= now]:
+            del self.revoked[jti]
+        return await self.remote.redis_client.zremrangebyscore(REVOKED_SESSIONS_KEY, "-inf", now)
+
+    async def _load_revoked(self) -> None:
+        revoked = await self.remote.redis_client.zrangebyscore(
+            REVOKED_SESSIONS_KEY, int(time.time()), "+inf", withscores=True)
+        self.revoked.update({jti: int(expires) for jti, expires in revoked})
+
+    async def _listen(self) -> None:
+        while True:
+            try:
+                async with self.remote.redis_client.pubsub() as pubsub:
+                    await pubsub.subscribe(REVOCATION_CHANNEL)
+                    async for message in pubsub.listen():
+                        if message["type"] == "subscribe":
+                            # Revocations published from here on arrive as messages.
+                            await self._load_revoked()
+                        elif message["type"] == "message":
+                            jti, expires = message["data"].split()
+                            self.revoked[jti] = int(expires)
+                            self.revocations_received += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("Session revocation listener error", exc_info=e)
+                await asyncio.sleep(1)
+
+    def pool_stats(self) -> Dict:
+        return self.remote.pool_stats()
+
+    def cache_stats(self) -> Dict:
+        return {
+            "verified": self.verified,
+            "rejected": self.rejected,
+            "revoked": len(self.revoked),
+            "revocations_received": self.revocations_received,
+        }
+
+    async def start(self) -> None:
+        if self._listener is None:
+            self._listener = asyncio.create_task(self._listen())
+
+    async def close(self) -> None:
+        if self._listener is not None:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except asyncio.CancelledError:
+                pass
+            self._listener = None
+        await self.remote.close()
+
+def sql_pool_stats(pool) -> Dict:
+    return {
+        "backend": "sql",
+        "pool_class": type(pool).__name__,
+        "size": pool.size() if hasattr(pool, "size") else None,
+        "checked_in": pool.checkedin() if hasattr(pool, "checkedin") else None,
+        "checked_out": pool.checkedout() if hasattr(pool, "checkedout") else None,
+        "overflow": pool.overflow() if hasattr(pool, "overflow") else None,
+        "status": pool.status(),
+    }
+
+def redis_pool_stats(pool) -> Dict:
+    if hasattr(pool, "_in_use_connections"):
+        # redis.asyncio pools track available and in-use connections separately.
+        idle = len(pool._available_connections)
+        in_use = len(pool._in_use_connections)
+    else:
+        # The sync BlockingConnectionPool keeps placeholders (None) in its queue for connections not yet made.
+        created = len(getattr(pool, "_connections", []))
+        idle = len([c for c in getattr(getattr(pool, "pool", None), "queue", []) if c is not None])
+        in_use = created - idle
+    return {
+        "backend": "redis",
+        "pool_class": type(pool).__name__,
+        "max_connections": pool.max_connections,
+        "created": idle + in_use,
+        "idle": idle,
+        "in_use": in_use,
+    }
+
+def redis_pool_kwargs() -> Dict:
+    return dict(
+        host=settings.redis_host,
+        port=settings.redis_port,
+        db=0,
+        decode_responses=True,
+        max_connections=settings.redis_max_connections,
+        timeout=settings.redis_pool_timeout,
+        socket_timeout=settings.redis_socket_timeout,
+        socket_connect_timeout=settings.redis_socket_connect_timeout,
+        health_check_interval=settings.redis_health_check_interval)
+
+def create_redis_pool() -> redis.ConnectionPool:
+    return redis.BlockingConnectionPool(**redis_pool_kwargs())
+
+def create_async_redis_pool() -> redis.asyncio.ConnectionPool:
+    return redis.asyncio.BlockingConnectionPool(**redis_pool_kwargs())
+
+def sql_pool_kwargs() -> Dict:
+    return dict(
+        pool_size=settings.cache_db_pool_size,
+        max_overflow=settings.cache_db_max_overflow,
+        pool_timeout=settings.cache_db_pool_timeout,
+        pool_recycle=settings.cache_db_pool_recycle,
+        pool_pre_ping=True)
+
+def create_cache_engine():
+    return create_sqlite_engine(CACHE_STORE_URI, **sql_pool_kwargs())
+
+def create_async_cache_engine():
+    return create_async_sqlite_engine(ASYNC_CACHE_STORE_URI, **sql_pool_kwargs())
+
+# Blocking stores for scripts and tools outside the event loop.
+def create_cache_store() -> CacheStore:
+    if settings.cache_store in ('redis', 'token'):
+        # In token mode only sessions made outside the app, like the admin session, are stored.
+        return RedisCacheStore(create_redis_pool())
+    elif settings.cache_store == 'sql':
+        return SQLCacheStore()
+    raise ValueError(f"Unknown cache_store: {settings.cache_store}")
+
+def create_async_cache_store() -> AsyncCacheStore:
     if settings.cache_store == 'redis':
-        return RedisCacheStore()
+        store = AsyncRedisCacheStore(create_async_redis_pool())
+        if settings.session_local_cache_ttl > 0:
+            return TieredCacheStore(store, maxsize=settings.session_local_cache_size,
+                                    ttl=settings.session_local_cache_ttl)
+        return store
+    elif settings.cache_store == 'token':
+        return TokenCacheStore(AsyncRedisCacheStore(create_async_redis_pool()),
+                               SessionTokenSigner(settings.session_token_keys))
     elif settings.cache_store == 'sql':
-        cs = next(get_cache())
-        return SQLCacheStore(cs)
+        return AsyncSQLCacheStore()
+    raise ValueError(f"Unknown cache_store: {settings.cache_store}")
+
+# The store (and its connection pool) lives for the whole worker process.
+# init_cache_store/close_cache_store are called from the app lifespan in main.py.
+_cache_store: Optional[AsyncCacheStore] = None
+
+def init_cache_store() -> AsyncCacheStore:
+    global _cache_store
+    if _cache_store is None:
+        _cache_store = create_async_cache_store()
+        if settings.metrics_enabled:
+            _cache_store = TimedCacheStore(_cache_store)
+    return _cache_store
+
+async def open_cache_store() -> AsyncCacheStore:
+    store = init_cache_store()
+    await store.start()
+    return store
+
+async def close_cache_store() -> None:
+    global _cache_store
+    if _cache_store is not None:
+        await _cache_store.close()
+        _cache_store = None
+
+def get_cache_store() -> AsyncCacheStore:
+    return init_cache_store()
 
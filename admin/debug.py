@@ -1,32 +1,72 @@
+import logging
 from config import settings
-from fastapi import APIRouter, HTTPException, Response, Request, Depends, Cookie, Header, Form
-from fastapi.templating import Jinja2Templates
-from fastapi.responses import JSONResponse, HTMLResponse
-from typing import Annotated
+from fastapi import APIRouter, HTTPException, Response, Request, Depends, Cookie, Header, Form, Query
+from admin.metrics import TimedTemplates
+from fastapi.responses import JSONResponse, HTMLResponse, PlainTextResponse
+from typing import Annotated, Literal
 from data.db import UserBase
-from admin import auth
+from admin import auth, logs
+from admin.user import user_cache
+from admin.reaper import reaper_stats
+from admin.idtoken import cert_cache
+from admin.events import get_event_bus
+from admin.metrics import slowest_requests
+from admin.profiler import sampler
 
-from admin.cachestore import CacheStore, get_cache_store
+from admin.cachestore import AsyncCacheStore, get_cache_store
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter()
-templates = Jinja2Templates(directory='templates')
+templates = TimedTemplates(directory='templates')
+
+@router.get("/sessions", dependencies=[Depends(auth.is_authenticated_admin)])
+async def list_sessions(cursor: Annotated[int | None, Query(ge=0)] = None,
+                        count: Annotated[int, Query(ge=1, le=1000)] = 100,
+                        cs: AsyncCacheStore = Depends(get_cache_store)):
+    return await cs.list_sessions(cursor, count)
+
+@router.get("/sessions/stats", dependencies=[Depends(auth.is_authenticated_admin)])
+async def session_stats(top: Annotated[int, Query(ge=0, le=1000)] = 20,
+                        cs: AsyncCacheStore = Depends(get_cache_store)):
+    return await cs.session_stats(top)
+
+@router.get("/pool_stats", dependencies=[Depends(auth.is_authenticated_admin)])
+async def pool_stats(cs: AsyncCacheStore = Depends(get_cache_store)):
+    return cs.pool_stats()
+
+@router.get("/session_cache", dependencies=[Depends(auth.is_authenticated_admin)])
+async def session_cache_stats(cs: AsyncCacheStore = Depends(get_cache_store)):
+    return cs.cache_stats()
 
-@router.get("/sessions")
-async def list_sessions(cs: CacheStore = Depends(get_cache_store)):
-    return cs.list_sessions()
+@router.get("/reaper", dependencies=[Depends(auth.is_authenticated_admin)])
+async def session_reaper_stats():
+    return reaper_stats()
+
+@router.get("/google_certs", dependencies=[Depends(auth.is_authenticated_admin)])
+async def google_certs_stats():
+    return cert_cache.stats()
+
+@router.get("/user_cache", dependencies=[Depends(auth.is_authenticated_admin)])
+async def user_cache_stats():
+    return user_cache.stats()
+
+@router.get("/events", dependencies=[Depends(auth.is_authenticated_admin)])
+async def event_bus_stats():
+    return get_event_bus().stats()
 
 @router.get("/env/")
 async def env():
-    print("settings: ", settings)
+    logger.debug("settings", extra={"settings": settings})
     return {
         "origin_server": settings.origin_server,
         "google_oauth2_client_id": settings.google_oauth2_client_id,
         }
 
 @router.get("/me")
-async def dump_users_info(request: Request, user: UserBase = Depends(auth.get_current_user), cs: CacheStore = Depends(get_cache_store)):
+async def dump_users_info(request: Request, user: UserBase = Depends(auth.get_current_user), cs: AsyncCacheStore = Depends(get_cache_store)):
     session_id = request.cookies.get("session_id")
-    session = cs.get_session(session_id)
+    session = await cs.get_session(session_id)
     try:
         return {"user": user, "session": session}
     except:
@@ -35,20 +75,20 @@ async def dump_users_info(request: Request, user: UserBase = Depends(auth.get_cu
 @router.get("/debug_headers")
 async def debug_headers(request: Request):
     headers = request.headers
-    print("Headers: ", headers)
+    logger.debug("Headers", extra={"headers": dict(headers)})
     return{"Headers": headers}
 
 @router.get("/refresh_token")
-def refresh_token(response: Response,
+async def refresh_token(response: Response,
                   session_id: Annotated[str | None, Cookie()] = None,
-                  cs: CacheStore = Depends(get_cache_store)):
+                  cs: AsyncCacheStore = Depends(get_cache_store)):
     # print("session_id: ", session_id)
-    session = cs.get_session(session_id)
+    session = await cs.get_session(session_id)
     if not session:
         raise HTTPException(status_code=403, detail="No session found for the session_id: "+session_id)
 
     try:
-        new_session = auth.mutate_session(response, session, cs, False)
+        new_session = await auth.mutate_session(response, session, cs, False)
         return {"ok": True, "new_token": new_session["session_id"], "csrf_token": new_session["csrf_token"]}
     except HTTPException as e:
         return JSONResponse(status_code=e.status_code, content={"detail": e.detail})
@@ -61,7 +101,7 @@ async def csrf_js_get(request: Request):
 @router.post("/csrf_js")
 async def csrf_js_post(x_csrf_token: Annotated[str | None, Header()] = None,
                  session_id: Annotated[str | None, Cookie()] = None,
-                 cs: CacheStore = Depends(get_cache_store)):
+                 cs: AsyncCacheStore = Depends(get_cache_store)):
     csrf_token = x_csrf_token
     return await csrf_post(session_id, cs, csrf_token)
 
@@ -75,12 +115,59 @@ async def csrf_html_get(request: Request,
 @router.post("/csrf_html")
 async def csrf_html_post(csrf_token: Annotated[str | None, Form()] = None,
                          session_id: Annotated[str | None, Cookie()] = None,
-                         cs: CacheStore = Depends(get_cache_store)):
+                         cs: AsyncCacheStore = Depends(get_cache_store)):
     return await csrf_post(session_id, cs, csrf_token)
 
 async def csrf_post(session_id, cs, csrf_token):
-    session = cs.get_session(session_id)
+    session = await cs.get_session(session_id)
     if not session:
         raise HTTPException(status_code=403, detail="No session found for the session_id: "+session_id)
     csrf_token = auth.csrf_verify(csrf_token, session)
     return {"ok": True, "csrf_token": csrf_token}
+
+# Per worker: with several workers, repeat the request until each one has answered.
+@router.get("/logging", dependencies=[Depends(auth.is_authenticated_admin)])
+async def logging_stats():
+    return logs.logging_stats()
+
+@router.put("/logging", dependencies=[Depends(auth.is_authenticated_admin)])
+async def set_logging(name: Annotated[str, Query(alias="logger")] = "admin",
+                      level: Literal["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"] = "DEBUG",
+                      sample: Annotated[float | None, Query(ge=0, le=1)] = None):
+    logs.set_level(name, level, sample)
+    return logs.logging_stats()
+
+@router.get("/slow_requests", dependencies=[Depends(auth.is_authenticated_admin)])
+async def slow_requests(top: Annotated[int, Query(ge=1, le=1000)] = 20):
+    return slowest_requests(top)
+
+# Collapsed stacks of this worker for the next `seconds`, e.g.
+#   curl -b cookies 'https://.../debug/profile?seconds=30' | flamegraph.pl > profile.svg
+@router.get("/profile", response_class=PlainTextResponse, dependencies=[Depends(auth.is_authenticated_admin)])
+async def profile(seconds: Annotated[float, Query(gt=0, le=settings.profile_max_seconds)] = 10):
+    try:
+        result = await sampler.profile(seconds)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return PlainTextResponse(result.collapsed(), headers={"X-Profile-Samples": str(result.samples)})
+
+@router.get("/profile/requests", dependencies=[Depends(auth.is_authenticated_admin)])
+async def profiled_requests():
+    return sampler.request_stats()
+
+# Requests sent with "X-Profile: 1" are profiled for the next `seconds`; 0 disarms.
+@router.put("/profile/requests", dependencies=[Depends(auth.is_authenticated_admin)])
+async def arm_request_profiling(seconds: Annotated[float, Query(ge=0, le=3600)] = 300):
+    try:
+        sampler.arm(seconds)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return sampler.request_stats()
+
+@router.get("/profile/requests/{profile_id}", response_class=PlainTextResponse,
+            dependencies=[Depends(auth.is_authenticated_admin)])
+async def request_profile(profile_id: str):
+    result = sampler.request_profile(profile_id)
+    if result is None:
+        raise HTTPException(status_code=404, detail="No such request profile")
+    return PlainTextResponse(result.collapsed(), headers={"X-Profile-Samples": str(result.samples)})
@@ -0,0 +1,205 @@
+import asyncio, json, time, secrets, logging
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from typing import Optional, Dict, Set
+import redis
+import redis.asyncio
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+# Session events pushed to the browser over Server-Sent Events (/auth/events),
+# so that open tabs no longer poll cookies, /auth/refresh_token and /auth/check.
+#
+# Events are published to a channel, either browser:<id> for all tabs of one
+# browser (the id is kept in the starlette_session cookie) or user:<user_id>
+# for every browser of a user. Each SSE connection reads its channels from an
+# in-process queue. With Redis, every worker keeps one pattern subscription to
+# events:* and fans the messages out to its local queues, so a tab costs no
+# Redis connection of its own. Without Redis, events only reach the tabs
+# connected to the same worker.
+#
+#   rotated       the session was rotated by another tab; carries the new expires
+#   expiring      the session may be rotated now (sent by the stream itself)
+#   logged_out    logout, revocation or expiry
+#   user_switched a user logged in from another tab of the browser
+
+EVENT_CHANNEL_PREFIX = "events:"
+
+class EventBus:
+
+    def __init__(self, queue_size: int):
+        self.queue_size = queue_size
+        self.subscribers: Dict[str, Set[asyncio.Queue]] = defaultdict(set)
+        self.published = 0
+        self.delivered = 0
+        self.dropped = 0
+
+    def _deliver(self, channel: str, event: Dict) -> None:
+        for queue in self.subscribers.get(channel, ()):
+            try:
+                queue.put_nowait(event)
+                self.delivered += 1
+            except asyncio.QueueFull:
+                # A stalled client; it resynchronizes when it reconnects.
+                self.dropped += 1
+
+    async def publish(self, channel: str, event: Dict) -> None:
+        self.published += 1
+        self._deliver(channel, event)
+
+    @asynccontextmanager
+    async def subscribe(self, *channels: str):
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        for channel in channels:
+            self.subscribers[channel].add(queue)
+        try:
+            yield queue
+        finally:
+            for channel in channels:
+                self.subscribers[channel].discard(queue)
+                if not self.subscribers[channel]:
+                    del self.subscribers[channel]
+
+    def stats(self) -> Dict:
+        return {
+            "backend": "local",
+            "channels": len(self.subscribers),
+            "subscribers": sum(len(queues) for queues in self.subscribers.values()),
+            "published": self.published,
+            "delivered": self.delivered,
+            "dropped": self.dropped,
+        }
+
+    async def start(self) -> None:
+        pass
+
+    async def close(self) -> None:
+        pass
+
+class RedisEventBus(EventBus):
+
+    def __init__(self, queue_size: int, redis_client: redis.asyncio.Redis):
+        super().__init__(queue_size)
+        self.redis_client = redis_client
+        self.received = 0
+        self.publish_errors = 0
+        self._relay: Optional[asyncio.Task] = None
+
+    async def publish(self, channel: str, event: Dict) -> None:
+        self.published += 1
+        try:
+            await self.redis_client.publish(EVENT_CHANNEL_PREFIX + channel, json.dumps(event))
+        except redis.RedisError as e:
+            # Still reach the tabs on this worker.
+            logger.warning("Event bus publish error: %s", e)
+            self.publish_errors += 1
+            self._deliver(channel, event)
+
+    async def _run_relay(self) -> None:
+        while True:
+            try:
+                async with self.redis_client.pubsub() as pubsub:
+                    await pubsub.psubscribe(EVENT_CHANNEL_PREFIX + "*")
+                    async for message in pubsub.listen():
+                        if message["type"] != "pmessage":
+                            continue
+                        self.received += 1
+                        self._deliver(message["channel"][len(EVENT_CHANNEL_PREFIX):], json.loads(message["data"]))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("Event bus relay error", exc_info=e)
+                await asyncio.sleep(1)
+
+    def stats(self) -> Dict:
+        stats = super().stats()
+        stats.update(backend="redis", received=self.received, publish_errors=self.publish_errors)
+        return stats
+
+    async def start(self) -> None:
+        if self._relay is None:
+            self._relay = asyncio.create_task(self._run_relay())
+
+    async def close(self) -> None:
+        if self._relay is not None:
+            self._relay.cancel()
+            try:
+                await self._relay
+            except asyncio.CancelledError:
+                pass
+            self._relay = None
+        await self.redis_client.aclose()
+
+def create_event_bus() -> EventBus:
+    if settings.cache_store in ('redis', 'token'):
+        from admin.cachestore import create_async_redis_pool
+        return RedisEventBus(settings.session_events_queue_size,
+                             redis.asyncio.Redis(connection_pool=create_async_redis_pool()))
+    return EventBus(settings.session_events_queue_size)
+
+# Created and started from the app lifespan in main.py, like the cache store.
+_event_bus: Optional[EventBus] = None
+
+async def open_event_bus() -> EventBus:
+    global _event_bus
+    if _event_bus is None:
+        _event_bus = create_event_bus()
+        await _event_bus.start()
+    return _event_bus
+
+async def close_event_bus() -> None:
+    global _event_bus
+    if _event_bus is not None:
+        await _event_bus.close()
+        _event_bus = None
+
+def get_event_bus() -> EventBus:
+    global _event_bus
+    if _event_bus is None:
+        _event_bus = create_event_bus()
+    return _event_bus
+
+def browser_channel(request_session: Dict) -> str:
+    if "event_channel" not in request_session:
+        request_session["event_channel"] = secrets.token_urlsafe(16)
+    return f"browser:{request_session['event_channel']}"
+
+def user_channel(user_id: int) -> str:
+    return f"user:{user_id}"
+
+def sse_message(event: Dict) -> str:
+    return f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+
+# The stream of one tab. Besides relaying published events it sends expiring
+# when the session gets old enough for mutate_session to rotate it, and
+# logged_out when it expires, so an idle tab makes no requests at all.
+async def session_event_stream(bus: EventBus, channels, session: Optional[Dict]):
+    # Sessions made by renew_admin_session.sh have no expiry.
+    expires = session.get("expires") if session else None
+    expiring_sent = False
+    async with bus.subscribe(*channels) as queue:
+        yield f"retry: {int(settings.session_events_retry * 1000)}\n\n"
+        while True:
+            timeout = settings.session_events_heartbeat
+            if expires is not None:
+                now = time.time()
+                if not expiring_sent and expires - now <= settings.session_max_age / 2:
+                    expiring_sent = True
+                    yield sse_message({"type": "expiring", "expires": expires})
+                if expires <= now:
+                    yield sse_message({"type": "logged_out", "reason": "expired"})
+                    return
+                next_at = expires if expiring_sent else expires - settings.session_max_age / 2
+                timeout = min(timeout, max(0.0, next_at - now))
+            try:
+                event = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                yield ": ping\n\n"
+                continue
+            if event["type"] == "rotated" and expires is not None:
+                expires, expiring_sent = event["expires"], False
+            yield sse_message(event)
+            if event["type"] in ("logged_out", "user_switched"):
+                return
@@ -0,0 +1,130 @@
+import re, time, asyncio, logging
+from typing import Dict, Optional
+import requests
+from google.auth import jwt
+from google.auth.exceptions import GoogleAuthError
+from starlette.concurrency import run_in_threadpool
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+# Verifies Google ID tokens against a per-worker cache of Google's signing certs.
+#
+# The certs are fetched once at startup and refreshed in the background shortly
+# before the Cache-Control max-age of the last response runs out. A token signed
+# with an unknown kid (i.e. Google rotated its keys) triggers one immediate
+# refetch, at most once per google_certs_min_refresh seconds. Fetching and the
+# RSA signature check both run in the thread pool, off the event loop.
+class GoogleCertCache:
+
+    def __init__(self, certs_url: str, default_max_age: int, min_refresh: int):
+        self.certs_url = certs_url
+        self.default_max_age = default_max_age
+        self.min_refresh = min_refresh
+        self.certs: Dict[str, str] = {}
+        self.expires_at = 0.0
+        self.fetched_at = 0.0
+        self.fetches = 0
+        self.fetch_errors = 0
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    def _fetch(self):
+        response = requests.get(self.certs_url, timeout=10)
+        response.raise_for_status()
+        return response.json(), response.headers.get("Cache-Control", "")
+
+    def _max_age(self, cache_control: str) -> int:
+        match = re.search(r"max-age=(\d+)", cache_control)
+        return int(match.group(1)) if match else self.default_max_age
+
+    async def refresh(self) -> Dict[str, str]:
+        fetched_at = self.fetched_at
+        async with self._lock:
+            # Another coroutine refreshed while we waited for the lock.
+            if self.certs and self.fetched_at != fetched_at:
+                return self.certs
+            try:
+                certs, cache_control = await run_in_threadpool(self._fetch)
+            except Exception:
+                self.fetch_errors += 1
+                raise
+            self.certs = certs
+            self.fetched_at = time.monotonic()
+            self.expires_at = self.fetched_at + self._max_age(cache_control)
+            self.fetches += 1
+            return self.certs
+
+    async def get_certs(self) -> Dict[str, str]:
+        if not self.certs or time.monotonic() >= self.expires_at:
+            return await self.refresh()
+        return self.certs
+
+    async def get_certs_for(self, token: str) -> Dict[str, str]:
+        certs = await self.get_certs()
+        try:
+            kid = jwt.decode_header(token).get("kid")
+        except ValueError:
+            return certs
+        if kid and kid not in certs and time.monotonic() - self.fetched_at >= self.min_refresh:
+            logger.info("GoogleCertCache: unknown kid, refetching certs", extra={"kid": kid})
+            certs = await self.refresh()
+        return certs
+
+    async def verify(self, token: str, audience: str) -> Dict:
+        certs = await self.get_certs_for(token)
+        idinfo = await run_in_threadpool(jwt.decode, token, certs=certs, audience=audience)
+        if idinfo.get("iss") not in settings.google_issuers:
+            raise GoogleAuthError(f"Wrong issuer. 'iss' should be one of the following: {settings.google_issuers}")
+        return idinfo
+
+    async def _run(self) -> None:
+        while True:
+            # Refresh a little before the current certs expire, retrying sooner on failure.
+            delay = max(self.min_refresh, self.expires_at - time.monotonic() - 60)
+            await asyncio.sleep(delay)
+            try:
+                await self.refresh()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("GoogleCertCache: failed to refresh certs: %s", e)
+
+    async def start(self) -> None:
+        try:
+            await self.refresh()
+        except Exception as e:
+            # Not fatal: the first login will fetch the certs again.
+            logger.warning("GoogleCertCache: failed to prefetch certs: %s", e)
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> Dict:
+        return {
+            "certs_url": self.certs_url,
+            "kids": list(self.certs),
+            "expires_in": max(0, int(self.expires_at - time.monotonic())),
+            "fetches": self.fetches,
+            "fetch_errors": self.fetch_errors,
+        }
+
+cert_cache = GoogleCertCache(settings.google_certs_url,
+                             default_max_age=settings.google_certs_default_max_age,
+                             min_refresh=settings.google_certs_min_refresh)
+
+async def verify_oauth2_token(token: str, audience: str) -> Dict:
+    try:
+        return await cert_cache.verify(token, audience)
+    except GoogleAuthError as e:
+        # Match google.oauth2.id_token, whose callers expect ValueError on a bad token.
+        raise ValueError(str(e)) from e
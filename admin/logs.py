@@ -0,0 +1,142 @@
+import copy, json, logging, logging.handlers, queue, random, re, sys, hashlib
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+# Application logging, configured by log_config.yaml:
+#
+#   uvicorn main:app --log-config log_config.yaml
+#
+# Modules log through logging.getLogger(__name__), with structured fields as extras:
+#
+#   logger.debug("session loaded", extra={"session": session})
+#
+# JSONQueueHandler puts records on a bounded queue and returns; a listener thread
+# formats them as one JSON object per line and writes them out, so a request never
+# waits on stdout. When the queue is full records are dropped and counted instead.
+# Fields whose name looks secret (session_id, csrf_token, jwt, ...) and token-like
+# strings in messages are replaced by a short hash, which still tells equal values apart.
+# SamplingFilter keeps a fraction of the records below WARNING per logger.
+# Levels and sample rates can be changed at runtime with PUT /debug/logging.
+
+SENSITIVE_KEY = re.compile(r"token|secret|key|password|credential|jwt|nonce|session_id|csrf|cookie|authorization", re.I)
+# JWTs, and the urlsafe base64 of secrets.token_urlsafe(32) and longer.
+TOKEN_VALUE = re.compile(r"eyJ[\w-]+\.[\w-]+\.[\w-]*|[\w-]{40,}={0,2}")
+
+# Attributes every LogRecord has; anything else on a record came from extra=,
+# except uvicorn's color_message, an ANSI-colored copy of the message.
+RECORD_ATTRIBUTES = set(logging.makeLogRecord({}).__dict__) | {"message", "asctime", "taskName", "color_message"}
+
+def fingerprint(value) -> str:
+    return "redacted:" + hashlib.sha256(str(value).encode()).hexdigest()[:8]
+
+def redact(value, key: Optional[str] = None):
+    if key is not None and value not in (None, "") and SENSITIVE_KEY.search(key):
+        if isinstance(value, (list, tuple, set)):
+            return [fingerprint(item) for item in value]
+        return fingerprint(value)
+    if isinstance(value, dict):
+        return {str(k): redact(v, str(k)) for k, v in value.items()}
+    if isinstance(value, (list, tuple, set)):
+        return [redact(item) for item in value]
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    if hasattr(value, "model_dump"):
+        return redact(value.model_dump())
+    return TOKEN_VALUE.sub(lambda m: fingerprint(m.group()), str(value))
+
+class JSONFormatter(logging.Formatter):
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": redact(record.getMessage()),
+        }
+        for name, value in record.__dict__.items():
+            if name not in RECORD_ATTRIBUTES and name not in entry:
+                entry[name] = redact(value, name)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+# Logger name prefix -> fraction of records below WARNING that are kept.
+SAMPLE_RATES: Dict[str, float] = {}
+
+def sample_rate(name: str) -> float:
+    while True:
+        rate = SAMPLE_RATES.get(name)
+        if rate is not None:
+            return rate
+        if "." not in name:
+            return 1.0
+        name = name.rsplit(".", 1)[0]
+
+class SamplingFilter(logging.Filter):
+
+    def __init__(self, rates: Optional[Dict[str, float]] = None):
+        super().__init__()
+        SAMPLE_RATES.update(rates or {})
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = sample_rate(record.name)
+        return rate >= 1.0 or random.random() < rate
+
+class JSONQueueHandler(logging.handlers.QueueHandler):
+
+    instances = []
+
+    def __init__(self, stream=sys.stderr, queue_size: int = 10000):
+        super().__init__(queue.Queue(queue_size))
+        target = logging.StreamHandler(stream)
+        target.setFormatter(JSONFormatter())
+        self.dropped = 0
+        self.listener = logging.handlers.QueueListener(self.queue, target)
+        self.listener.start()
+        JSONQueueHandler.instances.append(self)
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    # Only what cannot cross threads is resolved here: the message arguments and
+    # the traceback. The JSON is built by the listener.
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def close(self) -> None:
+        if self.listener is not None:
+            try:
+                # Writes out the records still queued.
+                self.listener.stop()
+            except queue.Full:
+                pass
+            self.listener = None
+        super().close()
+
+def set_level(name: str, level: str, sample: Optional[float] = None) -> None:
+    logging.getLogger(name).setLevel(level)
+    if sample is not None:
+        SAMPLE_RATES[name] = sample
+
+def logging_stats() -> Dict:
+    names = sorted(name for name, logger in logging.Logger.manager.loggerDict.items()
+                   if isinstance(logger, logging.Logger) and logger.level != logging.NOTSET)
+    return {
+        "levels": {name: logging.getLevelName(logging.getLogger(name).level) for name in names},
+        "sample_rates": dict(SAMPLE_RATES),
+        "queued": sum(handler.queue.qsize() for handler in JSONQueueHandler.instances),
+        "dropped": sum(handler.dropped for handler in JSONQueueHandler.instances),
+    }
@@ -0,0 +1,267 @@
+import time, hmac, heapq
+from bisect import bisect_left
+from collections import deque
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Tuple
+from fastapi import APIRouter, Request, HTTPException
+from fastapi.responses import PlainTextResponse
+from fastapi.templating import Jinja2Templates
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from starlette.datastructures import MutableHeaders
+
+from config import settings
+
+# Request instrumentation: Server-Timing headers and Prometheus metrics at /metrics.
+#
+# MetricsMiddleware gives every request a RequestTimings in a context variable.
+# Code on the request path adds to it with `with phase(name):`
+#   session  cache store operations (TimedCacheStore, wrapped around the store in init_cache_store)
+#   user     user lookup in get_current_user, from user_cache or data.db
+#   google   ID token verification in VerifyToken
+#   render   TemplateResponse rendering (TimedTemplates)
+#   db       SQL statements on any engine, counted and timed by cursor events
+# and the totals are sent as Server-Timing, e.g. in the browser's network panel.
+# The same durations feed process-wide histograms, rendered in the Prometheus
+# text format by /metrics. Counters are per worker process, so scrape each worker.
+#
+# The last metrics_recent_requests requests are also kept with their timings,
+# for the slowest ones to be listed at /debug/slow_requests.
+#
+# The cost per request is a few perf_counter calls and dict updates.
+
+REQUEST_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PHASE_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def label_string(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Histogram:
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...], buckets: Tuple[float, ...]):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> [count per bucket (the last one is +Inf), sum]
+        self.series: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, *label_values: str) -> None:
+        series = self.series.get(label_values)
+        if series is None:
+            series = self.series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for values, (counts, total) in sorted(self.series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{label_string(self.labels, values, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{label_string(self.labels, values)} {total}")
+            lines.append(f"{self.name}_count{label_string(self.labels, values)} {cumulative}")
+        return lines
+
+REQUEST_SECONDS = Histogram("http_request_duration_seconds", "Request duration by route template.",
+                            ("method", "route", "status"), REQUEST_BUCKETS)
+PHASE_SECONDS = Histogram("app_phase_duration_seconds", "Time spent in each request phase.",
+                          ("phase",), PHASE_BUCKETS)
+CACHE_STORE_SECONDS = Histogram("cache_store_op_duration_seconds", "Cache store operation latency.",
+                                ("op",), PHASE_BUCKETS)
+DB_QUERIES = Histogram("db_queries_per_request", "SQL statements executed per request.",
+                       ("route",), QUERY_BUCKETS)
+
+class RequestTimings:
+    __slots__ = ("start", "phases", "db_queries", "db_seconds")
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases: Dict[str, float] = {}
+        self.db_queries = 0
+        self.db_seconds = 0.0
+
+    def server_timing(self) -> str:
+        entries = [f"{name};dur={seconds * 1000:.2f}" for name, seconds in self.phases.items()]
+        if self.db_queries:
+            entries.append(f'db;dur={self.db_seconds * 1000:.2f};desc="{self.db_queries} queries"')
+        entries.append(f"app;dur={(time.perf_counter() - self.start) * 1000:.2f}")
+        return ", ".join(entries)
+
+# (time, method, path, route, status, seconds, RequestTimings)
+RECENT_REQUESTS: deque = deque(maxlen=settings.metrics_recent_requests)
+
+def slowest_requests(top: int) -> List[Dict]:
+    return [{
+        "time": started,
+        "method": method,
+        "path": path,
+        "route": route,
+        "status": status,
+        "duration_ms": round(seconds * 1000, 2),
+        "phases_ms": {name: round(phase_seconds * 1000, 2) for name, phase_seconds in timings.phases.items()},
+        "db_queries": timings.db_queries,
+        "db_ms": round(timings.db_seconds * 1000, 2),
+    } for started, method, path, route, status, seconds, timings in heapq.nlargest(top, RECENT_REQUESTS, key=lambda r: r[5])]
+
+_timings: ContextVar[Optional[RequestTimings]] = ContextVar("request_timings", default=None)
+
+def add_phase(name: str, seconds: float) -> None:
+    timings = _timings.get()
+    if timings is not None:
+        timings.phases[name] = timings.phases.get(name, 0.0) + seconds
+    PHASE_SECONDS.observe(seconds, name)
+
+class phase:
+
+    __slots__ = ("name", "start")
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        add_phase(self.name, time.perf_counter() - self.start)
+        return False
+
+# Times every call of the operations below on the wrapped store; any other
+# attribute is the store's own.
+CACHE_STORE_OPS = ["get_session", "create_session", "delete_session", "rotate_session",
+                   "revoke_user_sessions", "cleanup_sessions", "reap_expired", "list_sessions", "session_stats"]
+
+class TimedCacheStore:
+
+    def __init__(self, store):
+        self.store = store
+
+    def __getattr__(self, name: str):
+        return getattr(self.store, name)
+
+def timed_op(name: str):
+    async def op(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await getattr(self.store, name)(*args, **kwargs)
+        finally:
+            seconds = time.perf_counter() - start
+            CACHE_STORE_SECONDS.observe(seconds, name)
+            add_phase("session", seconds)
+    op.__name__ = name
+    return op
+
+for _op in CACHE_STORE_OPS:
+    setattr(TimedCacheStore, _op, timed_op(_op))
+
+class TimedTemplates(Jinja2Templates):
+
+    def TemplateResponse(self, *args, **kwargs):
+        with phase("render"):
+            return super().TemplateResponse(*args, **kwargs)
+
+    # Renders a template chunk by chunk for a StreamingResponse, from async
+    # iterables in the context such as a database cursor. render() can not be
+    # used with an async environment inside the event loop, so streaming uses an
+    # async overlay of the same environment. Waiting on the iterables counts as
+    # render time; by then the Server-Timing header is sent, so it only shows in
+    # /metrics and /debug/slow_requests.
+    async def stream(self, name: str, context: dict):
+        env = getattr(self, "async_env", None)
+        if env is None:
+            env = self.async_env = self.env.overlay(enable_async=True)
+        chunks = env.get_template(name).generate_async(context)
+        while True:
+            with phase("render"):
+                try:
+                    chunk = await chunks.__anext__()
+                except StopAsyncIteration:
+                    return
+            yield chunk
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _timings.get() is not None:
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    timings = _timings.get()
+    starts = conn.info.get("query_start")
+    if timings is not None and starts:
+        timings.db_queries += 1
+        timings.db_seconds += time.perf_counter() - starts.pop()
+
+class MetricsMiddleware:
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        timings = RequestTimings()
+        token = _timings.set(timings)
+        status = 500
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if settings.metrics_server_timing:
+                    MutableHeaders(scope=message).append("Server-Timing", timings.server_timing())
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            # The route template, not the path, so that path parameters do not make new series.
+            route = scope.get("route")
+            route = getattr(route, "path", "unmatched")
+            seconds = time.perf_counter() - timings.start
+            REQUEST_SECONDS.observe(seconds, scope["method"], route, str(status))
+            RECENT_REQUESTS.append((time.time() - seconds, scope["method"], scope["path"], route, status, seconds, timings))
+            DB_QUERIES.observe(timings.db_queries, route)
+            _timings.reset(token)
+
+def pool_gauges() -> List[str]:
+    from admin.cachestore import get_cache_store, sql_pool_stats
+    from data.db import AsyncDataStore
+    pools = {"cache": get_cache_store().pool_stats(), "data": sql_pool_stats(AsyncDataStore.sync_engine.pool)}
+    lines = ["# HELP pool_connections Connection pool usage, as in /debug/pool_stats.",
+             "# TYPE pool_connections gauge"]
+    for pool, stats in pools.items():
+        for stat, value in stats.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                lines.append(f"pool_connections{label_string(('pool', 'stat'), (pool, stat))} {value}")
+    return lines
+
+def render_metrics() -> str:
+    lines = []
+    for histogram in (REQUEST_SECONDS, PHASE_SECONDS, CACHE_STORE_SECONDS, DB_QUERIES):
+        lines.extend(histogram.render())
+    lines.extend(pool_gauges())
+    return "\n".join(lines) + "\n"
+
+router = APIRouter()
+
+@router.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+async def metrics(request: Request):
+    if settings.metrics_token:
+        authorization = request.headers.get("authorization", "")
+        if not hmac.compare_digest(authorization, f"Bearer {settings.metrics_token}"):
+            raise HTTPException(status_code=401, detail="Invalid metrics token")
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+# Counts the statements of every engine, data.db and cache.db alike.
+def instrument_engines() -> None:
+    event.listen(Engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(Engine, "after_cursor_execute", after_cursor_execute)
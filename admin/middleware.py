@@ -0,0 +1,14 @@
+import itsdangerous
+from starlette.middleware.sessions import SessionMiddleware
+from starlette.types import ASGIApp
+
+# SessionMiddleware that verifies the session cookie against a ring of keys.
+# Cookies are signed with the last key and accepted if signed with any of them,
+# so a new key can be appended and the oldest one dropped later without logging
+# anyone out. All workers and nodes must share the same ring.
+class KeyRingSessionMiddleware(SessionMiddleware):
+    def __init__(self, app: ASGIApp, secret_keys: list[str], **kwargs) -> None:
+        if not secret_keys:
+            raise ValueError("KeyRingSessionMiddleware needs at least one secret key")
+        super().__init__(app, secret_key=secret_keys[-1], **kwargs)
+        self.signer = itsdangerous.TimestampSigner(list(secret_keys))
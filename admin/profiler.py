@@ -0,0 +1,178 @@
+import asyncio, os, secrets, signal, sys, threading, time
+from collections import Counter, deque
+from contextvars import ContextVar
+from typing import Dict, Optional
+from starlette.datastructures import MutableHeaders
+
+from config import settings
+
+# Statistical profiler for a live worker, driven from the admin-only /debug/profile endpoints.
+#
+# While a profile is being taken, an ITIMER_PROF timer sends SIGPROF every
+# profile_interval seconds of CPU time, and the handler counts the stack of the
+# frame it interrupted. Nothing is traced, so the profiled code runs at full speed,
+# and an idle worker takes no samples. (A sampling thread would not do: it only gets
+# the GIL when the event loop releases it, which is mostly in select().) Python runs
+# signal handlers in the main thread, which is where uvicorn runs the event loop.
+# Profiles are returned as collapsed stacks, one "frame;frame;... count" line per
+# stack, which flamegraph.pl, speedscope and inferno read directly.
+#
+# A single request is profiled by sending it with "X-Profile: 1" while request
+# profiling is armed (PUT /debug/profile/requests). The request's profile is kept
+# in a context variable, which the signal handler reads in the context of the task
+# it interrupted, so samples of the request and of the tasks it starts (like the
+# body of a StreamingResponse) are counted, and those of concurrent requests are not.
+# The response carries an X-Profile-Id header to fetch the profile with.
+# Code run in the threadpool does not appear in either kind of profile.
+
+PROFILE_HEADER = b"x-profile"
+
+_request_profile: ContextVar[Optional["Profile"]] = ContextVar("request_profile", default=None)
+
+class Profile:
+
+    def __init__(self):
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self.started = time.time()
+        self.duration = 0.0
+
+    def collapsed(self) -> str:
+        return "".join(f"{';'.join(stack)} {count}\n" for stack, count in self.stacks.most_common())
+
+_labels: Dict[object, str] = {}
+
+def short_path(filename: str) -> str:
+    # "" on sys.path is the current directory.
+    for entry in sorted((entry or os.getcwd() for entry in sys.path), key=len, reverse=True):
+        if filename.startswith(entry + os.sep):
+            return filename[len(entry) + 1:]
+    return filename
+
+def frame_label(code) -> str:
+    label = _labels.get(code)
+    if label is None:
+        label = _labels[code] = f"{code.co_name} ({short_path(code.co_filename)}:{code.co_firstlineno})"
+    return label
+
+def stack_of(frame) -> tuple:
+    labels = []
+    while frame is not None:
+        labels.append(frame_label(frame.f_code))
+        frame = frame.f_back
+    return tuple(reversed(labels))
+
+class Sampler:
+
+    def __init__(self):
+        self.running = False
+        self.worker_profile: Optional[Profile] = None
+        # Request profiling: armed until this time.monotonic(), and the number of profiled requests in progress.
+        self.armed_until = 0.0
+        self.requests = 0
+        self.recent: deque = deque(maxlen=settings.profile_recent_requests)
+
+    def active(self) -> bool:
+        return self.worker_profile is not None or time.monotonic() < self.armed_until or self.requests > 0
+
+    def start(self) -> None:
+        if threading.current_thread() is not threading.main_thread():
+            raise RuntimeError("The profiler needs the event loop in the main thread")
+        if not self.running:
+            signal.signal(signal.SIGPROF, self._sample)
+            signal.setitimer(signal.ITIMER_PROF, settings.profile_interval, settings.profile_interval)
+            self.running = True
+
+    def stop(self) -> None:
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        # Not SIG_DFL, which would end the process on a SIGPROF still pending.
+        signal.signal(signal.SIGPROF, signal.SIG_IGN)
+        self.running = False
+
+    # Runs in the main thread between two bytecodes of the interrupted frame,
+    # so profiles need no locking as long as they are only read once detached.
+    def _sample(self, signum, frame) -> None:
+        if not self.active():
+            self.stop()
+            return
+        stack = stack_of(frame)
+        profile = self.worker_profile
+        if profile is not None:
+            profile.samples += 1
+            profile.stacks[stack] += 1
+        request_profile = _request_profile.get()
+        if request_profile is not None:
+            request_profile.samples += 1
+            request_profile.stacks[stack] += 1
+
+    async def profile(self, seconds: float) -> Profile:
+        if self.worker_profile is not None:
+            raise RuntimeError("A profile is already being taken on this worker")
+        profile = Profile()
+        self.start()
+        self.worker_profile = profile
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            self.worker_profile = None
+            profile.duration = time.time() - profile.started
+        return profile
+
+    def arm(self, seconds: float) -> None:
+        if seconds > 0:
+            self.start()
+        self.armed_until = time.monotonic() + seconds
+
+    def armed(self) -> bool:
+        return time.monotonic() < self.armed_until
+
+    def request_stats(self) -> Dict:
+        return {
+            "armed_for": max(0.0, round(self.armed_until - time.monotonic(), 1)),
+            "interval": settings.profile_interval,
+            "in_progress": self.requests,
+            "recent": [{"id": profile_id, "method": method, "path": path, "status": status,
+                        "duration_ms": round(profile.duration * 1000, 2), "samples": profile.samples}
+                       for profile_id, method, path, status, profile in reversed(self.recent)],
+        }
+
+    def request_profile(self, profile_id: str) -> Optional[Profile]:
+        for recent_id, _, _, _, profile in self.recent:
+            if recent_id == profile_id:
+                return profile
+        return None
+
+sampler = Sampler()
+
+class ProfileMiddleware:
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not sampler.armed() or (PROFILE_HEADER, b"1") not in scope["headers"]:
+            return await self.app(scope, receive, send)
+        try:
+            sampler.start()
+        except RuntimeError:
+            return await self.app(scope, receive, send)
+        profile_id = secrets.token_hex(8)
+        profile = Profile()
+        status = 500
+
+        async def send_with_id(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                MutableHeaders(scope=message).append("X-Profile-Id", profile_id)
+            await send(message)
+
+        sampler.requests += 1
+        token = _request_profile.set(profile)
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            _request_profile.reset(token)
+            sampler.requests -= 1
+            profile.duration = time.time() - profile.started
+            sampler.recent.append((profile_id, scope["method"], scope["path"], status, profile))
@@ -0,0 +1,107 @@
+import asyncio, random, time, logging
+from typing import Dict, Optional
+
+from admin.cachestore import AsyncCacheStore
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+# Removes expired sessions in the background so that request handlers never do.
+# Each pass deletes in chunks of batch_size until a short chunk comes back,
+# yielding to the event loop between chunks. The interval is jittered so that
+# workers started together do not all hit the cache store at the same time.
+class SessionReaper:
+
+    def __init__(self, store: AsyncCacheStore, interval: float, batch_size: int, jitter: float):
+        self.store = store
+        self.interval = interval
+        self.batch_size = batch_size
+        # At most half the interval, so that passes are always at least interval / 2 apart.
+        self.jitter = min(jitter, interval / 2)
+        self.passes = 0
+        self.total_reaped = 0
+        self.last_reaped = 0
+        self.last_duration = 0.0
+        self.last_run = None
+        self.errors = 0
+        self._task: Optional[asyncio.Task] = None
+
+    async def run_once(self) -> int:
+        start = time.perf_counter()
+        reaped = 0
+        while True:
+            n = await self.store.reap_expired(self.batch_size)
+            reaped += n
+            if n < self.batch_size:
+                break
+            await asyncio.sleep(0)
+
+        self.passes += 1
+        self.total_reaped += reaped
+        self.last_reaped = reaped
+        self.last_duration = time.perf_counter() - start
+        self.last_run = int(time.time())
+        if reaped:
+            logger.info("Session reaper: reaped %d sessions in %.1f ms", reaped, self.last_duration*1000)
+        return reaped
+
+    async def _run(self) -> None:
+        await asyncio.sleep(random.uniform(0, self.jitter))
+        while True:
+            try:
+                await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.errors += 1
+                logger.error("Session reaper error", exc_info=e)
+            await asyncio.sleep(self.interval + random.uniform(-self.jitter, self.jitter))
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> Dict:
+        return {
+            "running": self._task is not None,
+            "interval": self.interval,
+            "batch_size": self.batch_size,
+            "jitter": self.jitter,
+            "passes": self.passes,
+            "total_reaped": self.total_reaped,
+            "last_reaped": self.last_reaped,
+            "last_duration_ms": self.last_duration * 1000,
+            "last_run": self.last_run,
+            "errors": self.errors,
+        }
+
+_reaper: Optional[SessionReaper] = None
+
+def start_reaper(store: AsyncCacheStore) -> Optional[SessionReaper]:
+    global _reaper
+    if settings.session_reaper_interval <= 0:
+        return None
+    if _reaper is None:
+        _reaper = SessionReaper(store, interval=settings.session_reaper_interval,
+                                batch_size=settings.session_reaper_batch_size,
+                                jitter=settings.session_reaper_jitter)
+        _reaper.start()
+    return _reaper
+
+async def stop_reaper() -> None:
+    global _reaper
+    if _reaper is not None:
+        await _reaper.stop()
+        _reaper = None
+
+def reaper_stats() -> Dict:
+    return _reaper.stats() if _reaper else {"running": False}
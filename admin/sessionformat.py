@@ -0,0 +1,80 @@
+import json
+from abc import ABC, abstractmethod
+from typing import Optional, Dict
+
+from config import settings
+
+# How a session is laid out in Redis under session:<session_id>.
+#
+# "json" is the original format: a string holding the whole session as JSON.
+# "hash" is a Redis hash with one-letter fields and without the session_id,
+# which is already in the key. Small hashes are stored as a listpack, so this
+# takes less memory per session and needs no JSON parsing on lookup.
+#
+# Both formats are always readable, so switching REDIS_SESSION_FORMAT needs no
+# migration step: old entries are read in their own format until they expire.
+# read() and write() only queue or issue redis commands, so they work with both
+# the sync and the asyncio clients and pipelines.
+
+class SessionFormat(ABC):
+    name: str
+
+    @abstractmethod
+    def read(self, client, key: str):
+        pass
+
+    @abstractmethod
+    def write(self, pipe, key: str, session: Dict, ttl: int) -> None:
+        pass
+
+    @abstractmethod
+    def loads(self, session_id: str, raw) -> Optional[Dict]:
+        pass
+
+class JSONSessionFormat(SessionFormat):
+    name = "json"
+
+    def read(self, client, key: str):
+        return client.get(key)
+
+    def write(self, pipe, key: str, session: Dict, ttl: int) -> None:
+        pipe.setex(key, ttl, json.dumps(session))
+
+    def loads(self, session_id: str, raw) -> Optional[Dict]:
+        return json.loads(raw) if raw else None
+
+# The field names are also used by ROTATE_SESSION_SCRIPT in admin/cachestore.py.
+HASH_FIELDS = {"csrf_token": "c", "user_id": "u", "email": "e", "expires": "x"}
+
+class HashSessionFormat(SessionFormat):
+    name = "hash"
+
+    def read(self, client, key: str):
+        return client.hgetall(key)
+
+    def write(self, pipe, key: str, session: Dict, ttl: int) -> None:
+        pipe.hset(key, mapping={field: session[name] for name, field in HASH_FIELDS.items()})
+        pipe.expire(key, ttl)
+
+    def loads(self, session_id: str, raw) -> Optional[Dict]:
+        if not raw:
+            return None
+        return {
+            "session_id": session_id,
+            "csrf_token": raw["c"],
+            "user_id": int(raw["u"]),
+            "email": raw["e"],
+            "expires": int(raw["x"]),
+        }
+
+SESSION_FORMATS = {f.name: f for f in (JSONSessionFormat(), HashSessionFormat())}
+
+def get_session_format(name: Optional[str] = None) -> SessionFormat:
+    name = name or settings.redis_session_format
+    if name not in SESSION_FORMATS:
+        raise ValueError(f"Unknown redis_session_format: {name}")
+    return SESSION_FORMATS[name]
+
+# The format that entries written before a switch of REDIS_SESSION_FORMAT are in.
+def other_session_format(session_format: SessionFormat) -> SessionFormat:
+    return next(f for f in SESSION_FORMATS.values() if f is not session_format)
@@ -0,0 +1,41 @@
+import hmac, hashlib, base64, json
+from typing import Optional, Dict, List
+
+# Self-contained session tokens for CACHE_STORE=token.
+#
+# A token is base64url(claims) + "." + base64url(HMAC-SHA256(key, claims)).
+# Like the starlette_session key ring in admin/middleware.py, tokens are signed
+# with the last key and accepted with any key in the list, so keys can be rotated.
+
+def b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+def b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+def is_token(session_id: str) -> bool:
+    return "." in session_id
+
+class SessionTokenSigner:
+    def __init__(self, secret_keys: List[str]):
+        if not secret_keys:
+            raise ValueError("SESSION_TOKEN_KEYS must be set when CACHE_STORE=token")
+        self.keys = [key.encode() for key in secret_keys]
+
+    def _signature(self, key: bytes, payload: str) -> str:
+        return b64encode(hmac.new(key, payload.encode(), hashlib.sha256).digest())
+
+    def dumps(self, claims: Dict) -> str:
+        payload = b64encode(json.dumps(claims, separators=(",", ":")).encode())
+        return f"{payload}.{self._signature(self.keys[-1], payload)}"
+
+    # Returns the claims of a correctly signed token, expired or not.
+    def loads(self, token: str) -> Optional[Dict]:
+        payload, _, signature = token.partition(".")
+        for key in reversed(self.keys):
+            if hmac.compare_digest(signature, self._signature(key, payload)):
+                try:
+                    return json.loads(b64decode(payload))
+                except ValueError:
+                    return None
+        return None
@@ -1,52 +1,109 @@
+import logging
 from fastapi import Depends, APIRouter, HTTPException
-from sqlalchemy.orm import Session
-from data.db import User, UserBase, get_db
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from data.db import User, UserBase, get_async_db
+from admin.ttlcache import TTLCache
+from admin.cachestore import AsyncCacheStore, get_cache_store
+from admin.events import get_event_bus, user_channel
+from config import settings
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter()
+admin_router = APIRouter()
+
+# Validated UserBase objects keyed by user_id, read by auth.get_current_user.
+user_cache = TTLCache(maxsize=settings.user_cache_size, ttl=settings.user_cache_ttl)
 
-def get_user_by_name(db_session: Session, name: str):
-    return db_session.query(User).filter(User.name==name).first()
+async def get_user_by_name(db_session: AsyncSession, name: str):
+    result = await db_session.execute(select(User).where(User.name==name))
+    return result.scalars().first()
 
-def get_user_by_email(db_session: Session, email: str):
-    return db_session.query(User).filter(User.email==email).first()
+async def get_user_by_email(db_session: AsyncSession, email: str):
+    result = await db_session.execute(select(User).where(User.email==email))
+    return result.scalars().first()
 
-def get_user_by_id(db_session: Session, user_id: int):
-    return db_session.query(User).filter(User.id==user_id).first()
+async def get_user_by_id(db_session: AsyncSession, user_id: int):
+    result = await db_session.execute(select(User).where(User.id==user_id))
+    return result.scalars().first()
 
-async def create(idinfo: str, db_session: Session):
-    print("#### idinfo: ",idinfo)
+async def create(idinfo: str, db_session: AsyncSession):
+    logger.debug("Creating user", extra={"idinfo": idinfo})
     db_user = User(name=idinfo['name'], email=idinfo['email'], picture=idinfo['picture'])
     user = await create_user(db_user, db_session)
     return user
 
+# Revokes all sessions of a user and tells their open tabs.
+async def revoke_sessions(cs: AsyncCacheStore, user_id: int):
+    revoked = await cs.revoke_user_sessions(user_id)
+    await get_event_bus().publish(user_channel(user_id), {"type": "logged_out", "reason": "revoked"})
+    return revoked
+
 @router.get("/users/")
-def read_users(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    return db.query(User).offset(skip).limit(limit).all()
+async def read_users(skip: int = 0, limit: int = 100, db: AsyncSession = Depends(get_async_db)):
+    result = await db.execute(select(User).offset(skip).limit(limit))
+    return result.scalars().all()
 
 @router.get("/user/{name}")
-def read_user_by_name(name: str, db_session: Session = Depends(get_db)):
-    user = get_user_by_name(db_session, name)
+async def read_user_by_name(name: str, db_session: AsyncSession = Depends(get_async_db)):
+    user = await get_user_by_name(db_session, name)
     return user
 
 @router.post("/user/")
-async def create_user(user: UserBase, db_session: Session = Depends(get_db)):
-    db_user = get_user_by_email(db_session, user.email)
+async def create_user(user: UserBase, db_session: AsyncSession = Depends(get_async_db)):
+    db_user = await get_user_by_email(db_session, user.email)
     if db_user:
         return db_user
     if not db_user:
         user_model = User(name=user.name, email=user.email, picture=user.picture)
         db_session.add(user_model)
-        db_session.commit()
-        db_session.refresh(user_model)
-        db_user = get_user_by_email(db_session, user.email)
+        await db_session.commit()
+        await db_session.refresh(user_model)
+        user_cache.invalidate(user_model.id)
+        db_user = await get_user_by_email(db_session, user.email)
         return db_user
 
 @router.delete("/user/{name}")
-def delete_user(name: str, db_session: Session = Depends(get_db)):
-    user = get_user_by_name(db_session, name)
+async def delete_user(name: str, db_session: AsyncSession = Depends(get_async_db),
+                      cs: AsyncCacheStore = Depends(get_cache_store)):
+    user = await get_user_by_name(db_session, name)
     if not user:
         raise HTTPException(status_code=400, detail=f"\'{name}\' does not exist.")
     if user:
-            db_session.delete(user)
-            db_session.commit()
+            await db_session.delete(user)
+            await db_session.commit()
+            user_cache.invalidate(user.id)
+            await revoke_sessions(cs, user.id)
     return {"status": f"\'{name}\' has been deleted."}
+
+async def set_user_disabled(db_session: AsyncSession, cs: AsyncCacheStore, name: str, disabled: bool):
+    user = await get_user_by_name(db_session, name)
+    if not user:
+        raise HTTPException(status_code=400, detail=f"\'{name}\' does not exist.")
+    user.disabled = disabled
+    await db_session.commit()
+    user_cache.invalidate(user.id)
+    if disabled:
+        await revoke_sessions(cs, user.id)
+    return user
+
+@admin_router.put("/user/{name}/disable")
+async def disable_user(name: str, db_session: AsyncSession = Depends(get_async_db),
+                       cs: AsyncCacheStore = Depends(get_cache_store)):
+    return await set_user_disabled(db_session, cs, name, True)
+
+@admin_router.put("/user/{name}/enable")
+async def enable_user(name: str, db_session: AsyncSession = Depends(get_async_db),
+                      cs: AsyncCacheStore = Depends(get_cache_store)):
+    return await set_user_disabled(db_session, cs, name, False)
+
+# Log the user out everywhere.
+@admin_router.delete("/user/{name}/sessions")
+async def revoke_user_sessions(name: str, db_session: AsyncSession = Depends(get_async_db),
+                               cs: AsyncCacheStore = Depends(get_cache_store)):
+    user = await get_user_by_name(db_session, name)
+    if not user:
+        raise HTTPException(status_code=400, detail=f"\'{name}\' does not exist.")
+    revoked = await revoke_sessions(cs, user.id)
+    return {"status": f"{len(revoked)} sessions of \'{name}\' have been revoked."}
@@ -0,0 +1,75 @@
+# Per-page latency of the customer list, OFFSET pagination against the keyset
+# pagination of htmx.content_list_tbody, at increasing depth.
+#
+#   python3 -m bench.customer_pages [rows] [page_size]    # default: 1000000 rows, 100 per page
+#
+# A scratch SQLite file is filled with the given number of customers. For each
+# depth the same page is fetched both ways, and with keyset pagination also
+# rendered through the streaming template path.
+import os, sys, time, asyncio, sqlite3, tempfile, statistics
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+from data.db import Customer
+from htmx.htmx import customers_after, templates
+
+REPEAT = 20
+BATCH = 10000
+
+def populate(path, rows):
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE customer (id INTEGER PRIMARY KEY AUTOINCREMENT, name VARCHAR(30), email VARCHAR(254))")
+    for start in range(0, rows, BATCH):
+        conn.executemany("INSERT INTO customer (name, email) VALUES (?, ?)",
+                         ((f"customer{i}", f"customer{i}@example.com") for i in range(start, min(rows, start + BATCH))))
+    conn.commit()
+    conn.close()
+
+def customers_offset(skip, limit):
+    return select(Customer).order_by(Customer.id).offset(skip).limit(limit)
+
+async def timed(fn):
+    samples = []
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        await fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+async def measure(path, rows, page_size):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+    Session = async_sessionmaker(engine, expire_on_commit=False)
+
+    async with Session() as db:
+        async def offset_page(skip):
+            (await db.execute(customers_offset(skip, page_size))).scalars().all()
+
+        async def keyset_page(after_id):
+            (await db.execute(customers_after(after_id, page_size))).scalars().all()
+
+        async def keyset_render(after_id):
+            customers = await db.stream_scalars(customers_after(after_id, page_size))
+            context = {"customers": customers, "after_id": after_id, "limit": page_size}
+            async for _ in templates.stream("content.list.tbody.j2", context):
+                pass
+
+        print(f"{'depth':>9} {'offset ms':>10} {'keyset ms':>10} {'keyset+stream ms':>17}")
+        for depth in [0, rows // 100, rows // 10, rows // 2, rows - page_size]:
+            # Ids start at 1 with no gaps, so the row at offset n has id n + 1.
+            o = await timed(lambda: offset_page(depth))
+            k = await timed(lambda: keyset_page(depth))
+            r = await timed(lambda: keyset_render(depth))
+            print(f"{depth:>9} {o:>10.3f} {k:>10.3f} {r:>17.3f}")
+    await engine.dispose()
+
+def main(rows, page_size):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "customers.db")
+        populate(path, rows)
+        print(f"{rows} customers, {page_size} per page")
+        asyncio.run(measure(path, rows, page_size))
+
+if __name__ == "__main__":
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    page_size = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    main(rows, page_size)
@@ -0,0 +1,65 @@
+# Latency of /htmx/content.list.search queries (data.search.search_customers)
+# on a large customer table.
+#
+#   python3 -m bench.customer_search [rows]    # default: 3000000
+#
+# A scratch SQLite file is filled with customers generated by data.seed, indexed
+# with the statements of data migration 2, and then queried with terms of
+# different selectivity, as typed one keystroke at a time.
+import os, sys, time, random, asyncio, sqlite3, tempfile, statistics
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+from data.search import CUSTOMER_FTS_STATEMENTS, search_customers
+from data.seed import customer_rows, batched
+
+BATCH = 10000
+REPEAT = 50
+LIMIT = 20
+RANK_LIMIT = 1000
+
+def populate(path, rows):
+    rng = random.Random(1)
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE customer (id INTEGER PRIMARY KEY AUTOINCREMENT, name VARCHAR(30), email VARCHAR(254))")
+    for batch in batched(customer_rows(rng, 1, rows), BATCH):
+        conn.executemany("INSERT INTO customer (name, email) VALUES (:name, :email)", batch)
+    conn.commit()
+    start = time.perf_counter()
+    for statement in CUSTOMER_FTS_STATEMENTS:
+        conn.execute(statement)
+    conn.commit()
+    print(f"indexed {rows} customers in {time.perf_counter() - start:.1f} s")
+    sample = conn.execute("SELECT name, email FROM customer WHERE id = ?", (rows // 2,)).fetchone()
+    conn.close()
+    return sample
+
+async def timed(db, q):
+    samples, found = [], 0
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        found = len(await search_customers(db, q, LIMIT, RANK_LIMIT))
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    return statistics.median(samples), samples[int(len(samples) * 0.99)], found
+
+async def measure(path, queries):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+    Session = async_sessionmaker(engine, expire_on_commit=False)
+    async with Session() as db:
+        print(f"{'query':<36} {'p50 ms':>8} {'p99 ms':>8} {'rows':>5}")
+        for q in queries:
+            p50, p99, found = await timed(db, q)
+            print(f"{q:<36} {p50:>8.2f} {p99:>8.2f} {found:>5}")
+    await engine.dispose()
+
+def main(rows):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "customers.db")
+        sample_name, sample_email = populate(path, rows)
+        first, last = sample_name.split()
+        queries = [first[:2], first[:3], first, f"{first} {last[:3]}", sample_name,
+                   sample_email.split("@")[0], sample_email.split("@")[1], "nomatch"]
+        asyncio.run(measure(path, queries))
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 3000000)
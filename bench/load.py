@@ -0,0 +1,376 @@
+# Throughput and tail latency of the app under a realistic browser mix, per cache store.
+#
+#   python3 -m bench.load                                  # sql and redis, in-process, 50 users, 20 s
+#   python3 -m bench.load --store redis --mode uvicorn --users 200 --duration 60
+#   python3 -m bench.load --compare bench/results/load-20260101-120000.json
+#
+# Every virtual user is a browser tab that loads the navbar, logs in with an ID
+# token, loads the navbar again, then repeatedly does what the tab does every
+# 10 seconds (/auth/refresh_token), checks its session every 6th tick and
+# fetches secret content every 3rd, and finally logs out. There is no think
+# time: the users run back to back, so the numbers are the capacity of one worker.
+#
+# Nothing outside the process is needed:
+#   - ID tokens are signed by a local fake issuer, whose public key is served
+#     in Google's certs format at GOOGLE_CERTS_URL.
+#   - CACHE_STORE=redis (and token) runs on fakeredis (pip install fakeredis lupa).
+#   - data.db and cache.db are scratch files in a temporary directory.
+# Each store runs in its own process, since settings are read at import. With
+# --mode uvicorn the app is served by uvicorn in that process and driven over
+# TCP from this one; in-process, requests go through httpx's ASGI transport.
+#
+# Results are printed and saved as JSON (--out), and --compare prints the
+# change against an earlier result file.
+import os, sys, json, time, random, socket, asyncio, argparse, tempfile, statistics, subprocess, threading, traceback
+import multiprocessing as mp
+from http.cookies import SimpleCookie
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from datetime import datetime
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CLIENT_ID = "load-test-client"
+ISSUER = "https://issuer.load-test.invalid"
+KID = "load-test"
+TICK_SECONDS = 10
+
+# Environment of the app under test; the settings without a default must be set.
+def app_environ(store: str, certs_url: str) -> dict:
+    return {
+        "CACHE_STORE": store,
+        "GOOGLE_CERTS_URL": certs_url,
+        "GOOGLE_ISSUERS": json.dumps([ISSUER]),
+        "GOOGLE_OAUTH2_CLIENT_ID": CLIENT_ID,
+        "ORIGIN_SERVER": "https://testserver",
+        "ADMIN_EMAIL": "admin@load-test.invalid",
+        "SESSION_MAX_AGE": os.environ.get("SESSION_MAX_AGE", "300"),
+        "SESSION_SECRET_KEYS": json.dumps(["load-test-session-key"]),
+        "SESSION_TOKEN_KEYS": json.dumps(["load-test-token-key"]),
+        "REDIS_HOST": "localhost",
+        "REDIS_PORT": "6379",
+        "REDIS_HEALTH_CHECK_INTERVAL": "0",
+    }
+
+# Signs Google-style ID tokens and serves the public key at /certs.
+class FakeIssuer:
+
+    def __init__(self):
+        from cryptography.hazmat.primitives import serialization
+        from cryptography.hazmat.primitives.asymmetric import rsa
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        self.private_pem = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                             serialization.NoEncryption()).decode()
+        public_pem = key.public_key().public_bytes(serialization.Encoding.PEM,
+                                                   serialization.PublicFormat.SubjectPublicKeyInfo).decode()
+        body = json.dumps({KID: public_pem}).encode()
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Cache-Control", "public, max-age=3600")
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.certs_url = f"http://127.0.0.1:{self.server.server_address[1]}/certs"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self) -> None:
+        self.server.shutdown()
+
+def token_signer(private_pem: str):
+    from google.auth import crypt, jwt
+
+    def sign(email: str, name: str, nonce: str) -> str:
+        now = int(time.time())
+        claims = {"iss": ISSUER, "aud": CLIENT_ID, "sub": email, "email": email, "email_verified": True,
+                  "name": name, "picture": None, "nonce": nonce, "iat": now, "exp": now + 3600}
+        return jwt.encode(crypt.RSASigner.from_string(private_pem, key_id=KID), claims).decode()
+    return sign
+
+# Runs the app against scratch databases: the working directory becomes a
+# temporary one holding data/, with links to the templates and images.
+def prepare_app_process(store: str, certs_url: str, workspace: str) -> None:
+    os.environ.update(app_environ(store, certs_url))
+    os.makedirs(os.path.join(workspace, "data"), exist_ok=True)
+    for name in ("templates", "images"):
+        link = os.path.join(workspace, name)
+        if not os.path.exists(link):
+            os.symlink(os.path.join(REPO, name), link)
+    os.chdir(workspace)
+    sys.path.insert(0, REPO)
+    if store in ("redis", "token"):
+        use_fakeredis()
+
+def use_fakeredis() -> None:
+    import redis, redis.asyncio, fakeredis, fakeredis.aioredis
+    from admin import cachestore
+    server = fakeredis.FakeServer()
+
+    def pool_kwargs(connection_class):
+        kwargs = cachestore.redis_pool_kwargs()
+        kwargs.pop("host", None)
+        kwargs.pop("port", None)
+        return dict(kwargs, connection_class=connection_class, server=server)
+
+    cachestore.create_redis_pool = lambda: redis.BlockingConnectionPool(**pool_kwargs(fakeredis.FakeConnection))
+    cachestore.create_async_redis_pool = lambda: redis.asyncio.BlockingConnectionPool(
+        **pool_kwargs(fakeredis.aioredis.FakeConnection))
+
+class Recorder:
+
+    def __init__(self, warmup_until: float):
+        self.warmup_until = warmup_until
+        self.samples = {}
+        self.errors = {}
+        self.started = None
+
+    def add(self, name: str, started: float, ok: bool) -> None:
+        if started < self.warmup_until:
+            return
+        if self.started is None:
+            self.started = started
+        self.samples.setdefault(name, []).append((time.perf_counter() - started) * 1000)
+        if not ok:
+            self.errors[name] = self.errors.get(name, 0) + 1
+
+# One browser tab. Cookies are kept here rather than in httpx, so that the
+# Secure ones are also sent over plain http.
+class VirtualUser:
+
+    def __init__(self, client, recorder: Recorder, sign, number: int, rng: random.Random):
+        from admin.auth import hash_email
+        self.client = client
+        self.recorder = recorder
+        self.sign = sign
+        self.rng = rng
+        self.name = f"load{number}"
+        self.email = f"load{number}@seed.example.com"
+        self.user_token = hash_email(self.email)
+        self.cookies = {}
+
+    async def request(self, name: str, method: str, url: str, expect=(200,), **kwargs):
+        headers = {"hx-request": "true", **kwargs.pop("headers", {})}
+        if self.cookies:
+            headers["cookie"] = "; ".join(f"{k}={v}" for k, v in self.cookies.items())
+        started = time.perf_counter()
+        try:
+            response = await self.client.request(method, url, headers=headers, **kwargs)
+        except Exception:
+            self.recorder.add(name, started, False)
+            raise
+        self.recorder.add(name, started, response.status_code in expect)
+        for header in response.headers.get_list("set-cookie"):
+            for key, morsel in SimpleCookie(header).items():
+                if morsel["max-age"] == "0" or not morsel.value:
+                    self.cookies.pop(key, None)
+                else:
+                    self.cookies[key] = morsel.value
+        return response
+
+    async def visit(self, ticks: int) -> None:
+        navbar = await self.request("navbar_anonymous", "GET", "/auth/auth_navbar")
+        nonce = navbar.text.split('data-nonce="', 1)[1].split('"', 1)[0]
+        credential = self.sign(self.email, self.name, nonce)
+        await self.request("login", "POST", "/auth/login", content=f"credential={credential}",
+                           headers={"content-type": "application/x-www-form-urlencoded"})
+        await self.request("navbar", "GET", "/auth/auth_navbar")
+        for tick in range(1, ticks + 1):
+            await self.request("refresh_token", "GET", "/auth/refresh_token",
+                               headers={"x-csrf-token": self.cookies.get("csrf_token", ""),
+                                        "x-user-token": self.user_token})
+            if tick % 6 == 0:
+                await self.request("check", "GET", "/auth/check", expect=(204,))
+            if tick % 3 == 0:
+                secret = self.rng.choice(["content.secret1", "content.secret2"])
+                await self.request("secret", "GET", f"/htmx/{secret}")
+        await self.request("logout", "GET", "/auth/logout")
+        self.cookies.clear()
+
+async def drive(client, sign, users: int, duration: float, warmup: float, ticks: int, seed: int) -> dict:
+    start = time.perf_counter()
+    deadline = start + warmup + duration
+    recorder = Recorder(start + warmup)
+    failures = []
+
+    async def run_user(number: int):
+        user = VirtualUser(client, recorder, sign, number, random.Random(f"{seed}:{number}"))
+        while time.perf_counter() < deadline:
+            try:
+                await user.visit(ticks)
+            except Exception as e:
+                failures.append(repr(e))
+                user.cookies.clear()
+                await asyncio.sleep(0.1)
+
+    await asyncio.gather(*(run_user(i) for i in range(users)))
+    return summarize(recorder, time.perf_counter() - (recorder.started or start), failures)
+
+def percentile(samples, q: int) -> float:
+    if len(samples) < 2:
+        return samples[0] if samples else float("nan")
+    return statistics.quantiles(samples, n=100, method="inclusive")[q - 1]
+
+def summarize(recorder: Recorder, elapsed: float, failures) -> dict:
+    endpoints = {}
+    everything = []
+    for name, samples in sorted(recorder.samples.items()):
+        everything.extend(samples)
+        endpoints[name] = {
+            "requests": len(samples),
+            "errors": recorder.errors.get(name, 0),
+            "rps": round(len(samples) / elapsed, 1),
+            "p50_ms": round(percentile(samples, 50), 2),
+            "p99_ms": round(percentile(samples, 99), 2),
+            "max_ms": round(max(samples), 2),
+        }
+    total = {
+        "requests": len(everything),
+        "errors": sum(recorder.errors.values()),
+        "rps": round(len(everything) / elapsed, 1),
+        "p50_ms": round(percentile(everything, 50), 2) if everything else None,
+        "p99_ms": round(percentile(everything, 99), 2) if everything else None,
+    }
+    return {"elapsed": round(elapsed, 2), "endpoints": endpoints, "total": total,
+            "failures": len(failures), "first_failures": failures[:5]}
+
+def in_process(store, certs_url, private_pem, args, queue):
+    try:
+        queue.put(run_in_process(store, certs_url, private_pem, args))
+    except BaseException:
+        queue.put({"error": traceback.format_exc()})
+        raise
+
+def run_in_process(store, certs_url, private_pem, args) -> dict:
+    with tempfile.TemporaryDirectory() as workspace:
+        prepare_app_process(store, certs_url, workspace)
+        import httpx
+        import main
+
+        async def run():
+            async with main.app.router.lifespan_context(main.app):
+                transport = httpx.ASGITransport(app=main.app)
+                async with httpx.AsyncClient(transport=transport, base_url="https://testserver") as client:
+                    return await drive(client, token_signer(private_pem), args.users, args.duration,
+                                       args.warmup, args.ticks, args.seed)
+        return asyncio.run(run())
+
+def uvicorn_server(store, certs_url, port):
+    with tempfile.TemporaryDirectory() as workspace:
+        prepare_app_process(store, certs_url, workspace)
+        import uvicorn
+        import main
+        uvicorn.run(main.app, host="127.0.0.1", port=port, log_level="warning", access_log=False)
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def under_uvicorn(ctx, store, certs_url, private_pem, args) -> dict:
+    import httpx
+    port = free_port()
+    server = ctx.Process(target=uvicorn_server, args=(store, certs_url, port))
+    server.start()
+    try:
+        for _ in range(300):
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+        else:
+            raise RuntimeError(f"uvicorn did not start on port {port}")
+        # The driver imports admin.auth for hash_email, which needs the settings.
+        os.environ.update(app_environ(store, certs_url))
+        sys.path.insert(0, REPO)
+
+        async def run():
+            limits = httpx.Limits(max_connections=args.users, max_keepalive_connections=args.users)
+            async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", limits=limits, timeout=30) as client:
+                return await drive(client, token_signer(private_pem), args.users, args.duration,
+                                   args.warmup, args.ticks, args.seed)
+        return asyncio.run(run())
+    finally:
+        server.terminate()
+        server.join()
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except Exception:
+        return "unknown"
+
+def print_result(store: str, result: dict, baseline: dict = None) -> None:
+    print(f"\n{store}: {result['total']['requests']} requests in {result['elapsed']} s, "
+          f"{result['total']['rps']} req/s, {result['total']['errors']} errors, {result['failures']} failed visits")
+    compare = " " * 3 + f"{'Δp50':>7} {'Δp99':>7} {'Δrps':>7}" if baseline else ""
+    print(f"{'endpoint':<18} {'requests':>9} {'errors':>7} {'rps':>8} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8}{compare}")
+    rows = dict(result["endpoints"], total=result["total"])
+    for name, row in rows.items():
+        line = (f"{name:<18} {row['requests']:>9} {row['errors']:>7} {row['rps']:>8} "
+                f"{row['p50_ms']:>8} {row['p99_ms']:>8} {row.get('max_ms', ''):>8}")
+        old = baseline and (baseline["endpoints"].get(name) if name != "total" else baseline["total"])
+        if old:
+            line += "   " + " ".join(f"{change(old[key], row[key]):>7}" for key in ("p50_ms", "p99_ms", "rps"))
+        print(line)
+    for failure in result["first_failures"]:
+        print("  failure:", failure)
+
+def change(old, new) -> str:
+    if not old or new is None:
+        return "-"
+    return f"{(new - old) / old * 100:+.0f}%"
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(prog="python3 -m bench.load", description="Load test the app per cache store.")
+    parser.add_argument("--store", nargs="+", choices=["sql", "redis", "token"], default=["sql", "redis"])
+    parser.add_argument("--mode", choices=["inprocess", "uvicorn"], default="inprocess")
+    parser.add_argument("--users", type=int, default=50, help="concurrent virtual users")
+    parser.add_argument("--duration", type=float, default=20.0, help="measured seconds per store")
+    parser.add_argument("--warmup", type=float, default=3.0, help="seconds before measuring starts")
+    parser.add_argument("--ticks", type=int, default=12,
+                        help=f"refresh_token polls per visit, one per {TICK_SECONDS} s of tab time")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", help="result file; default: bench/results/load-<time>.json")
+    parser.add_argument("--compare", help="earlier result file to compare with")
+    args = parser.parse_args(argv)
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+
+    ctx = mp.get_context("spawn")
+    issuer = FakeIssuer()
+    results = {}
+    try:
+        for store in args.store:
+            print(f"Running {store} ({args.mode}, {args.users} users, {args.duration} s)...", flush=True)
+            if args.mode == "uvicorn":
+                results[store] = under_uvicorn(ctx, store, issuer.certs_url, issuer.private_pem, args)
+            else:
+                queue = ctx.Queue()
+                process = ctx.Process(target=in_process, args=(store, issuer.certs_url, issuer.private_pem, args, queue))
+                process.start()
+                results[store] = queue.get()
+                process.join()
+                if "error" in results[store]:
+                    sys.exit(f"{store} failed:\n{results[store]['error']}")
+            print_result(store, results[store], baseline.get(store))
+    finally:
+        issuer.close()
+
+    out = args.out or os.path.join(REPO, "bench", "results", f"load-{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w") as f:
+        json.dump({"revision": git_revision(), "time": datetime.now().isoformat(timespec="seconds"),
+                   "config": vars(args), "results": results}, f, indent=2)
+    print(f"\nSaved {out}")
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,272 @@
+# Microbenchmarks of the cache stores and of the auth helpers on every request.
+#
+#   python3 -m bench.micro                              # store sizes 1000 10000 100000
+#   python3 -m bench.micro --sizes 1000 --ops 200 --compare bench/results/micro-20260101-120000.json
+#   python3 -m bench.micro --redis-url redis://localhost:6379/15    # a real server; the db is FLUSHed
+#
+# Stores are found through the CacheStore and AsyncCacheStore ABCs: every
+# concrete subclass is built from the fixtures below, matched by constructor
+# parameter name (session_factory, connection_pool, remote, signer, ...), so a
+# new backend is benchmarked without changes here as long as its parameters
+# have fixtures. Stores with a required parameter without one are listed as skipped.
+#
+# For each store size, the backends are preloaded with that many sessions
+# (data.seed) and each store is timed on:
+#   create_session, get_session (hits on the created ones), get_session_miss,
+#   delete_session, and cleanup_sessions after 1% of the sessions expired.
+# The auth helpers of admin/auth.py are timed on their own, in batches.
+#
+# Without --redis-url, Redis is fakeredis, which is slower than a real server
+# but shows the client-side cost. Results are saved as JSON like bench.load.
+import os, sys, json, time, random, asyncio, inspect, argparse, tempfile, statistics, timeit
+from datetime import datetime
+from sqlalchemy import select, update
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from config import settings
+from data.db import Sessions, CacheStoreBase, create_sqlite_engine, create_async_sqlite_engine
+from data.migrate import upgrade, CACHE_MIGRATIONS
+from data.seed import seed_sql_sessions, seed_redis_sessions
+from admin.cachestore import CacheStore, AsyncCacheStore, AsyncRedisCacheStore, redis_pool_kwargs
+from admin.sessiontoken import SessionTokenSigner
+from bench.load import REPO, change, git_revision, percentile
+
+STORE_OPS = ["create_session", "get_session", "get_session_miss", "delete_session", "cleanup_sessions"]
+CLEANUP_REPEAT = 10
+USERS = [(user_id, f"bench{user_id}@seed.example.com") for user_id in range(1, 1001)]
+
+def store_classes():
+    found, pending = [], [CacheStore, AsyncCacheStore]
+    while pending:
+        for cls in pending.pop(0).__subclasses__():
+            pending.append(cls)
+            if not inspect.isabstract(cls) and cls not in found:
+                found.append(cls)
+    return found
+
+class SQLBackend:
+
+    def __init__(self, workdir: str):
+        path = os.path.join(workdir, "cache.db")
+        self.engine = create_sqlite_engine(f"sqlite:///{path}")
+        upgrade(self.engine, CacheStoreBase.metadata, CACHE_MIGRATIONS)
+        self.async_engine = create_async_sqlite_engine(f"sqlite+aiosqlite:///{path}")
+
+    def fixtures(self, is_async: bool) -> dict:
+        if is_async:
+            return {"session_factory": lambda: async_sessionmaker(autoflush=False, expire_on_commit=False,
+                                                                  bind=self.async_engine)}
+        return {"session_factory": lambda: sessionmaker(autocommit=False, autoflush=False, bind=self.engine)}
+
+    def preload(self, rng: random.Random, count: int) -> None:
+        seed_sql_sessions(rng, USERS, count, 10000, engine=self.engine)
+
+    def expire(self, count: int) -> None:
+        live = select(Sessions.id).where(Sessions.expires > int(time.time())).limit(count)
+        with self.engine.begin() as conn:
+            conn.execute(update(Sessions).where(Sessions.id.in_(live)).values(expires=0))
+
+    async def close(self) -> None:
+        self.engine.dispose()
+        await self.async_engine.dispose()
+
+class RedisBackend:
+
+    # Pools are configured like create_redis_pool, on another server.
+    def __init__(self, url: str = None):
+        import redis, redis.asyncio
+        kwargs = redis_pool_kwargs()
+        for name in ("host", "port", "db"):
+            kwargs.pop(name)
+        if url:
+            self.pool = lambda: redis.BlockingConnectionPool.from_url(url, **kwargs)
+            self.async_pool = lambda: redis.asyncio.BlockingConnectionPool.from_url(url, **kwargs)
+        else:
+            import fakeredis, fakeredis.aioredis
+            server = fakeredis.FakeServer()
+            self.pool = lambda: redis.BlockingConnectionPool(
+                connection_class=fakeredis.FakeConnection, server=server, **kwargs)
+            self.async_pool = lambda: redis.asyncio.BlockingConnectionPool(
+                connection_class=fakeredis.aioredis.FakeConnection, server=server, **kwargs)
+        self.client = redis.Redis(connection_pool=self.pool())
+        self.client.flushdb()
+
+    def fixtures(self, is_async: bool) -> dict:
+        if is_async:
+            return {"connection_pool": self.async_pool,
+                    "remote": lambda: AsyncRedisCacheStore(connection_pool=self.async_pool())}
+        return {"connection_pool": self.pool}
+
+    def preload(self, rng: random.Random, count: int) -> None:
+        seed_redis_sessions(self.client, rng, USERS, count, 10000)
+
+    def expire(self, count: int) -> None:
+        # Redis expires sessions itself; cleanup_sessions has nothing to do.
+        pass
+
+    async def close(self) -> None:
+        self.client.flushdb()
+        self.client.close()
+
+# Fixtures that do not depend on a backend.
+def common_fixtures() -> dict:
+    return {
+        "signer": lambda: SessionTokenSigner(["bench-token-key"]),
+        "maxsize": lambda: settings.session_local_cache_size,
+        "ttl": lambda: settings.session_local_cache_ttl or 30.0,
+    }
+
+# Returns the store, or the name of the first parameter without a fixture.
+def build(cls, fixtures: dict):
+    kwargs = {}
+    for name, param in inspect.signature(cls).parameters.items():
+        if name in fixtures:
+            kwargs[name] = fixtures[name]()
+        elif param.default is inspect.Parameter.empty:
+            return None, name
+    return cls(**kwargs), None
+
+async def call(fn, *args):
+    result = fn(*args)
+    if inspect.isawaitable(result):
+        result = await result
+    return result
+
+async def timed(samples: list, fn, *args):
+    start = time.perf_counter()
+    result = await call(fn, *args)
+    samples.append((time.perf_counter() - start) * 1e6)
+    return result
+
+async def bench_store(store, backends, ops: int, size: int, rng: random.Random) -> dict:
+    samples = {op: [] for op in STORE_OPS}
+    session_ids = []
+    for _ in range(ops):
+        user_id, email = rng.choice(USERS)
+        session = await timed(samples["create_session"], store.create_session, user_id, email)
+        session_ids.append(session["session_id"])
+    for session_id in session_ids:
+        await timed(samples["get_session"], store.get_session, session_id)
+    for _ in range(ops):
+        await timed(samples["get_session_miss"], store.get_session, f"missing-{rng.getrandbits(64)}")
+    for session_id in session_ids:
+        await timed(samples["delete_session"], store.delete_session, session_id)
+    for _ in range(CLEANUP_REPEAT):
+        for backend in backends:
+            backend.expire(max(1, size // 100))
+        await timed(samples["cleanup_sessions"], store.cleanup_sessions)
+    return {op: summarize(values) for op, values in samples.items()}
+
+def summarize(samples) -> dict:
+    return {
+        "calls": len(samples),
+        "p50_us": round(percentile(samples, 50), 1),
+        "p99_us": round(percentile(samples, 99), 1),
+        "ops_per_s": round(1e6 / statistics.mean(samples)),
+    }
+
+async def bench_size(size: int, args, skipped: dict) -> dict:
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        backends = [SQLBackend(workdir), RedisBackend(args.redis_url)]
+        for number, backend in enumerate(backends):
+            backend.preload(random.Random(f"{args.seed}:preload:{number}"), size)
+        for cls in store_classes():
+            is_async = issubclass(cls, AsyncCacheStore)
+            fixtures = common_fixtures()
+            for backend in backends:
+                fixtures.update(backend.fixtures(is_async))
+            store, missing = build(cls, fixtures)
+            if store is None:
+                skipped[cls.__name__] = f"no fixture for parameter '{missing}'"
+                continue
+            if is_async:
+                await store.start()
+            try:
+                results[cls.__name__] = await bench_store(store, backends, args.ops, size,
+                                                          random.Random(f"{args.seed}:{cls.__name__}"))
+            finally:
+                await call(store.close)
+        for backend in backends:
+            await backend.close()
+    return results
+
+def bench_helpers(number: int) -> dict:
+    from fastapi import Response
+    from admin.auth import hash_email, csrf_verify, user_verify, new_cookie
+    from data.db import User, UserBase
+
+    email = "bench1@seed.example.com"
+    session = {"session_id": "s" * 86, "csrf_token": "c" * 43, "user_id": 1, "email": email,
+               "expires": int(time.time()) + settings.session_max_age}
+    user = User(id=1, name="bench1", email=email, disabled=False, admin=False, password=None,
+                picture="/img/unknown-person-icon.png")
+    user_token = hash_email(email)
+    cases = {
+        "hash_email": lambda: hash_email(email),
+        "csrf_verify": lambda: csrf_verify(session["csrf_token"], session),
+        "user_verify": lambda: user_verify(user_token, session),
+        "new_cookie": lambda: new_cookie(Response(), session),
+        "UserBase.model_validate": lambda: UserBase.model_validate(user),
+    }
+    results = {}
+    for name, fn in cases.items():
+        per_call = [t / number * 1e6 for t in timeit.Timer(fn).repeat(repeat=7, number=number)]
+        results[name] = {"calls": number * 7, "p50_us": round(statistics.median(per_call), 2),
+                         "best_us": round(min(per_call), 2), "ops_per_s": round(1e6 / statistics.median(per_call))}
+    return results
+
+def print_table(title: str, rows: dict, baseline: dict, keys) -> None:
+    print(f"\n{title}")
+    header = f"{'':<26}" + "".join(f"{key:>12}" for key in keys)
+    if baseline:
+        header += f"{'Δp50':>8}"
+    print(header)
+    for name, row in rows.items():
+        line = f"{name:<26}" + "".join(f"{row[key]:>12}" for key in keys)
+        old = (baseline or {}).get(name)
+        if old:
+            line += f"{change(old['p50_us'], row['p50_us']):>8}"
+        print(line)
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(prog="python3 -m bench.micro", description="Cache store and auth helper microbenchmarks.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000], help="preloaded sessions")
+    parser.add_argument("--ops", type=int, default=500, help="calls per store operation")
+    parser.add_argument("--helper-calls", type=int, default=20000, help="calls per helper batch")
+    parser.add_argument("--redis-url", help="benchmark a real Redis server instead of fakeredis; its db is flushed")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", help="result file; default: bench/results/micro-<time>.json")
+    parser.add_argument("--compare", help="earlier result file to compare with")
+    args = parser.parse_args(argv)
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    stores, skipped = {}, {}
+    for size in args.sizes:
+        print(f"Benchmarking stores with {size} sessions...", flush=True)
+        stores[size] = asyncio.run(bench_size(size, args, skipped))
+    helpers = bench_helpers(args.helper_calls)
+
+    for size, results in stores.items():
+        for name, rows in results.items():
+            old = baseline.get("stores", {}).get(str(size), {}).get(name)
+            print_table(f"{name}, {size} sessions (µs)", rows, old, ["p50_us", "p99_us", "ops_per_s"])
+    print_table("auth helpers (µs per call)", helpers, baseline.get("helpers"), ["p50_us", "best_us", "ops_per_s"])
+    for name, reason in skipped.items():
+        print(f"skipped {name}: {reason}")
+
+    out = args.out or os.path.join(REPO, "bench", "results", f"micro-{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w") as f:
+        json.dump({"revision": git_revision(), "time": datetime.now().isoformat(timespec="seconds"),
+                   "config": vars(args), "redis": "real" if args.redis_url else "fakeredis",
+                   "stores": stores, "helpers": helpers, "skipped": skipped}, f, indent=2)
+    print(f"\nSaved {out}")
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,102 @@
+# Memory and lookup cost of the Redis session layouts in admin/sessionformat.py.
+#
+#   python3 -m bench.session_encoding [sessions]    # default: 1000000
+#
+# Needs the Redis server from .env (REDIS_HOST/REDIS_PORT). For each layout the
+# given number of sessions is written under bench:session:* with pipelining, and
+# the used_memory delta per session is reported together with the client side
+# payload size. Then random sessions are looked up, timing the round trip and the
+# decoding separately. The bench keys are removed afterwards.
+import sys, time, random, secrets, statistics
+import redis
+
+from admin.cachestore import create_redis_pool
+from admin.sessionformat import SESSION_FORMATS
+
+PREFIX = "bench:session:"
+BATCH = 10000
+LOOKUPS = 10000
+TTL = 3600
+
+def make_session(i):
+    return {
+        "session_id": secrets.token_urlsafe(64),
+        "csrf_token": secrets.token_urlsafe(32),
+        "user_id": i,
+        "email": f"user{i}@example.com",
+        "expires": int(time.time()) + TTL,
+    }
+
+def payload_bytes(session_format, session):
+    # What goes over the wire and into the value, not counting the key.
+    pipe = redis.Redis().pipeline()
+    session_format.write(pipe, "k", session, TTL)
+    args = pipe.command_stack[0][0]
+    args = args[3:] if args[0] == "SETEX" else args[2:]
+    return sum(len(str(a).encode()) for a in args)
+
+def used_memory(client):
+    try:
+        return client.info("memory")["used_memory"]
+    except redis.ResponseError:
+        return None
+
+def populate(client, session_format, count):
+    session_ids = []
+    pipe = client.pipeline(transaction=False)
+    for i in range(count):
+        session = make_session(i)
+        session_ids.append(session["session_id"])
+        session_format.write(pipe, PREFIX + session["session_id"], session, TTL)
+        if len(pipe) >= BATCH:
+            pipe.execute()
+    pipe.execute()
+    return session_ids
+
+def lookups(client, session_format, session_ids):
+    read_us, decode_us = [], []
+    for session_id in random.sample(session_ids, min(LOOKUPS, len(session_ids))):
+        start = time.perf_counter()
+        raw = session_format.read(client, PREFIX + session_id)
+        mid = time.perf_counter()
+        session_format.loads(session_id, raw)
+        end = time.perf_counter()
+        read_us.append((mid - start) * 1e6)
+        decode_us.append((end - mid) * 1e6)
+    return read_us, decode_us
+
+def cleanup(client):
+    for keys in batched(client.scan_iter(match=PREFIX + "*", count=BATCH)):
+        client.unlink(*keys)
+
+def batched(keys):
+    batch = []
+    for key in keys:
+        batch.append(key)
+        if len(batch) == BATCH:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def main(count):
+    client = redis.Redis(connection_pool=create_redis_pool())
+    cleanup(client)
+    sample = make_session(0)
+    print(f"{count} sessions")
+    print(f"{'format':<6} {'payload B':>10} {'memory B/session':>17} {'read p50/p99 us':>18} {'decode p50/p99 us':>19}")
+    for session_format in SESSION_FORMATS.values():
+        before = used_memory(client)
+        session_ids = populate(client, session_format, count)
+        after = used_memory(client)
+        per_session = f"{(after - before) / count:.0f}" if before is not None else "n/a"
+
+        read_us, decode_us = lookups(client, session_format, session_ids)
+        read = statistics.quantiles(read_us, n=100)
+        decode = statistics.quantiles(decode_us, n=100)
+        print(f"{session_format.name:<6} {payload_bytes(session_format, sample):>10} {per_session:>17}"
+              f" {read[49]:>8.1f}/{read[98]:<9.1f} {decode[49]:>9.2f}/{decode[98]:<9.2f}")
+        cleanup(client)
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
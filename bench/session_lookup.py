@@ -0,0 +1,87 @@
+# Session and user lookup latency before and after the indexes added by data/migrate.py.
+#
+#   python3 -m bench.session_lookup [rows ...]    # default: 10000 100000 1000000
+#
+# Each size gets a scratch SQLite file with the pre-migration (unindexed) schema,
+# is timed, upgraded in place with data.migrate.upgrade, and timed again.
+import os, sys, time, random, secrets, sqlite3, tempfile, statistics
+from sqlalchemy import create_engine, MetaData
+
+from data.migrate import upgrade, CACHE_MIGRATIONS, DATA_MIGRATIONS
+
+LEGACY_SCHEMA = [
+    "CREATE TABLE sessions (id INTEGER PRIMARY KEY AUTOINCREMENT, session_id VARCHAR(254), csrf_token VARCHAR(254),"
+    " user_id INTEGER, email VARCHAR(254), expires INTEGER)",
+    "CREATE TABLE user (id INTEGER PRIMARY KEY AUTOINCREMENT, name VARCHAR(30), email VARCHAR(254),"
+    " disabled BOOLEAN, admin BOOLEAN, password VARCHAR(254), picture VARCHAR(1024))",
+]
+
+LOOKUPS = 200
+
+def populate(path, rows):
+    conn = sqlite3.connect(path)
+    for ddl in LEGACY_SCHEMA:
+        conn.execute(ddl)
+    now = int(time.time())
+    session_ids = []
+    batch = []
+    for i in range(rows):
+        session_id = secrets.token_urlsafe(64)
+        session_ids.append(session_id)
+        batch.append((session_id, secrets.token_urlsafe(32), i, f"user{i}@example.com", now + random.randint(-600, 600)))
+        if len(batch) == 10000:
+            conn.executemany("INSERT INTO sessions (session_id, csrf_token, user_id, email, expires) VALUES (?,?,?,?,?)", batch)
+            batch = []
+    if batch:
+        conn.executemany("INSERT INTO sessions (session_id, csrf_token, user_id, email, expires) VALUES (?,?,?,?,?)", batch)
+    conn.executemany("INSERT INTO user (name, email, disabled, admin) VALUES (?,?,0,0)",
+                     ((f"user{i}", f"user{i}@example.com") for i in range(rows)))
+    conn.commit()
+    conn.close()
+    return session_ids, now
+
+def timed(conn, sql, params_list):
+    samples = []
+    for params in params_list:
+        start = time.perf_counter()
+        conn.execute(sql, params).fetchall()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples), max(samples)
+
+def measure(path, session_ids, rows, now):
+    conn = sqlite3.connect(path)
+    picks = random.sample(session_ids, min(LOOKUPS, len(session_ids)))
+    users = [random.randrange(rows) for _ in range(LOOKUPS)]
+    results = {
+        "get_session": timed(conn, "SELECT * FROM sessions WHERE session_id = ?", [(p,) for p in picks]),
+        "expired_batch": timed(conn, "SELECT id FROM sessions WHERE expires <= ? LIMIT 1000", [(now - 500,)] * 20),
+        "user_by_email": timed(conn, "SELECT * FROM user WHERE email = ?", [(f"user{u}@example.com",) for u in users]),
+        "user_by_name": timed(conn, "SELECT * FROM user WHERE name = ?", [(f"user{u}",) for u in users]),
+    }
+    conn.close()
+    return results
+
+def main(sizes):
+    print(f"{'rows':>9} {'query':<14} {'before p50/max ms':>20} {'after p50/max ms':>20} {'speedup':>8}")
+    for rows in sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "bench.db")
+            session_ids, now = populate(path, rows)
+            before = measure(path, session_ids, rows, now)
+
+            engine = create_engine(f"sqlite:///{path}")
+            upgrade(engine, MetaData(), CACHE_MIGRATIONS)
+            with engine.begin() as conn:
+                # Both tables live in one scratch file, so reset the version before the data migrations.
+                conn.exec_driver_sql("PRAGMA user_version = 0")
+            # Only the lookup indexes; later data migrations need tables (customer) the legacy schema lacks.
+            upgrade(engine, MetaData(), DATA_MIGRATIONS[:1])
+            engine.dispose()
+
+            after = measure(path, session_ids, rows, now)
+            for query in before:
+                b, a = before[query], after[query]
+                print(f"{rows:>9} {query:<14} {b[0]:>9.3f}/{b[1]:<10.3f} {a[0]:>9.3f}/{a[1]:<10.3f} {b[0]/a[0] if a[0] else 0:>7.0f}x")
+
+if __name__ == "__main__":
+    main([int(n) for n in sys.argv[1:]] or [10000, 100000, 1000000])
@@ -0,0 +1,90 @@
+# Concurrent login/refresh/logout traffic against cache.db from several worker processes,
+# once per SQLite profile, to compare lock contention of the rollback journal and WAL.
+#
+#   python3 -m bench.sqlite_contention [workers] [seconds]    # default: 8 workers, 10 seconds
+#
+# Every worker runs SQLCacheStore on a shared scratch database in a loop of
+# login (create_session), three reads (auth_navbar, check, secret content),
+# refresh (get + rotate_session) and logout (delete_session).
+import os, sys, time, tempfile, statistics
+import multiprocessing as mp
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.exc import OperationalError
+
+from data.db import CacheStoreBase, create_sqlite_engine
+from admin.cachestore import SQLCacheStore
+
+PROFILES = ["default", "wal"]
+
+def worker(uri, profile, seconds, worker_id, queue):
+    engine = create_sqlite_engine(uri, profile=profile, pool_size=1, max_overflow=0)
+    cs = SQLCacheStore(sessionmaker(autocommit=False, autoflush=False, bind=engine))
+    latencies = {"login": [], "read": [], "refresh": [], "logout": []}
+    errors = 0
+    deadline = time.perf_counter() + seconds
+
+    def timed(name, fn, *args):
+        nonlocal errors
+        start = time.perf_counter()
+        try:
+            result = fn(*args)
+        except OperationalError:
+            errors += 1
+            return None
+        latencies[name].append((time.perf_counter() - start) * 1000)
+        return result
+
+    while time.perf_counter() < deadline:
+        session = timed("login", cs.create_session, worker_id, f"user{worker_id}@example.com")
+        if not session:
+            continue
+        for _ in range(3):
+            timed("read", cs.get_session, session["session_id"])
+
+        def refresh(old):
+            cs.get_session(old["session_id"])
+            return cs.rotate_session(old["session_id"])
+        session = timed("refresh", refresh, session) or session
+        timed("logout", cs.delete_session, session["session_id"])
+    engine.dispose()
+    queue.put((latencies, errors))
+
+def run(profile, workers, seconds):
+    with tempfile.TemporaryDirectory() as tmp:
+        uri = f"sqlite:///{os.path.join(tmp, 'cache.db')}"
+        engine = create_sqlite_engine(uri, profile=profile)
+        CacheStoreBase.metadata.create_all(bind=engine)
+        engine.dispose()
+
+        queue = mp.Queue()
+        procs = [mp.Process(target=worker, args=(uri, profile, seconds, i, queue)) for i in range(workers)]
+        for p in procs:
+            p.start()
+        results = [queue.get() for _ in procs]
+        for p in procs:
+            p.join()
+
+    merged = {name: [] for name in results[0][0]}
+    for latencies, _ in results:
+        for name, samples in latencies.items():
+            merged[name].extend(samples)
+    errors = sum(e for _, e in results)
+    return merged, errors
+
+def percentile(samples, q):
+    if not samples:
+        return float("nan")
+    return statistics.quantiles(samples, n=100)[q - 1] if len(samples) > 1 else samples[0]
+
+def main(workers, seconds):
+    print(f"{workers} workers, {seconds} s per profile")
+    print(f"{'profile':<8} {'op':<8} {'ops/s':>8} {'p50 ms':>8} {'p99 ms':>8}")
+    for profile in PROFILES:
+        merged, errors = run(profile, workers, seconds)
+        for name, samples in merged.items():
+            print(f"{profile:<8} {name:<8} {len(samples)/seconds:>8.0f} {percentile(samples, 50):>8.2f} {percentile(samples, 99):>8.2f}")
+        print(f"{profile:<8} {'locked':<8} {errors:>8} errors")
+
+if __name__ == "__main__":
+    args = [int(a) for a in sys.argv[1:]]
+    main(args[0] if args else 8, args[1] if len(args) > 1 else 10)
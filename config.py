@@ -9,6 +9,90 @@ class Settings(BaseSettings):
     redis_host: str
     redis_port: int
 
+    # Keys for the starlette_session cookie, oldest first; new cookies are signed with the last one.
+    # Every worker and node must use the same list.
+    session_secret_keys: list[str] = []
+
+    # Keys for the signed session tokens of CACHE_STORE=token, oldest first, shared by all workers.
+    session_token_keys: list[str] = []
+
+    # Shared connection pool for the cache store, created once per worker.
+    redis_max_connections: int = 50
+    redis_pool_timeout: float = 5.0
+    redis_socket_timeout: float = 5.0
+    redis_socket_connect_timeout: float = 2.0
+    redis_health_check_interval: int = 30
+    cache_db_pool_size: int = 5
+    cache_db_max_overflow: int = 10
+    cache_db_pool_timeout: float = 30.0
+    cache_db_pool_recycle: int = 3600
+
+    # Layout of sessions in Redis: "hash" (compact) or "json". Entries in the other layout stay readable.
+    redis_session_format: str = "hash"
+
+    # SQLite tuning for data.db and cache.db: "wal" or "default" (rollback journal).
+    sqlite_profile: str = "wal"
+    sqlite_synchronous: str = "NORMAL"
+    sqlite_busy_timeout: int = 5000
+    sqlite_mmap_size: int = 268435456
+    sqlite_cache_size: int = -65536
+    data_db_pool_size: int = 5
+    data_db_max_overflow: int = 10
+    data_db_pool_timeout: float = 30.0
+
+    # Per-worker session cache in front of Redis, invalidated over pub/sub. 0 disables it.
+    session_local_cache_ttl: float = 0.0
+    session_local_cache_size: int = 10000
+
+    # Background removal of expired sessions. 0 disables the reaper. The jitter is
+    # capped at half the interval.
+    session_reaper_interval: float = 60.0
+    session_reaper_batch_size: int = 500
+    session_reaper_jitter: float = 10.0
+
+    # Seconds a rotated session keeps pointing at its successor, so concurrent refreshes get the same one.
+    session_rotation_grace: int = 10
+
+    # Server-Sent Events at /auth/events: heartbeat and client reconnect delay in seconds, queued events per tab.
+    session_events_heartbeat: float = 30.0
+    session_events_retry: float = 5.0
+    session_events_queue_size: int = 16
+
+    # Google ID token verification. The certs url and issuers can point at a local fake issuer for load tests.
+    google_certs_url: str = "https://www.googleapis.com/oauth2/v1/certs"
+    google_issuers: list[str] = ["accounts.google.com", "https://accounts.google.com"]
+    google_certs_default_max_age: int = 3600
+    google_certs_min_refresh: int = 60
+
+    # Per-worker cache of validated users in front of get_current_user.
+    user_cache_size: int = 1024
+    user_cache_ttl: float = 30.0
+
+    # /htmx/content.list.tbody: largest page, and pages larger than the threshold are streamed.
+    content_list_max_limit: int = 1000
+    content_list_stream_threshold: int = 100
+    # Rows returned by /htmx/content.list.search, and the most matches that are still ranked.
+    content_search_limit: int = 20
+    content_search_rank_limit: int = 1000
+
+    # /crud bulk export and import: rows fetched per cursor round trip, rows upserted per transaction.
+    bulk_export_chunk_size: int = 1000
+    bulk_import_batch_size: int = 500
+
+    # Server-Timing response headers and Prometheus metrics at /metrics. With a token set,
+    # /metrics requires "Authorization: Bearer <token>"; without one, an admin login.
+    metrics_enabled: bool = True
+    metrics_server_timing: bool = True
+    metrics_token: str = ""
+    # Requests kept with their timings for /debug/slow_requests.
+    metrics_recent_requests: int = 1000
+
+    # Sampling profiler at /debug/profile: seconds between samples, longest profile,
+    # and the number of profiled requests kept.
+    profile_interval: float = 0.005
+    profile_max_seconds: int = 60
+    profile_recent_requests: int = 20
+
     class Config:
         env_file = ".env"
 
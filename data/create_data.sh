@@ -4,10 +4,8 @@ source .env
 
 DB=data/data.db
 
-for i in {001..080} ; do
-echo "insert into customer(name,email) values('a$i','a$i@example.com')"  \
-| sqlite3 $DB
-done
+# More customers, users and sessions: python3 -m data.seed --help
+python3 -m data.seed --customers 80
 
 for i in {01..01} ; do
 echo "insert into user(name,email,disabled,admin,password,picture) values('${ADMIN_EMAIL}','${ADMIN_EMAIL}','0','1','fakehashed_admin$i','/img/admin_icon.webp')" | sqlite3 $DB
@@ -1,20 +1,68 @@
 # database.py
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy import Boolean
+from config import settings
+
+# SQLite performance profiles, applied to every new connection.
+# "wal" lets readers in other workers proceed while a session is being written;
+# "default" keeps SQLite's rollback journal, e.g. for comparison in benchmarks.
+def sqlite_profile_pragmas(profile: str) -> dict:
+    if profile == "wal":
+        return {
+            "journal_mode": "WAL",
+            "synchronous": settings.sqlite_synchronous,
+            "busy_timeout": settings.sqlite_busy_timeout,
+            "mmap_size": settings.sqlite_mmap_size,
+            "cache_size": settings.sqlite_cache_size,
+        }
+    elif profile == "default":
+        return {"journal_mode": "DELETE", "synchronous": "FULL", "busy_timeout": settings.sqlite_busy_timeout}
+    raise ValueError(f"Unknown sqlite_profile: {profile}")
+
+def set_sqlite_pragmas(engine, profile: str):
+    pragmas = sqlite_profile_pragmas(profile)
+
+    @event.listens_for(engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+    return engine
+
+def data_pool_kwargs() -> dict:
+    return dict(
+        pool_size=settings.data_db_pool_size,
+        max_overflow=settings.data_db_max_overflow,
+        pool_timeout=settings.data_db_pool_timeout,
+        pool_pre_ping=True)
+
+def create_sqlite_engine(uri: str, profile: str | None = None, **kwargs):
+    engine = create_engine(uri, connect_args={"check_same_thread": False}, echo=False, **kwargs)
+    return set_sqlite_pragmas(engine, profile or settings.sqlite_profile)
+
+def create_async_sqlite_engine(uri: str, profile: str | None = None, **kwargs):
+    engine = create_async_engine(uri, echo=False, **kwargs)
+    set_sqlite_pragmas(engine.sync_engine, profile or settings.sqlite_profile)
+    return engine
 
 DATA_STORE_URI = "sqlite:///data/data.db"
 
-DataStore = create_engine(
-    DATA_STORE_URI, connect_args={"check_same_thread": False}, echo=False
-)
+DataStore = create_sqlite_engine(DATA_STORE_URI, **data_pool_kwargs())
 SessionDATA = sessionmaker(autocommit=False, autoflush=False, bind=DataStore)
 
+# Async engine for the request handlers; the sync one above is kept for scripts.
+ASYNC_DATA_STORE_URI = "sqlite+aiosqlite:///data/data.db"
+
+AsyncDataStore = create_async_sqlite_engine(ASYNC_DATA_STORE_URI, **data_pool_kwargs())
+AsyncSessionDATA = async_sessionmaker(autoflush=False, expire_on_commit=False, bind=AsyncDataStore)
+
 CACHE_STORE_URI = "sqlite:///data/cache.db"
+ASYNC_CACHE_STORE_URI = "sqlite+aiosqlite:///data/cache.db"
 
-CacheStore = create_engine(
-    CACHE_STORE_URI, connect_args={"check_same_thread": False}, echo=False
-)
+CacheStore = create_sqlite_engine(CACHE_STORE_URI)
 SessionCACHE = sessionmaker(autocommit=False, autoflush=False, bind=CacheStore)
 
 DataStoreBase = declarative_base()
@@ -27,13 +75,13 @@ class Customer(DataStoreBase):
     __tablename__ = 'customer'
     id = Column('id', Integer, primary_key = True, autoincrement = True)
     name = Column('name', String(30))
-    email = Column('email', String(254))
+    email = Column('email', String(254), unique=True, index=True)
 
 class User(DataStoreBase):
     __tablename__ = 'user'
     id = Column('id', Integer, primary_key = True, autoincrement = True)
-    name = Column('name', String(30))
-    email = Column('email', String(254))
+    name = Column('name', String(30), index=True)
+    email = Column('email', String(254), unique=True, index=True)
     disabled = Column('disabled', Boolean, default=False)
     admin = Column('admin', Boolean, default=False)
     password = Column('password', String(254))
@@ -42,11 +90,19 @@ class User(DataStoreBase):
 class Sessions(CacheStoreBase):
     __tablename__ = 'sessions'
     id = Column('id', Integer, primary_key = True, autoincrement = True)
-    session_id = Column('session_id', String(254))
+    session_id = Column('session_id', String(254), unique=True, index=True)
     csrf_token = Column('csrf_token', String(254))
-    user_id = Column('user_id', Integer)
+    user_id = Column('user_id', Integer, index=True)
     email = Column('email', String(254))
-    expires = Column('expires', Integer)
+    expires = Column('expires', Integer, index=True)
+
+# Maps a rotated session to its successor for a short grace period, so that a
+# second concurrent refresh of the same old cookie gets the same new session.
+class SessionRotation(CacheStoreBase):
+    __tablename__ = 'session_rotations'
+    old_session_id = Column('old_session_id', String(254), primary_key = True)
+    new_session_id = Column('new_session_id', String(254))
+    expires = Column('expires', Integer, index=True)
 
 # schemas.py
 from pydantic import BaseModel, EmailStr, HttpUrl
@@ -79,9 +135,6 @@ class SessionBase(BaseModel):
     class Config:
         from_attributes = True
 
-DataStoreBase.metadata.create_all(bind=DataStore)
-CacheStoreBase.metadata.create_all(bind=CacheStore)
-
 def get_db():
     ds = SessionDATA()
     try:
@@ -89,6 +142,10 @@ def get_db():
     finally:
         ds.close()
 
+async def get_async_db():
+    async with AsyncSessionDATA() as ds:
+        yield ds
+
 def get_cache():
     cs = SessionCACHE()
     try:
@@ -0,0 +1,121 @@
+# Versioned schema migrations for data.db and cache.db.
+#
+# The schema version of each database is kept in SQLite's PRAGMA user_version.
+# upgrade() creates missing tables from the models, then applies every migration
+# newer than the stored version, in order. Statements must be idempotent
+# (IF NOT EXISTS etc.) so that a fresh database created from the models, which
+# already has everything, can be stamped by running them as no-ops. A statement
+# may also be a function of the connection, for checks plain SQL can not make.
+#
+#   python3 -m data.migrate           # upgrade both databases
+#   python3 -m data.migrate status    # show current and latest versions
+#   python3 -m data.migrate rebuild-search    # re-index customers for full-text search
+import logging, sys
+from sqlalchemy import text
+
+from data.db import DataStore, CacheStore, DataStoreBase, CacheStoreBase
+from data import search
+
+logger = logging.getLogger(__name__)
+
+class MigrationError(Exception):
+    pass
+
+# Fails a migration that adds a unique index on rows that already break it,
+# naming the duplicated values, instead of the IntegrityError of CREATE INDEX.
+def require_unique(table: str, column: str, shown: int = 10):
+    def check(conn) -> None:
+        duplicates = conn.execute(text(
+            f"SELECT {column}, COUNT(*) FROM {table} WHERE {column} IS NOT NULL "
+            f"GROUP BY {column} HAVING COUNT(*) > 1 ORDER BY {column}")).all()
+        if duplicates:
+            values = ", ".join(f"{value!r} ({count} rows)" for value, count in duplicates[:shown])
+            more = f" and {len(duplicates) - shown} more" if len(duplicates) > shown else ""
+            raise MigrationError(f"Can not add a unique index on {table}.{column}: {len(duplicates)} "
+                                 f"duplicated values: {values}{more}. Remove or change the duplicates and restart.")
+    return check
+
+DATA_MIGRATIONS = [
+    (1, "index user.email (unique) and user.name", [
+        require_unique("user", "email"),
+        "CREATE UNIQUE INDEX IF NOT EXISTS ix_user_email ON user (email)",
+        "CREATE INDEX IF NOT EXISTS ix_user_name ON user (name)",
+    ]),
+    (2, "customer_fts full-text index with sync triggers", search.CUSTOMER_FTS_STATEMENTS),
+    (3, "index customer.email (unique) for bulk import upserts", [
+        require_unique("customer", "email"),
+        "CREATE UNIQUE INDEX IF NOT EXISTS ix_customer_email ON customer (email)",
+    ]),
+]
+
+CACHE_MIGRATIONS = [
+    (1, "index sessions.session_id (unique) and sessions.expires", [
+        "CREATE UNIQUE INDEX IF NOT EXISTS ix_sessions_session_id ON sessions (session_id)",
+        "CREATE INDEX IF NOT EXISTS ix_sessions_expires ON sessions (expires)",
+    ]),
+    (2, "index sessions.user_id for revoke_user_sessions", [
+        "CREATE INDEX IF NOT EXISTS ix_sessions_user_id ON sessions (user_id)",
+    ]),
+    (3, "session_rotations table for rotate_session", [
+        "CREATE TABLE IF NOT EXISTS session_rotations (old_session_id VARCHAR(254) NOT NULL, "
+        "new_session_id VARCHAR(254), expires INTEGER, PRIMARY KEY (old_session_id))",
+        "CREATE INDEX IF NOT EXISTS ix_session_rotations_expires ON session_rotations (expires)",
+    ]),
+]
+
+DATABASES = {
+    "data": (DataStore, DataStoreBase.metadata, DATA_MIGRATIONS),
+    "cache": (CacheStore, CacheStoreBase.metadata, CACHE_MIGRATIONS),
+}
+
+def current_version(conn) -> int:
+    return conn.execute(text("PRAGMA user_version")).scalar()
+
+def latest_version(migrations) -> int:
+    return migrations[-1][0] if migrations else 0
+
+def upgrade(engine, metadata, migrations) -> int:
+    metadata.create_all(bind=engine)
+    with engine.connect() as conn:
+        version = current_version(conn)
+    for number, description, statements in migrations:
+        if number <= version:
+            continue
+        logger.info("Applying migration %s to %s: %s", number, engine.url.database, description)
+        # One transaction per migration: pysqlite commits DDL on its own, so a
+        # failing migration must not roll back the data statements and version
+        # of the ones before it.
+        with engine.begin() as conn:
+            for statement in statements:
+                if callable(statement):
+                    statement(conn)
+                else:
+                    conn.execute(text(statement))
+            # PRAGMA does not take bound parameters.
+            conn.execute(text(f"PRAGMA user_version = {int(number)}"))
+        version = number
+    return version
+
+def upgrade_all() -> None:
+    for engine, metadata, migrations in DATABASES.values():
+        upgrade(engine, metadata, migrations)
+
+def status() -> None:
+    for name, (engine, _, migrations) in DATABASES.items():
+        with engine.connect() as conn:
+            print(f"{name}: {engine.url.database} version {current_version(conn)}, latest {latest_version(migrations)}")
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    command = sys.argv[1] if len(sys.argv) > 1 else "upgrade"
+    if command == "upgrade":
+        upgrade_all()
+        status()
+    elif command == "status":
+        status()
+    elif command == "rebuild-search":
+        search.rebuild(DataStore)
+        print(f"Rebuilt customer_fts in {DataStore.url.database}")
+    else:
+        print(f"Unknown command: {command}. Use upgrade, status or rebuild-search.")
+        sys.exit(1)
@@ -0,0 +1,66 @@
+# Full-text search over customers with SQLite FTS5.
+#
+# customer_fts is an external content table: it indexes customer.name and
+# customer.email without storing a copy of them, and is kept in sync by the
+# triggers below (data migration 2). The prefix option adds index entries for
+# 2 and 3 character prefixes, so that short search-as-you-type terms stay fast.
+#
+#   python3 -m data.migrate rebuild-search    # re-index all customers
+import re
+from sqlalchemy import select, table, column, text, literal_column
+
+from data.db import Customer
+
+CUSTOMER_FTS_STATEMENTS = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS customer_fts USING fts5("
+    "name, email, content='customer', content_rowid='id', prefix='2 3')",
+    "CREATE TRIGGER IF NOT EXISTS customer_fts_insert AFTER INSERT ON customer BEGIN "
+    "INSERT INTO customer_fts (rowid, name, email) VALUES (new.id, new.name, new.email); END",
+    "CREATE TRIGGER IF NOT EXISTS customer_fts_delete AFTER DELETE ON customer BEGIN "
+    "INSERT INTO customer_fts (customer_fts, rowid, name, email) VALUES ('delete', old.id, old.name, old.email); END",
+    "CREATE TRIGGER IF NOT EXISTS customer_fts_update AFTER UPDATE ON customer BEGIN "
+    "INSERT INTO customer_fts (customer_fts, rowid, name, email) VALUES ('delete', old.id, old.name, old.email); "
+    "INSERT INTO customer_fts (rowid, name, email) VALUES (new.id, new.name, new.email); END",
+    # Index the rows that existed before the triggers.
+    "INSERT INTO customer_fts (customer_fts) VALUES ('rebuild')",
+]
+
+customer_fts = table("customer_fts", column("rowid"), column("customer_fts"))
+
+# Turns what the user typed into an FTS5 query. Every word must match, and
+# the last one, still being typed, as a prefix. Words are quoted, so FTS5
+# operators and syntax in the input are searched for literally.
+def match_query(q: str) -> str:
+    words = [f'"{word}"' for word in re.findall(r"\w+", q)]
+    if words:
+        words[-1] += "*"
+    return " ".join(words)
+
+def matching_ids(q: str, limit: int):
+    # In rowid order, so FTS5 stops after limit matches.
+    return select(customer_fts.c.rowid).where(customer_fts.c.customer_fts.match(match_query(q))).limit(limit)
+
+def ranked_customers(q: str, limit: int):
+    ranked = (select(customer_fts.c.rowid.label("id"), literal_column("rank").label("rank"))
+              .where(customer_fts.c.customer_fts.match(match_query(q)))
+              .order_by(literal_column("rank")).limit(limit).subquery())
+    return select(Customer).join(ranked, Customer.id == ranked.c.id).order_by(ranked.c.rank)
+
+# Best matches first. Ranking scores every match, which takes hundreds of ms
+# for a short prefix over millions of rows, so only queries with at most
+# rank_limit matches are ranked. Broader ones return their first matches by id
+# until more is typed.
+async def search_customers(db, q: str, limit: int, rank_limit: int):
+    if not match_query(q):
+        return []
+    ids = (await db.execute(matching_ids(q, rank_limit + 1))).scalars().all()
+    if len(ids) > rank_limit:
+        query = select(Customer).where(Customer.id.in_(ids[:limit])).order_by(Customer.id)
+    else:
+        query = ranked_customers(q, limit)
+    return (await db.execute(query)).scalars().all()
+
+def rebuild(engine) -> None:
+    with engine.begin() as conn:
+        conn.execute(text("INSERT INTO customer_fts (customer_fts) VALUES ('rebuild')"))
+        conn.execute(text("INSERT INTO customer_fts (customer_fts) VALUES ('optimize')"))
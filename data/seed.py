@@ -0,0 +1,182 @@
+# Bulk test data for data.db, cache.db and Redis, built on the data/db.py models.
+#
+#   python3 -m data.seed --customers 1000000 --users 10000 --sessions 100000
+#   python3 -m data.seed --sessions 100000 --store redis --reset --seed 7
+#
+# Rows are generated lazily and inserted with executemany in batches, each table
+# in a single transaction (the customer_fts index is rebuilt after it); Redis
+# sessions are written through a pipeline, one round trip per batch. The same
+# --seed on the same database gives the same names, emails and session ids, so
+# benchmark runs are comparable. Session expiry is relative to the current time,
+# so that seeded sessions are valid.
+#
+# Seeded users have @seed.example.com emails. --reset removes them and their
+# sessions, and all customers, before seeding.
+import sys, time, random, base64, argparse
+from itertools import islice
+from sqlalchemy import insert, delete, select, func, text
+
+from data.db import DataStore, CacheStore, DataStoreBase, CacheStoreBase, Customer, User, Sessions
+from data.migrate import upgrade, DATA_MIGRATIONS, CACHE_MIGRATIONS
+from data import search
+from config import settings
+
+FIRST = ["James", "Mary", "Robert", "Patricia", "John", "Jennifer", "Michael", "Linda", "David", "Elizabeth",
+         "William", "Barbara", "Richard", "Susan", "Joseph", "Jessica", "Thomas", "Sarah", "Hiroshi", "Yuki",
+         "Kenji", "Aiko", "Lars", "Ingrid", "Pierre", "Amelie", "Carlos", "Lucia", "Ahmed", "Fatima"]
+CUSTOMER_DOMAINS = ["example.com", "example.org", "mail.example.net", "corp.example.jp"]
+USER_DOMAIN = "seed.example.com"
+
+def person_name(rng: random.Random) -> str:
+    last = "".join(rng.choice("bcdfghjklmnprstvwz") + rng.choice("aeiou") for _ in range(rng.randint(2, 4))).title()
+    return f"{rng.choice(FIRST)} {last}"
+
+# Same length and alphabet as secrets.token_urlsafe(nbytes), but reproducible.
+def token(rng: random.Random, nbytes: int) -> str:
+    return base64.urlsafe_b64encode(rng.randbytes(nbytes)).rstrip(b"=").decode()
+
+def batched(rows, size: int):
+    rows = iter(rows)
+    while batch := list(islice(rows, size)):
+        yield batch
+
+def next_id(conn, model) -> int:
+    return (conn.execute(select(func.max(model.id))).scalar() or 0) + 1
+
+def customer_rows(rng: random.Random, start: int, count: int):
+    for n in range(start, start + count):
+        name = person_name(rng)
+        yield {"name": name, "email": f"{name.replace(' ', '.').lower()}{n}@{rng.choice(CUSTOMER_DOMAINS)}"}
+
+def user_rows(rng: random.Random, start: int, count: int):
+    for n in range(start, start + count):
+        name = person_name(rng)
+        yield {"name": name, "email": f"{name.replace(' ', '.').lower()}{n}@{USER_DOMAIN}",
+               "disabled": rng.random() < 0.05, "admin": False, "picture": None}
+
+def session_rows(rng: random.Random, users, count: int):
+    now = int(time.time())
+    for _ in range(count):
+        user_id, email = rng.choice(users)
+        yield {"session_id": token(rng, 64), "csrf_token": token(rng, 32), "user_id": user_id, "email": email,
+               "expires": now + rng.randint(settings.session_max_age // 10, settings.session_max_age)}
+
+def seed_customers(rng: random.Random, count: int, batch_size: int, reset: bool) -> None:
+    # customer_fts is rebuilt once at the end instead of row by row by the triggers.
+    # pysqlite runs DDL outside of the transaction, so dropping the triggers commits
+    # on its own; they are recreated and the index rebuilt even if the insert fails.
+    with DataStore.begin() as conn:
+        conn.execute(text("DROP TRIGGER IF EXISTS customer_fts_insert"))
+        conn.execute(text("DROP TRIGGER IF EXISTS customer_fts_delete"))
+    try:
+        with DataStore.begin() as conn:
+            if reset:
+                conn.execute(delete(Customer))
+            for batch in batched(customer_rows(rng, next_id(conn, Customer), count), batch_size):
+                conn.execute(insert(Customer), batch)
+    finally:
+        with DataStore.begin() as conn:
+            for statement in search.CUSTOMER_FTS_STATEMENTS:
+                conn.execute(text(statement))
+
+def seeded_users(conn):
+    return conn.execute(select(User.id, User.email).where(User.email.like(f"%@{USER_DOMAIN}")).order_by(User.id)).all()
+
+def seed_users(rng: random.Random, count: int, batch_size: int, reset: bool) -> None:
+    with DataStore.begin() as conn:
+        if reset:
+            conn.execute(delete(User).where(User.email.like(f"%@{USER_DOMAIN}")))
+        for batch in batched(user_rows(rng, next_id(conn, User), count), batch_size):
+            conn.execute(insert(User), batch)
+
+def reset_sql_sessions() -> None:
+    with CacheStore.begin() as conn:
+        conn.execute(delete(Sessions).where(Sessions.email.like(f"%@{USER_DOMAIN}")))
+
+def seed_sql_sessions(rng: random.Random, users, count: int, batch_size: int, engine=CacheStore) -> None:
+    with engine.begin() as conn:
+        for batch in batched(session_rows(rng, users, count), batch_size):
+            conn.execute(insert(Sessions), batch)
+
+def redis_client():
+    import redis
+    from admin.cachestore import create_redis_pool
+    return redis.Redis(connection_pool=create_redis_pool())
+
+def reset_redis_sessions(client, users, batch_size: int) -> None:
+    for batch in batched(users, batch_size):
+        pipe = client.pipeline(transaction=False)
+        for user_id, _ in batch:
+            pipe.smembers(f"user_sessions:{user_id}")
+        members = pipe.execute()
+        for (user_id, _), session_ids in zip(batch, members):
+            pipe.delete(f"user_sessions:{user_id}", *(f"session:{session_id}" for session_id in session_ids))
+        pipe.execute()
+
+# Same keys as RedisCacheStore.create_session, in the REDIS_SESSION_FORMAT layout.
+def seed_redis_sessions(client, rng: random.Random, users, count: int, batch_size: int) -> None:
+    from admin.sessionformat import get_session_format
+    session_format = get_session_format()
+    now = int(time.time())
+    for batch in batched(session_rows(rng, users, count), batch_size):
+        pipe = client.pipeline(transaction=False)
+        for session in batch:
+            ttl = session["expires"] - now
+            session_format.write(pipe, f"session:{session['session_id']}", session, ttl)
+            pipe.sadd(f"user_sessions:{session['user_id']}", session["session_id"])
+            pipe.expire(f"user_sessions:{session['user_id']}", settings.session_max_age)
+        pipe.execute()
+
+def timed(label: str, fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    print(f"{label} in {time.perf_counter() - start:.1f} s")
+    return result
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(prog="python3 -m data.seed", description="Seed customers, users and sessions.")
+    parser.add_argument("--customers", type=int, default=0)
+    parser.add_argument("--users", type=int, default=0)
+    parser.add_argument("--sessions", type=int, default=0, help="sessions of random seeded users")
+    parser.add_argument("--store", choices=["sql", "redis"], default=None,
+                        help="where sessions go; default: CACHE_STORE")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--batch", type=int, default=10000, help="rows per executemany or pipeline")
+    parser.add_argument("--reset", action="store_true")
+    args = parser.parse_args(argv)
+
+    store = args.store or settings.cache_store
+    if args.sessions and store not in ("sql", "redis"):
+        parser.error(f"sessions of CACHE_STORE={store} are not stored; use --store sql or --store redis")
+
+    upgrade(DataStore, DataStoreBase.metadata, DATA_MIGRATIONS)
+    upgrade(CacheStore, CacheStoreBase.metadata, CACHE_MIGRATIONS)
+    # One generator per table, so that e.g. the users do not depend on --customers.
+    customer_rng, user_rng, session_rng = (random.Random(f"{args.seed}:{name}") for name in ("customer", "user", "session"))
+
+    if args.reset:
+        with DataStore.connect() as conn:
+            users = seeded_users(conn)
+        if store == "redis":
+            timed(f"Removed Redis sessions of {len(users)} seeded users", reset_redis_sessions, redis_client(), users, args.batch)
+        else:
+            timed("Removed SQL sessions of seeded users", reset_sql_sessions)
+
+    if args.customers or args.reset:
+        timed(f"Seeded {args.customers} customers", seed_customers, customer_rng, args.customers, args.batch, args.reset)
+    if args.users or args.reset:
+        timed(f"Seeded {args.users} users", seed_users, user_rng, args.users, args.batch, args.reset)
+
+    if args.sessions:
+        with DataStore.connect() as conn:
+            users = seeded_users(conn)
+        if not users:
+            parser.error("no seeded users to create sessions for; add --users")
+        if store == "redis":
+            timed(f"Seeded {args.sessions} Redis sessions", seed_redis_sessions,
+                  redis_client(), session_rng, users, args.sessions, args.batch)
+        else:
+            timed(f"Seeded {args.sessions} SQL sessions", seed_sql_sessions, session_rng, users, args.sessions, args.batch)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,13 +1,16 @@
-from typing import Optional
-from fastapi import APIRouter, Request, HTTPException, status, Depends, Header
-from fastapi.templating import Jinja2Templates
-from fastapi.responses import HTMLResponse
+from typing import Optional, Annotated
+from fastapi import APIRouter, Request, HTTPException, status, Depends, Header, Query
+from admin.metrics import TimedTemplates
+from fastapi.responses import HTMLResponse, StreamingResponse
 
-from sqlalchemy.orm import Session
-from data.db import Customer, get_db
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from data.db import Customer, AsyncSessionDATA, get_async_db
+from data.search import search_customers
+from config import settings
 
 router = APIRouter()
-templates = Jinja2Templates(directory='templates')
+templates = TimedTemplates(directory='templates')
 
 @router.get("/content.top", response_class=HTMLResponse)
 async def spa_content(request: Request, hx_request: Optional[str] = Header(None)):
@@ -21,26 +24,61 @@ async def spa_content(request: Request, hx_request: Optional[str] = Header(None)
 
 # HTMX Incremental table update
 @router.get("/content.list", response_class=HTMLResponse)
-async def content_list(request: Request, skip: int = 0, limit: int = 2, hx_request: Optional[str] = Header(None)):
+async def content_list(request: Request, limit: int = 2, hx_request: Optional[str] = Header(None)):
     if not hx_request:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Only HX request is allowed to this end point."
             )
-    context = {"request": request, "skip_next": skip, "limit": limit, "title": "Incremental hx-get demo"}
+    context = {"request": request, "after_id": 0, "limit": limit, "title": "Incremental hx-get demo"}
     return templates.TemplateResponse("content.list.j2", context)
 
+# Keyset pagination: the page starts after the last id of the previous one, so
+# every page is an index range scan on the primary key however deep it is.
+def customers_after(after_id: int, limit: int):
+    return select(Customer).where(Customer.id > after_id).order_by(Customer.id).limit(limit)
+
 @router.get("/content.list.tbody", response_class=HTMLResponse)
-async def content_list_tbody(request: Request, skip: int = 0, limit: int = 1, hx_request: Optional[str] = Header(None), db: Session = Depends(get_db)):
+async def content_list_tbody(request: Request, after_id: int = 0,
+                             limit: Annotated[int, Query(ge=1, le=settings.content_list_max_limit)] = 1,
+                             hx_request: Optional[str] = Header(None)):
     if not hx_request:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Only HX request is allowed to this end point."
             )
-    customers = db.query(Customer).offset(skip).limit(limit).all()
-    context = {"request": request, "skip_next": skip+limit, "limit": limit, 'customers': customers}
+    context = {"request": request, "after_id": after_id, "limit": limit}
+    if limit > settings.content_list_stream_threshold:
+        return StreamingResponse(stream_customers("content.list.tbody.j2", context, customers_after(after_id, limit)),
+                                 media_type="text/html")
+    async with AsyncSessionDATA() as db:
+        result = await db.execute(customers_after(after_id, limit))
+        context["customers"] = result.scalars().all()
     return templates.TemplateResponse("content.list.tbody.j2", context)
 
+# Rows are rendered as they are read from the database cursor. The session is
+# opened here, not taken from get_async_db, because dependencies are closed
+# before a streaming response is sent; the route does not use get_async_db, so
+# each request holds one connection either way.
+async def stream_customers(name: str, context: dict, query):
+    async with AsyncSessionDATA() as db:
+        customers = await db.stream_scalars(query)
+        async for chunk in templates.stream(name, {**context, "customers": customers}):
+            yield chunk
+
+# HTMX active search: called on debounced keystrokes, returns the best matching rows.
+@router.get("/content.list.search", response_class=HTMLResponse)
+async def content_list_search(request: Request, q: Annotated[str, Query(max_length=100)] = "",
+                              hx_request: Optional[str] = Header(None), db: AsyncSession = Depends(get_async_db)):
+    if not hx_request:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Only HX request is allowed to this end point."
+            )
+    customers = await search_customers(db, q, settings.content_search_limit, settings.content_search_rank_limit)
+    context = {"request": request, "q": q, "customers": customers}
+    return templates.TemplateResponse("content.list.search.j2", context)
+
 @router.get("/admin.login", response_class=HTMLResponse)
 async def admin_login(request: Request, hx_request: Optional[str] = Header(None)):
     if not hx_request:
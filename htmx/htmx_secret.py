@@ -1,11 +1,11 @@
 from typing import Optional
 from fastapi import APIRouter, Request, HTTPException, status, Header
-from fastapi.templating import Jinja2Templates
+from admin.metrics import TimedTemplates
 from fastapi.responses import HTMLResponse
 from config import settings
 
 router = APIRouter()
-templates = Jinja2Templates(directory='templates')
+templates = TimedTemplates(directory='templates')
 
 # Normal Response function
 @router.get("/content.secret1", response_class=HTMLResponse)
@@ -1,9 +1,9 @@
 from fastapi import APIRouter, Request
-from fastapi.templating import Jinja2Templates
+from admin.metrics import TimedTemplates
 from fastapi.responses import HTMLResponse
 
 router = APIRouter()
-templates = Jinja2Templates(directory='templates')
+templates = TimedTemplates(directory='templates')
 
 @router.get("/", response_class=HTMLResponse)
 async def spa_top(request: Request):
@@ -1,19 +1,41 @@
 from fastapi import FastAPI, Request, Depends
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import RedirectResponse
+from contextlib import asynccontextmanager
 
-from admin import debug, user, auth, admin
+from admin import debug, user, auth, admin, cachestore, reaper, idtoken, events, bulk, metrics, profiler
 from htmx import htmx, htmx_secret, spa
 from images import image
+from data import migrate
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    migrate.upgrade_all()
+    store = await cachestore.open_cache_store()
+    reaper.start_reaper(store)
+    await idtoken.cert_cache.start()
+    await events.open_event_bus()
+    yield
+    await events.close_event_bus()
+    await idtoken.cert_cache.stop()
+    await reaper.stop_reaper()
+    await cachestore.close_cache_store()
 
 app = FastAPI(
     swagger_ui_parameters={"persistAuthorization": True},
-    docs_url=None, redoc_url=None, openapi_url = None
+    docs_url=None, redoc_url=None, openapi_url = None,
+    lifespan=lifespan,
     )
 
-import os
-from starlette.middleware.sessions import SessionMiddleware
-app.add_middleware(SessionMiddleware, secret_key=os.urandom(24),
+import os, logging
+from config import settings
+from admin.middleware import KeyRingSessionMiddleware
+session_secret_keys = settings.session_secret_keys
+if not session_secret_keys:
+    # A per-process random key only works with a single worker.
+    logging.getLogger(__name__).warning("SESSION_SECRET_KEYS is not set. Using a random key; run a single worker only.")
+    session_secret_keys = [os.urandom(24).hex()]
+app.add_middleware(KeyRingSessionMiddleware, secret_keys=session_secret_keys,
                    https_only=True,same_site="Strict",
                    max_age=86400,session_cookie="starlette_session")
 
@@ -66,6 +88,27 @@ app.include_router(
     dependencies=[Depends(auth.is_authenticated)],
 )
 
+app.include_router(
+    user.admin_router,
+    prefix="/crud",
+    tags=["CRUD"],
+    dependencies=[Depends(auth.is_authenticated_admin)],
+)
+
+app.include_router(
+    bulk.router,
+    prefix="/crud",
+    tags=["CRUD"],
+    dependencies=[Depends(auth.is_authenticated)],
+)
+
+app.include_router(
+    bulk.admin_router,
+    prefix="/crud",
+    tags=["CRUD"],
+    dependencies=[Depends(auth.is_authenticated_admin)],
+)
+
 # docs and redocs
 app.include_router(
     admin.doc_router,
@@ -82,6 +125,16 @@ app.include_router(
     include_in_schema=False,
 )
 
+if settings.metrics_enabled:
+    metrics.instrument_engines()
+    # Without a scraper token, /metrics is only for a logged-in admin.
+    app.include_router(
+        metrics.router,
+        tags=["Metrics"],
+        include_in_schema=False,
+        dependencies=[] if settings.metrics_token else [Depends(auth.is_authenticated_admin)],
+    )
+
 origins = [
     "http://localhost:3000",
     "http://v200.h.ccmp.jp:4000",
@@ -94,3 +147,9 @@ app.add_middleware(
         allow_methods=["*"],
         allow_headers=["*"],
     )
+
+app.add_middleware(profiler.ProfileMiddleware)
+
+# Added last, so that it is the outermost middleware and times the whole request.
+if settings.metrics_enabled:
+    app.add_middleware(metrics.MetricsMiddleware)
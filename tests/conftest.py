@@ -0,0 +1,13 @@
+import os
+
+# config.Settings has required fields without defaults; give tests a minimal environment.
+for name, value in {
+    "ORIGIN_SERVER": "http://localhost:3000",
+    "GOOGLE_OAUTH2_CLIENT_ID": "test-client-id",
+    "ADMIN_EMAIL": "admin@example.com",
+    "SESSION_MAX_AGE": "3600",
+    "CACHE_STORE": "sql",
+    "REDIS_HOST": "localhost",
+    "REDIS_PORT": "6379",
+}.items():
+    os.environ.setdefault(name, value)
@@ -0,0 +1,121 @@
+import asyncio, json, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from google.auth import crypt, jwt
+
+from admin import idtoken
+from admin.idtoken import GoogleCertCache
+from config import settings
+
+CLIENT_ID = settings.google_oauth2_client_id
+ISSUER = "https://accounts.google.com"
+
+class Key:
+
+    def __init__(self, kid: str):
+        self.kid = kid
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        self.private_pem = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                             serialization.NoEncryption()).decode()
+        self.public_pem = key.public_key().public_bytes(serialization.Encoding.PEM,
+                                                        serialization.PublicFormat.SubjectPublicKeyInfo).decode()
+
+    def sign(self, **overrides) -> str:
+        now = int(time.time())
+        claims = {"iss": ISSUER, "aud": CLIENT_ID, "sub": "1234", "email": "user@example.com",
+                  "iat": now, "exp": now + 3600, **overrides}
+        return jwt.encode(crypt.RSASigner.from_string(self.private_pem, key_id=self.kid), claims).decode()
+
+# Serves {kid: public key PEM} like https://www.googleapis.com/oauth2/v1/certs,
+# from the keys in `keys`, which tests replace to rotate them.
+class FakeIssuer:
+
+    def __init__(self, keys):
+        self.keys = keys
+        self.requests = 0
+        issuer = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                issuer.requests += 1
+                body = json.dumps({key.kid: key.public_pem for key in issuer.keys}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Cache-Control", "public, max-age=3600")
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.certs_url = f"http://127.0.0.1:{self.server.server_address[1]}/certs"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+@pytest.fixture(scope="module")
+def keys():
+    return Key("key-1"), Key("key-2")
+
+@pytest.fixture
+def issuer(keys):
+    issuer = FakeIssuer([keys[0]])
+    yield issuer
+    issuer.close()
+
+@pytest.fixture
+def cert_cache(issuer, monkeypatch):
+    cache = GoogleCertCache(issuer.certs_url, default_max_age=3600, min_refresh=0)
+    # verify_oauth2_token goes through the module's cache.
+    monkeypatch.setattr(idtoken, "cert_cache", cache)
+    return cache
+
+def verify(token: str, audience: str = CLIENT_ID):
+    return asyncio.run(idtoken.verify_oauth2_token(token, audience))
+
+def test_verify(keys, issuer, cert_cache):
+    idinfo = verify(keys[0].sign())
+    assert idinfo["email"] == "user@example.com"
+    assert idinfo["aud"] == CLIENT_ID
+    # The second token is checked against the cached certs.
+    verify(keys[0].sign(sub="5678"))
+    assert cert_cache.fetches == 1
+    assert issuer.requests == 1
+
+def test_unknown_kid_refetches_certs(keys, issuer, cert_cache):
+    verify(keys[0].sign())
+    issuer.keys = [keys[0], keys[1]]
+    idinfo = verify(keys[1].sign())
+    assert idinfo["sub"] == "1234"
+    assert cert_cache.fetches == 2
+    assert set(cert_cache.certs) == {"key-1", "key-2"}
+
+def test_unknown_kid_refetch_is_throttled(keys, issuer, cert_cache):
+    cert_cache.min_refresh = 3600
+    verify(keys[0].sign())
+    issuer.keys = [keys[0], keys[1]]
+    with pytest.raises(ValueError):
+        verify(keys[1].sign())
+    assert cert_cache.fetches == 1
+    assert issuer.requests == 1
+
+def test_wrong_audience_is_rejected(keys, issuer, cert_cache):
+    with pytest.raises(ValueError):
+        verify(keys[0].sign(), audience="another-client-id")
+    with pytest.raises(ValueError):
+        verify(keys[0].sign(aud="another-client-id"))
+
+def test_wrong_issuer_is_rejected(keys, issuer, cert_cache):
+    with pytest.raises(ValueError, match="Wrong issuer"):
+        verify(keys[0].sign(iss="https://issuer.example.com"))
+
+def test_signature_of_another_key_is_rejected(keys, issuer, cert_cache):
+    forged = Key("key-1")
+    with pytest.raises(ValueError):
+        verify(forged.sign())